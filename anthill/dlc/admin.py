@@ -1,19 +1,25 @@
 
 from tornado.gen import IOLoop
-from tornado.queues import Queue
 
 import anthill.common.admin as a
 from anthill.common import random_string
+from anthill.common.options import options
 from anthill.common.environment import EnvironmentClient, AppNotFound
 
 from . model.data import VersionUsesDataError, DataError, NoSuchDataError, DatasModel
 from . model.apps import ApplicationVersionError, NoSuchApplicationVersionError, \
     NoSuchApplicationError, ApplicationError, ApplicationsModel
-from . model.bundle import BundleError, NoSuchBundleError, BundlesModel, BundleQueryError
+from . model.bundle import BundleError, NoSuchBundleError, BundlesModel, BundleQueryError, \
+    BundleUploadPipeline, UploadAbortedError
 from . model.deploy import DeploymentMethods, DeploymentModel
+from . model.jobs import JobError
+from . model.storage import storage_path, AREA_IMPORTS
 
+import asyncio
 import base64
 import logging
+import os
+import tempfile
 import ujson
 
 
@@ -192,7 +198,9 @@ class BundleController(a.UploadAdminController):
     def __init__(self, app, token):
         super(BundleController, self).__init__(app, token)
 
-        self.chunks = Queue(10)
+        self.pipeline = BundleUploadPipeline(options.upload_buffer_size)
+        self.upload = None
+        self.upload_started = None
 
     async def detach(self, **ignored):
 
@@ -224,6 +232,11 @@ class BundleController(a.UploadAdminController):
         except BundleError as e:
             raise a.ActionError(e.message)
 
+        try:
+            await datas.refresh_manifests(self.gamespace, [data_id])
+        except DataError as e:
+            raise a.ActionError(e.message)
+
         raise a.Redirect(
             "data_version",
             message="Bundle has been detached",
@@ -314,10 +327,8 @@ class BundleController(a.UploadAdminController):
             raise a.ActionError(e.message)
 
         try:
-            await bundles.update_bundle_properties(self.gamespace, bundle_id, bundle_filters, bundle_payload)
-        except NoSuchBundleError:
-            raise a.ActionError("No such bundle")
-        except BundleError as e:
+            await datas.update_bundle_properties(self.gamespace, bundle_id, bundle_filters, bundle_payload)
+        except DataError as e:
             raise a.ActionError(e.message)
 
         raise a.Redirect("bundle",
@@ -476,17 +487,34 @@ class BundleController(a.UploadAdminController):
         except BundleError as e:
             raise a.ActionError(e.message)
 
-        IOLoop.current().add_callback(
-            bundles.upload_bundle,
-            self.gamespace, app_id, bundle,
-            self.__producer__)
+        self.upload_started = IOLoop.current().time()
+        self.upload = asyncio.ensure_future(bundles.upload_bundle(
+            self.gamespace, app_id, bundle, self.pipeline.produce))
+        self.upload.add_done_callback(self.__upload_done__)
+
+    def __upload_done__(self, upload):
+        if upload.cancelled():
+            self.pipeline.abort("Upload has been cancelled")
+        elif upload.exception() is not None:
+            self.pipeline.abort(str(upload.exception()))
 
     async def receive_data(self, chunk):
-        await self.chunks.put(chunk)
+        # waits while too much of the upload is still not written, so the request body is read no faster than that
+        try:
+            await self.pipeline.put(chunk)
+        except UploadAbortedError as e:
+            raise a.ActionError("Failed to upload bundle: " + e.message)
 
     async def receive_completed(self):
 
-        await self.chunks.put(None)
+        self.pipeline.finish()
+
+        try:
+            await self.upload
+        except (BundleError, UploadAbortedError, OSError) as e:
+            raise a.ActionError("Failed to upload bundle: " + str(e))
+        finally:
+            self.__report_upload__()
 
         app_id = self.context.get("app_id")
         bundle_id = self.context.get("bundle_id")
@@ -498,12 +526,15 @@ class BundleController(a.UploadAdminController):
                          bundle_id=bundle_id,
                          data_id=data_id)
 
-    async def __producer__(self, write):
-        while True:
-            chunk = await self.chunks.get()
-            if chunk is None:
-                return
-            await write(chunk)
+    def __report_upload__(self):
+        pipeline = self.pipeline
+
+        self.application.monitor_action("bundle_upload", values={
+            "time": IOLoop.current().time() - self.upload_started,
+            "max_depth": pipeline.max_depth,
+            "stalls": pipeline.stalls,
+            "stall_time": pipeline.stall_time
+        }, gamespace=str(self.gamespace))
 
 
 class DataVersionController(a.AdminController):
@@ -518,12 +549,34 @@ class DataVersionController(a.AdminController):
             await datas.delete_data_version(self.gamespace, app_id, data_id)
         except VersionUsesDataError:
             raise a.ActionError("Application Version uses this data, detach the version first.")
+        except NoSuchDataError:
+            raise a.ActionError("No such data version")
+        except DataError as e:
+            raise a.ActionError(e.message)
 
         raise a.Redirect(
             "app",
             message="Data version has been deleted",
             app_id=app_id)
 
+    async def clone(self, **ignored):
+
+        datas = self.application.datas
+
+        app_id = self.context.get("app_id")
+        data_id = self.context.get("data_id")
+
+        try:
+            new_data_id = await datas.clone_data_version(self.gamespace, app_id, data_id)
+        except NoSuchDataError:
+            raise a.ActionError("No such data version")
+        except DataError as e:
+            raise a.ActionError(e.message)
+
+        raise a.Redirect("data_version",
+                         message="New data version has been created",
+                         app_id=app_id, data_id=new_data_id)
+
     async def publish(self, **ignored):
 
         datas = self.application.datas
@@ -548,7 +601,9 @@ class DataVersionController(a.AdminController):
                          message="Publish process has been started",
                          app_id=app_id, data_id=data_id)
 
-    async def get(self, app_id, data_id):
+    BUNDLES_PER_PAGE = 100
+
+    async def get(self, app_id, data_id, cursor=None):
 
         bundles = self.application.bundles
         datas = self.application.datas
@@ -566,15 +621,37 @@ class DataVersionController(a.AdminController):
         except DataError as e:
             raise a.ActionError(e.message)
 
+        # the table needs neither the filters nor the payload of the bundles
+        q = bundles.bundles_query(self.gamespace)
+
+        q.data_id = data_id
+        q.lean = True
+        q.cursor = cursor
+        q.limit = DataVersionController.BUNDLES_PER_PAGE
+
         try:
-            bundles = await bundles.list_bundles(self.gamespace, data_id)
-        except BundleError as e:
+            bundles, next_cursor, bundles_count = await q.query_page(count=True)
+        except BundleQueryError as e:
             raise a.ActionError(e.message)
 
+        data_status = data.status + (": " + str(data.reason) if data.reason else "")
+
+        if data.status == DatasModel.STATUS_PUBLISHING:
+            try:
+                job = await datas.jobs.get_job(self.gamespace, data_id)
+            except JobError as e:
+                raise a.ActionError(e.message)
+
+            if job is not None and job.total:
+                data_status += " ({0} of {1} bundles delivered)".format(job.progress, job.total)
+
         result = {
             "app_name": app.title,
             "bundles": bundles,
-            "data_status": data.status + (": " + str(data.reason) if data.reason else "")
+            "bundles_count": bundles_count,
+            "next_cursor": next_cursor,
+            "status": data.status,
+            "data_status": data_status
         }
 
         return result
@@ -587,15 +664,12 @@ class DataVersionController(a.AdminController):
                 a.link("app", data["app_name"], app_id=self.context.get("app_id"))
             ], "Data #" + str(self.context.get("data_id"))),
 
-            a.content("Bundles of data version: #" + str(self.context.get("data_id")), headers=[
+            a.content("Bundles of data version: #{0} ({1} total)".format(
+                self.context.get("data_id"), data["bundles_count"]), headers=[
                 {
                     "id": "name",
                     "title": "Bundle"
                 },
-                {
-                    "id": "filters",
-                    "title": "Bundle filters"
-                },
                 {
                     "id": "size",
                     "title": "Bundle size"
@@ -623,9 +697,6 @@ class DataVersionController(a.AdminController):
                     "size": BundleController.sizeof_fmt(bundle.size) if bundle.size else [
                         a.status("Empty", "info")
                     ],
-                    "filters": [
-                        a.json_view(bundle.filters)
-                    ],
                     "hash": bundle.hash[-24:] if bundle.hash else [
                         a.status("No hash", "info")
                     ],
@@ -654,13 +725,29 @@ class DataVersionController(a.AdminController):
             ], style="primary", empty="No bundles in this data")
         ]
 
-        status = data["data_status"]
+        pages = []
+
+        if self.context.get("cursor"):
+            pages.append(a.link("data_version", "First page", icon="fast-backward",
+                                app_id=self.context.get("app_id"), data_id=self.context.get("data_id")))
+
+        if data["next_cursor"]:
+            pages.append(a.link("data_version", "Next page", icon="forward",
+                                app_id=self.context.get("app_id"), data_id=self.context.get("data_id"),
+                                cursor=data["next_cursor"]))
+
+        if pages:
+            r.append(a.links("Pages", pages))
+
+        status = data["status"]
 
         if status == DatasModel.STATUS_PUBLISHED:
             r.extend([
                 a.form("Actions", fields={
                     "data_status": a.field("Status", "status", "success")
-                }, methods={}, data=data),
+                }, methods={
+                    "clone": a.method("Create a new data version from this one", "primary")
+                }, data=data),
                 a.links("Navigate", [
                     a.link("app", "Back", app_id=self.context.get("app_id"))
                 ])
@@ -678,20 +765,25 @@ class DataVersionController(a.AdminController):
                         DatasModel.STATUS_CREATED: "default",
                         DatasModel.STATUS_PUBLISHED: "success",
                         DatasModel.STATUS_PUBLISHING: "info"
-                    }.get(data["data_status"], "danger"), icon={
+                    }.get(status, "danger"), icon={
                         DatasModel.STATUS_CREATED: "cog fa-spin",
                         DatasModel.STATUS_PUBLISHED: "check",
                         DatasModel.STATUS_PUBLISHING: "refresh fa-spin"
-                    }.get(data["data_status"], "error"))
+                    }.get(status, "error"))
                 }, methods={
                     "delete": a.method("Delete", "danger", order=1),
-                    "publish": a.method("Publish this data version", "success", order=2)
+                    "publish": a.method("Publish this data version", "success", order=2),
+                    "clone": a.method("Create a new data version from this one (delivered bundles only)",
+                                      "primary", order=3)
                 }, data=data),
                 a.links("Navigate", [
                     a.link("app", "Back", app_id=self.context.get("app_id")),
                     a.link("new_bundle", "Add new bundle", "plus", app_id=self.context.get("app_id"),
                            data_id=self.context.get("data_id")),
                     a.link("attach_bundle", "Attach existing bundle", "plus-circle",
+                           app_id=self.context.get("app_id"),
+                           data_id=self.context.get("data_id")),
+                    a.link("import_bundles", "Import bundles", "upload",
                            app_id=self.context.get("app_id"),
                            data_id=self.context.get("data_id"))
                 ])
@@ -798,6 +890,142 @@ class NewBundleController(a.AdminController):
             data_id=data_id)
 
 
+class ImportBundlesController(a.UploadAdminController):
+    def __init__(self, app, token):
+        super(ImportBundlesController, self).__init__(app, token)
+
+        self.archive = None
+        self.archive_path = None
+
+    async def get(self, app_id, data_id):
+
+        datas = self.application.datas
+        environment_client = EnvironmentClient(self.application.cache)
+
+        try:
+            app = await environment_client.get_app_info(app_id)
+        except AppNotFound as e:
+            raise a.ActionError("App was not found.")
+
+        try:
+            await datas.get_data_version(self.gamespace, data_id)
+        except DataError as e:
+            raise a.ActionError(e.message)
+        except NoSuchDataError:
+            raise a.ActionError("No such data")
+
+        result = {
+            "app_name": app.title,
+            "bundles": []
+        }
+
+        return result
+
+    def render(self, data):
+        return [
+            a.breadcrumbs([
+                a.link("index", "Applications"),
+                a.link("app", data["app_name"], app_id=self.context.get("app_id")),
+                a.link("data_version", "Data #" + str(self.context.get("data_id")),
+                       app_id=self.context.get("app_id"), data_id=self.context.get("data_id"))
+            ], "Import bundles"),
+            a.notice("About importing",
+                     """
+                        Creates many bundles at once. Either every bundle is created, or none of them.
+                        A list of bundles creates empty bundles, their contents should be uploaded later.
+                        An archive (zip) creates a bundle for every file in it, named after the file, and uploads
+                        its contents. Filters and payloads could be set with an optional bundles.json file
+                        in the root of the archive: {"bundle name": {"filters": {...}, "payload": {...}}}
+                     """),
+            a.form("Import a list of bundles", fields={
+                "bundles": a.field("Bundles: [{\"name\": ..., \"filters\": {...}, \"payload\": {...}}, ...]",
+                                   "json", "primary", "non-empty", order=1)
+            }, methods={
+                "import_bundles": a.method("Import", "primary")
+            }, data=data),
+            a.file_upload("Import an archive"),
+            a.links("Navigate", [
+                a.link("data_version", "Back", app_id=self.context.get("app_id"), data_id=self.context.get("data_id"))
+            ])
+        ]
+
+    def access_scopes(self):
+        return ["dlc_admin"]
+
+    async def import_bundles(self, bundles):
+
+        try:
+            bundles = ujson.loads(bundles)
+        except (KeyError, ValueError):
+            raise a.ActionError("Corrupted bundles")
+
+        if not isinstance(bundles, list) or not all(isinstance(bundle, dict) for bundle in bundles):
+            raise a.ActionError("Bundles should be a list of objects")
+
+        app_id = self.context.get("app_id")
+        data_id = self.context.get("data_id")
+
+        try:
+            created = await self.application.bundles.import_bundles(self.gamespace, data_id, [
+                (bundle.get("name"), bundle.get("filters", {}), bundle.get("payload", {}))
+                for bundle in bundles
+            ])
+        except BundleError as e:
+            raise a.ActionError(e.message)
+
+        raise a.Redirect(
+            "data_version",
+            message="{0} bundle(s) have been created".format(len(created)),
+            app_id=app_id,
+            data_id=data_id)
+
+    @staticmethod
+    def __create_archive__(directory):
+        """
+        Runs on the executor: returns (path, file) of a new temporary archive in the directory
+        """
+        os.makedirs(directory, exist_ok=True)
+        fd, path = tempfile.mkstemp(suffix=".zip", dir=directory)
+        return path, os.fdopen(fd, "wb")
+
+    async def receive_started(self, filename, args):
+
+        bundles = self.application.bundles
+        directory = storage_path(bundles.data_location, AREA_IMPORTS)
+
+        try:
+            self.archive_path, self.archive = await IOLoop.current().run_in_executor(
+                bundles.executor, ImportBundlesController.__create_archive__, directory)
+        except OSError as e:
+            raise a.ActionError("Failed to receive archive: " + str(e))
+
+    async def receive_data(self, chunk):
+        await IOLoop.current().run_in_executor(self.application.bundles.executor, self.archive.write, chunk)
+
+    async def receive_completed(self):
+
+        bundles = self.application.bundles
+        app_id = self.context.get("app_id")
+        data_id = self.context.get("data_id")
+
+        await IOLoop.current().run_in_executor(bundles.executor, self.archive.close)
+
+        try:
+            created = await bundles.import_archive(
+                self.gamespace, app_id, data_id, self.archive_path, options.import_concurrency)
+        except BundleError as e:
+            raise a.ActionError(e.message)
+        finally:
+            # removed in the background
+            bundles.reclaimer.reclaim([self.archive_path])
+
+        raise a.Redirect(
+            "data_version",
+            message="{0} bundle(s) have been imported".format(len(created)),
+            app_id=app_id,
+            data_id=data_id)
+
+
 class RootAdminController(a.AdminController):
     async def get(self):
 
@@ -842,6 +1070,7 @@ class ApplicationSettingsController(a.AdminController):
         except NoSuchApplicationError:
             deployment_method = ""
             deployment_data = {}
+            deployment_concurrency = ApplicationsModel.DEFAULT_DEPLOYMENT_CONCURRENCY
             payload_scheme = ApplicationsModel.DEFAULT_PAYLOAD_SCHEME
             filters_scheme = ApplicationsModel.DEFAULT_FILTERS_SCHEME
         except ApplicationError as e:
@@ -849,6 +1078,7 @@ class ApplicationSettingsController(a.AdminController):
         else:
             deployment_method = settings.deployment_method
             deployment_data = settings.deployment_data
+            deployment_concurrency = settings.deployment_concurrency
             filters_scheme = settings.filters_scheme
             payload_scheme = settings.payload_scheme
 
@@ -862,12 +1092,48 @@ class ApplicationSettingsController(a.AdminController):
             "deployment_methods": deployment_methods,
             "deployment_method": deployment_method,
             "deployment_data": deployment_data,
+            "deployment_concurrency": deployment_concurrency,
             "filters_scheme": filters_scheme,
             "payload_scheme": payload_scheme
         }
 
         return result
 
+    async def update_concurrency(self, deployment_concurrency):
+
+        app_id = self.context.get("app_id")
+
+        environment_client = EnvironmentClient(self.application.cache)
+        apps = self.application.app_versions
+
+        try:
+            deployment_concurrency = int(deployment_concurrency)
+        except (TypeError, ValueError):
+            raise a.ActionError("Concurrency should be a number")
+
+        if deployment_concurrency < 1:
+            raise a.ActionError("Concurrency should be at least 1")
+
+        try:
+            await environment_client.get_app_info(app_id)
+        except AppNotFound as e:
+            raise a.ActionError("App was not found.")
+
+        try:
+            await apps.get_application(self.gamespace, app_id)
+        except NoSuchApplicationError:
+            raise a.ActionError("Please select deployment method first")
+        except ApplicationError as e:
+            raise a.ActionError(e.message)
+
+        try:
+            await apps.update_deployment_concurrency(self.gamespace, app_id, deployment_concurrency)
+        except ApplicationError as e:
+            raise a.ActionError(e.message)
+
+        raise a.Redirect("app_settings", message="Deployment concurrency has been updated",
+                         app_id=app_id)
+
     async def update_deployment_method(self, deployment_method):
 
         app_id = self.context.get("app_id")
@@ -1011,6 +1277,13 @@ class ApplicationSettingsController(a.AdminController):
                     "update_deployment": a.method("Update", "primary")
                 }, data=deployment_data))
 
+            r.append(a.form("Deployment concurrency", fields={
+                "deployment_concurrency": a.field(
+                    "How many bundles are deployed at the same time", "text", "primary", "number")
+            }, methods={
+                "update_concurrency": a.method("Update", "primary")
+            }, data=data))
+
             r.append(a.form("Update schemes", fields={
                 "payload_scheme": a.field("""
                     This scheme is used to define custom attributes for each bundle.
@@ -1132,6 +1405,11 @@ class AttachBundleController(a.AdminController):
         except BundleError as e:
             raise a.ActionError(e.message)
 
+        try:
+            await datas.refresh_manifests(self.gamespace, [data_id])
+        except DataError as e:
+            raise a.ActionError(e.message)
+
         raise a.Redirect(
             "bundle",
             message="Bundle has been attached",
@@ -2,22 +2,65 @@
 from anthill.common.handler import JsonHandler, AuthenticatedHandler
 from anthill.common.access import scoped, AccessToken
 
-from tornado.web import HTTPError
+from tornado.web import HTTPError, RequestHandler
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado import httputil
 
 from . model.apps import NoSuchApplicationVersionError, ApplicationVersionError
-from . model.bundle import BundleQueryError, BundlesModel
+from . model.bundle import BundleQueryError, BundlesModel, BundleError
+from . model.cache import ManifestCache
+from . model.data import DataError
+from . model.filters import FilterError
+from . model.upload import UploadError, NoSuchUploadError
 
+import mimetypes
+import os
+import re
 import ujson
 
+from stat import S_ISREG
+
 
 class AppVersionHandler(JsonHandler):
+    # in order of preference
+    ENCODINGS = ["br", "gzip"]
+
     def data_received(self, chunk):
         pass
 
+    def __encoding__(self, manifest):
+        """
+        Picks one of the precompressed bodies the client accepts, or None for the plain one
+        """
+        accepted = {}
+
+        for part in self.request.headers.get("Accept-Encoding", "").split(","):
+            params = part.strip().split(";")
+            quality = 1.0
+
+            for param in params[1:]:
+                param = param.strip()
+                if param.startswith("q="):
+                    try:
+                        quality = float(param[2:])
+                    except ValueError:
+                        quality = 0
+
+            accepted[params[0].strip().lower()] = quality
+
+        for encoding in AppVersionHandler.ENCODINGS:
+            if encoding in manifest.encodings and accepted.get(encoding, accepted.get("*", 0)) > 0:
+                return encoding
+
+        return None
+
     async def get(self, app_name, version_name):
 
         apps = self.application.app_versions
         bundles = self.application.bundles
+        datas = self.application.datas
+        manifests = self.application.manifests
 
         env = self.get_argument("env", "{}")
 
@@ -26,67 +69,511 @@ class AppVersionHandler(JsonHandler):
         except (KeyError, ValueError):
             raise HTTPError(400, "Corrupted 'env'")
 
-        try:
-            v = await apps.get_application_version(app_name, version_name)
-        except NoSuchApplicationVersionError:
-            raise HTTPError(404, "No such app and/or version")
-        except ApplicationVersionError as e:
-            raise HTTPError(500, e.message)
+        env_key = ManifestCache.normalize_env(env)
+        key = await manifests.key(app_name, version_name, env_key)
+        manifest = await manifests.get(key)
 
-        q = bundles.bundles_query(v.gamespace_id)
+        if manifest is None:
+            version_key = await manifests.version_key(app_name, version_name)
+            v = await manifests.get_json(version_key)
 
-        q.data_id = v.current
-        q.status = BundlesModel.STATUS_DELIVERED
-        q.filters = env
+            if v is None:
+                try:
+                    app_version = await apps.get_application_version(app_name, version_name)
+                except NoSuchApplicationVersionError:
+                    raise HTTPError(404, "No such app and/or version")
+                except ApplicationVersionError as e:
+                    raise HTTPError(500, e.message)
 
-        try:
-            bundles = await q.query(one=False)
-        except BundleQueryError as e:
-            raise HTTPError(500, e.message)
+                v = await manifests.put_json(version_key, {
+                    "gamespace_id": app_version.gamespace_id,
+                    "current": app_version.current
+                })
 
-        self.dumps({
-            "bundles": {
-                bundle.name: {
-                    "hash": bundle.hash,
-                    "url": bundle.url,
-                    "size": bundle.size,
-                    "payload": bundle.payload
-                } for bundle in bundles
-            }
-        })
+            try:
+                snapshot = await datas.get_manifest_snapshot(v["gamespace_id"], app_name, v["current"])
+            except DataError as e:
+                raise HTTPError(500, e.message)
+
+            if snapshot is not None:
+                try:
+                    manifest = snapshot.manifest(env)
+                except FilterError as e:
+                    raise HTTPError(400, e.message)
+            else:
+                q = bundles.bundles_query(v["gamespace_id"])
+
+                q.data_id = v["current"]
+                q.status = BundlesModel.STATUS_DELIVERED
+                q.filters = env
+
+                try:
+                    bundles = await q.query(one=False)
+                except BundleQueryError as e:
+                    raise HTTPError(500, e.message)
+
+                manifest = {
+                    "bundles": {
+                        bundle.name: {
+                            "hash": bundle.hash,
+                            "url": bundle.url,
+                            "size": bundle.size,
+                            "payload": bundle.payload
+                        } for bundle in bundles
+                    }
+                }
+
+            manifest = await manifests.put(key, await manifests.build(v["current"], manifest))
+
+        encoding = self.__encoding__(manifest)
+
+        self.set_header("Vary", "Accept-Encoding")
+
+        # every representation should have its own strong ETag
+        if encoding:
+            self.set_header("Etag", '"{0}-{1}"'.format(manifest.etag, encoding))
+        else:
+            self.set_header("Etag", '"{0}"'.format(manifest.etag))
+
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+
+        self.set_header("Content-Type", "application/json")
+
+        if encoding:
+            self.set_header("Content-Encoding", encoding)
+            self.write(manifest.encodings[encoding])
+        else:
+            self.write(manifest.body)
 
 
 class FetchBundleHandler(AuthenticatedHandler):
     @scoped(scopes=["dlc"])
     async def get(self):
 
-        apps = self.application.app_versions
         bundles = self.application.bundles
+        manifests = self.application.manifests
 
         bundle_name = self.get_argument("bundle_name")
         bundle_hash = self.get_argument("bundle_hash")
 
         gamespace_id = self.current_user.token.get(AccessToken.GAMESPACE)
 
-        q = bundles.bundles_query(gamespace_id)
+        keys = await manifests.bundle_keys(gamespace_id, [(bundle_name, bundle_hash)])
+        key = keys[(bundle_name, bundle_hash)]
+        bundle = await manifests.get_json(key)
 
-        q.status = BundlesModel.STATUS_DELIVERED
-        q.name = bundle_name
-        q.hash = bundle_hash
+        if bundle is None:
+            q = bundles.bundles_query(gamespace_id)
 
-        try:
-            bundle = await q.query(one=True)
-        except BundleQueryError as e:
-            raise HTTPError(500, e.message)
+            q.status = BundlesModel.STATUS_DELIVERED
+            q.name = bundle_name
+            q.hash = bundle_hash
+
+            try:
+                found = await q.query(one=True)
+            except BundleQueryError as e:
+                raise HTTPError(500, e.message)
 
-        if not bundle:
-            raise HTTPError(404, "No such bundle")
+            if not found:
+                raise HTTPError(404, "No such bundle")
+
+            # invalidated once filters or payload of a bundle change, see DatasModel.update_bundle_properties
+            bundle = await manifests.put_json(key, {
+                "hash": found.hash,
+                "url": found.url,
+                "size": found.size,
+                "payload": found.payload
+            })
 
         self.dumps({
-            "bundle": {
+            "bundle": bundle
+        })
+
+
+class FetchBundlesHandler(AuthenticatedHandler):
+    """
+    Same as FetchBundleHandler, but for many bundles at once. Expects a JSON list of
+    {"name": ..., "hash": ...} objects as the 'bundles' argument.
+    """
+
+    MAX_BUNDLES = 1000
+
+    @scoped(scopes=["dlc"])
+    async def post(self):
+
+        bundles = self.application.bundles
+        manifests = self.application.manifests
+
+        pairs = self.get_argument("bundles")
+
+        try:
+            pairs = ujson.loads(pairs)
+        except (KeyError, ValueError):
+            raise HTTPError(400, "Corrupted 'bundles'")
+
+        if not isinstance(pairs, list):
+            raise HTTPError(400, "'bundles' should be a list")
+
+        if len(pairs) > FetchBundlesHandler.MAX_BUNDLES:
+            raise HTTPError(400, "Too many bundles at once, {0} max".format(FetchBundlesHandler.MAX_BUNDLES))
+
+        try:
+            pairs = [(str(pair["name"]), str(pair["hash"])) for pair in pairs]
+        except (KeyError, TypeError):
+            raise HTTPError(400, "Each of 'bundles' should have 'name' and 'hash'")
+
+        gamespace_id = self.current_user.token.get(AccessToken.GAMESPACE)
+
+        keys = await manifests.bundle_keys(gamespace_id, pairs)
+
+        cached = await manifests.get_json_many(list(keys.values()))
+        missing = [pair for pair, key in keys.items() if key not in cached]
+
+        try:
+            found = await bundles.find_delivered_bundles(gamespace_id, missing)
+        except BundleError as e:
+            raise HTTPError(500, e.message)
+
+        found = {
+            keys[(bundle.name, bundle.hash)]: {
                 "hash": bundle.hash,
                 "url": bundle.url,
                 "size": bundle.size,
                 "payload": bundle.payload
             }
+            for bundle in found
+            if (bundle.name, bundle.hash) in keys
+        }
+
+        await manifests.put_json_many(found)
+        cached.update(found)
+
+        result_found = []
+        result_missing = []
+
+        for pair, key in keys.items():
+            bundle = cached.get(key)
+            if bundle is None:
+                result_missing.append({
+                    "name": pair[0],
+                    "hash": pair[1]
+                })
+            else:
+                result_found.append(dict(bundle, name=pair[0]))
+
+        self.dumps({
+            "bundles": result_found,
+            "missing": result_missing
+        })
+
+
+class UploadsHandler(AuthenticatedHandler):
+    """
+    Starts a resumable upload of a bundle, see UploadHandler
+    """
+
+    @scoped(scopes=["dlc_admin"])
+    async def post(self):
+
+        uploads = self.application.uploads
+
+        app_id = self.get_argument("app_id")
+        data_id = self.get_argument("data_id")
+        bundle_id = self.get_argument("bundle_id")
+        upload_hash = self.get_argument("hash", None)
+
+        try:
+            upload_size = int(self.get_argument("size"))
+        except ValueError:
+            raise HTTPError(400, "Bad size")
+
+        gamespace_id = self.current_user.token.get(AccessToken.GAMESPACE)
+
+        try:
+            upload_id = await uploads.create_upload(
+                gamespace_id, app_id, data_id, bundle_id, upload_size, upload_hash)
+        except UploadError as e:
+            raise HTTPError(400, e.message)
+
+        self.dumps({
+            "upload_id": str(upload_id)
+        })
+
+
+class UploadHandler(AuthenticatedHandler):
+    """
+    GET returns the ranges already uploaded, PUT writes the request body at the 'offset',
+    DELETE cancels the upload
+    """
+
+    async def __ranges__(self, upload_id):
+        uploads = self.application.uploads
+        gamespace_id = self.current_user.token.get(AccessToken.GAMESPACE)
+
+        try:
+            upload, ranges = await uploads.list_ranges(gamespace_id, upload_id)
+        except NoSuchUploadError:
+            raise HTTPError(404, "No such upload")
+        except UploadError as e:
+            raise HTTPError(500, e.message)
+
+        self.dumps({
+            "upload": upload.dump(),
+            "ranges": ranges,
+            "complete": ranges == [[0, upload.size]] or not upload.size
         })
+
+    @scoped(scopes=["dlc_admin"])
+    async def get(self, upload_id):
+        await self.__ranges__(upload_id)
+
+    @scoped(scopes=["dlc_admin"])
+    async def put(self, upload_id):
+
+        uploads = self.application.uploads
+
+        try:
+            chunk_offset = int(self.get_argument("offset"))
+        except ValueError:
+            raise HTTPError(400, "Bad offset")
+
+        gamespace_id = self.current_user.token.get(AccessToken.GAMESPACE)
+
+        try:
+            await uploads.write_chunk(gamespace_id, upload_id, chunk_offset, self.request.body)
+        except NoSuchUploadError:
+            raise HTTPError(404, "No such upload")
+        except UploadError as e:
+            raise HTTPError(400, e.message)
+
+        await self.__ranges__(upload_id)
+
+    @scoped(scopes=["dlc_admin"])
+    async def delete(self, upload_id):
+
+        uploads = self.application.uploads
+        gamespace_id = self.current_user.token.get(AccessToken.GAMESPACE)
+
+        try:
+            await uploads.delete_upload(gamespace_id, upload_id)
+        except UploadError as e:
+            raise HTTPError(500, e.message)
+
+
+class FinalizeUploadHandler(AuthenticatedHandler):
+    @scoped(scopes=["dlc_admin"])
+    async def post(self, upload_id):
+
+        uploads = self.application.uploads
+        gamespace_id = self.current_user.token.get(AccessToken.GAMESPACE)
+
+        try:
+            bundle_hash = await uploads.finalize_upload(gamespace_id, upload_id)
+        except NoSuchUploadError:
+            raise HTTPError(404, "No such upload")
+        except UploadError as e:
+            raise HTTPError(409, e.message)
+
+        self.dumps({
+            "hash": bundle_hash
+        })
+
+
+def stat_file(path):
+    """
+    Runs on the executor: returns os.stat of a regular file, or None if there's no such file
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    return stat if S_ISREG(stat.st_mode) else None
+
+
+def parse_range(header, size):
+    """
+    Parses a Range header (a single range of bytes) of a file of the size, returns [start, end)
+    of the requested range, or None if the whole file should be sent instead
+    """
+
+    m = DownloadHandler.RANGE_PATTERN.match(header.strip())
+
+    # multiple ranges are not supported, the whole file is sent instead (as RFC 7233 allows)
+    if not m or not (m.group(1) or m.group(2)):
+        return None
+
+    if m.group(1):
+        start = int(m.group(1))
+        end = int(m.group(2)) + 1 if m.group(2) else size
+    else:
+        # the last N bytes
+        start = max(0, size - int(m.group(2)))
+        end = size
+
+    return start, min(end, size)
+
+
+class DownloadHandler(RequestHandler):
+    """
+    Serves deployed files (see LocalDeploymentMethod) straight from data_runtime_location,
+    for the deployments without a separate web server or a CDN.
+
+    Supports Range (a single one) and If-Range. The file is opened and read on the executor, a block
+    at a time (the next one is read while the previous one is being sent), so the IOLoop never waits for the disk.
+
+    The ETag of a chunk is its hash (it is a part of the path). The ETag of a bundle file is not the hash
+    of the bundle: the path has the bundle key, not the hash, and looking the hash up would put the database
+    on the path of every request. A delivered bundle file is never rewritten in place, so its modification
+    time, size and inode identify its content just as well.
+    """
+
+    CHUNK_SIZE = 1048576
+    RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+    CHUNK_PATTERN = re.compile(r"^chunks/([0-9a-f]{64})$")
+
+    def initialize(self, root):
+        self.root = os.path.abspath(root)
+
+    def data_received(self, chunk):
+        pass
+
+    async def __resolve__(self, path):
+        """
+        Returns the absolute path of the file and its os.stat, the disk is accessed on the executor
+        """
+        absolute_path = os.path.abspath(os.path.join(self.root, path))
+
+        if not absolute_path.startswith(self.root + os.sep):
+            raise HTTPError(403)
+
+        stat = await IOLoop.current().run_in_executor(self.application.bundles.executor, stat_file, absolute_path)
+
+        if stat is None:
+            raise HTTPError(404)
+
+        return absolute_path, stat
+
+    @staticmethod
+    def __etag__(path, stat):
+        """
+        A chunk is identified by its hash, anything else (a bundle file is never rewritten in place)
+        by its size and modification time
+        """
+
+        chunk = DownloadHandler.CHUNK_PATTERN.match(path)
+
+        if chunk:
+            return chunk.group(1)
+
+        return "{0:x}-{1:x}-{2:x}".format(int(stat.st_mtime), stat.st_size, stat.st_ino)
+
+    def __range__(self, size, etag, modified):
+        """
+        Returns (start, end) of the requested range, or None for the whole file
+        """
+
+        header = self.request.headers.get("Range")
+
+        if not header:
+            return None
+
+        if_range = self.request.headers.get("If-Range")
+
+        # the client has a different version of the file, so it needs the whole file
+        if if_range and if_range.strip() not in ('"{0}"'.format(etag), modified):
+            return None
+
+        return parse_range(header, size)
+
+    async def head(self, path):
+        await self.__serve__(path, include_body=False)
+
+    async def get(self, path):
+        await self.__serve__(path, include_body=True)
+
+    async def __serve__(self, path, include_body):
+        absolute_path, stat = await self.__resolve__(path)
+        size = stat.st_size
+
+        etag = DownloadHandler.__etag__(path, stat)
+        modified = httputil.format_timestamp(stat.st_mtime)
+
+        self.set_header("Etag", '"{0}"'.format(etag))
+        self.set_header("Last-Modified", modified)
+        self.set_header("Accept-Ranges", "bytes")
+        self.set_header("Content-Type", mimetypes.guess_type(absolute_path)[0] or "application/octet-stream")
+
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+
+        requested = self.__range__(size, etag, modified)
+
+        if requested is None:
+            start, end = 0, size
+        else:
+            start, end = requested
+
+            if start >= end:
+                self.set_status(416)
+                self.set_header("Content-Range", "bytes */{0}".format(size))
+                return
+
+            self.set_status(206)
+            self.set_header("Content-Range", "bytes {0}-{1}/{2}".format(start, end - 1, size))
+
+        self.set_header("Content-Length", end - start)
+
+        if not include_body or start == end:
+            return
+
+        executor = self.application.bundles.executor
+
+        try:
+            fd = await IOLoop.current().run_in_executor(executor, os.open, absolute_path, os.O_RDONLY)
+        except OSError:
+            raise HTTPError(404)
+
+        try:
+            await self.flush()
+            await self.__send__(fd, start, end)
+        finally:
+            await IOLoop.current().run_in_executor(executor, os.close, fd)
+
+    async def __send__(self, fd, start, end):
+        loop = IOLoop.current()
+        executor = self.application.bundles.executor
+
+        def read(at):
+            return loop.run_in_executor(executor, os.pread, fd, min(DownloadHandler.CHUNK_SIZE, end - at), at)
+
+        offset = start
+        reading = read(offset)
+
+        try:
+            while reading is not None:
+                data = await reading
+                reading = None
+
+                # could be truncated since
+                if not data:
+                    break
+
+                offset += len(data)
+
+                if offset < end:
+                    reading = read(offset)
+
+                await self.request.connection.write(data)
+        except StreamClosedError:
+            pass
+        finally:
+            # the file is not closed while it is being read
+            if reading is not None:
+                try:
+                    await reading
+                except OSError:
+                    pass
@@ -1,7 +1,8 @@
 
-from anthill.common.model import Model
 from anthill.common.database import DatabaseError
 
+from . indexes import IndexedModel
+
 import ujson
 
 
@@ -42,12 +43,19 @@ class ApplicationAdapter(object):
         self.name = data.get("application_name")
         self.gamespace_id = data.get("gamespace_id")
         self.deployment_method = data.get("deployment_method")
-        self.deployment_data = data.get("deployment_data")
+        # settings of the deployment method only, the concurrency used to be kept there too
+        self.deployment_data = dict(data.get("deployment_data") or {})
+        legacy_concurrency = self.deployment_data.pop("concurrency", None)
+        self.deployment_concurrency = data.get("deployment_concurrency") or legacy_concurrency or \
+            ApplicationsModel.DEFAULT_DEPLOYMENT_CONCURRENCY
         self.filters_scheme = data.get("filters_scheme", ApplicationsModel.DEFAULT_FILTERS_SCHEME)
         self.payload_scheme = data.get("payload_scheme", {})
 
 
-class ApplicationsModel(Model):
+class ApplicationsModel(IndexedModel):
+
+    # how many bundles are deployed at the same time, unless set in the application settings
+    DEFAULT_DEPLOYMENT_CONCURRENCY = 4
 
     DEFAULT_PAYLOAD_SCHEME = {
         "type": "object",
@@ -162,8 +170,9 @@ class ApplicationsModel(Model):
         }
     }
 
-    def __init__(self, db):
+    def __init__(self, db, manifests):
         self.db = db
+        self.manifests = manifests
 
     def get_setup_db(self):
         return self.db
@@ -171,6 +180,9 @@ class ApplicationsModel(Model):
     def get_setup_tables(self):
         return ["applications", "application_versions"]
 
+    def get_setup_columns(self):
+        return [("applications", "deployment_concurrency")]
+
     async def delete_application_version(self, gamespace_id, app_id, version_id):
         try:
             await self.db.execute(
@@ -181,6 +193,8 @@ class ApplicationsModel(Model):
         except DatabaseError as e:
             raise ApplicationVersionError("Failed to delete application version: " + e.args[1])
 
+        await self.manifests.invalidate(app_id)
+
     async def find_application_version(self, gamespace_id, app_id, version_name):
         try:
             application_version = await self.db.get(
@@ -227,6 +241,8 @@ class ApplicationsModel(Model):
         except DatabaseError as e:
             raise ApplicationVersionError("Failed to switch app version: " + e.args[1])
 
+        await self.manifests.invalidate(app_id)
+
     async def delete_application(self, gamespace_id, app_id):
         try:
             await self.db.execute(
@@ -285,6 +301,8 @@ class ApplicationsModel(Model):
         filters_scheme = ujson.dumps(filters_scheme)
         payload_scheme = ujson.dumps(payload_scheme)
 
+        # the concurrency kept in the deployment_data by the older versions is moved into its own column
+        # before the deployment_data is replaced (the assignments are applied in order)
         try:
             await self.db.insert(
                 """
@@ -293,12 +311,29 @@ class ApplicationsModel(Model):
                     `filters_scheme`, `payload_scheme`)
                 VALUES (%s, %s, %s, %s, %s, %s)
                 ON DUPLICATE KEY
-                UPDATE `deployment_method`=%s, `deployment_data`=%s, `filters_scheme`=%s, `payload_scheme`=%s;
+                UPDATE
+                    `deployment_concurrency`=COALESCE(`deployment_concurrency`,
+                        JSON_EXTRACT(`deployment_data`, '$.concurrency')),
+                    `deployment_method`=%s, `deployment_data`=%s, `filters_scheme`=%s, `payload_scheme`=%s;
                 """, app_id, deployment_method, deployment_data, gamespace_id, filters_scheme, payload_scheme,
                 deployment_method, deployment_data, filters_scheme, payload_scheme)
         except DatabaseError as e:
             raise ApplicationError("Failed to switch app version: " + e.args[1])
 
+        # the filters scheme is a part of the manifest snapshots
+        await self.manifests.invalidate(app_id)
+
+    async def update_deployment_concurrency(self, gamespace_id, app_id, deployment_concurrency):
+        try:
+            await self.db.execute(
+                """
+                UPDATE `applications`
+                SET `deployment_concurrency`=%s
+                WHERE `application_name`=%s AND `gamespace_id`=%s;
+                """, deployment_concurrency, app_id, gamespace_id)
+        except DatabaseError as e:
+            raise ApplicationError("Failed to update deployment concurrency: " + e.args[1])
+
 
 class NoSuchVersionError(Exception):
     pass
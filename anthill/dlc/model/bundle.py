@@ -1,13 +1,28 @@
 
 import os
+import base64
 import hashlib
 
-from anthill.common import random_string
-from anthill.common.model import Model
+from expiringdict import ExpiringDict
+
+from tornado.ioloop import IOLoop
+from tornado.locks import Condition, Semaphore
+
+from anthill.common import random_string, run_on_executor
 from anthill.common.database import DatabaseError, DuplicateError, format_conditions_json
 from anthill.common.options import options
 
+from . indexes import IndexedModel
+from . chunks import ChunkError
+from . storage import storage_path, AREA_BLOBS
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+
+import asyncio
+import logging
 import ujson
+import zipfile
 
 
 class BundleError(Exception):
@@ -52,6 +67,20 @@ class NoSuchBundleError(Exception):
 
 
 class BundleQuery(object):
+    """
+    Bundles are paged by `bundle_id` (newest first): a page ends with an opaque cursor that
+    should be passed as `cursor` to get the next one, so deep pages are as fast as the first one.
+    """
+
+    # counting is expensive on large tables, so the counts are approximate (cached for a while)
+    COUNT_CACHE = ExpiringDict(max_len=1024, max_age_seconds=60)
+
+    # everything but the filters and the payload (JSON, often the biggest part of a row)
+    LEAN_COLUMNS = ["bundle_id", "bundle_name", "bundle_key", "bundle_hash", "bundle_url", "bundle_status",
+                    "bundle_size"]
+
+    STREAM_BATCH_SIZE = 500
+
     def __init__(self, gamespace_id, db):
         self.gamespace_id = gamespace_id
         self.db = db
@@ -62,10 +91,28 @@ class BundleQuery(object):
         self.hash = None
         self.name = None
 
-        self.offset = 0
+        self.cursor = None
         self.limit = 0
 
+        # if set, the bundles have no filters and payload
+        self.lean = False
+
+    @staticmethod
+    def encode_cursor(bundle_id):
+        return base64.urlsafe_b64encode(str(bundle_id).encode("ascii")).decode("ascii")
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            return int(base64.urlsafe_b64decode(str(cursor).encode("ascii")).decode("ascii"))
+        except (ValueError, TypeError):
+            raise BundleQueryError("Corrupted cursor")
+
     def __values__(self):
+        tables = [
+            "`bundles`"
+        ]
+
         conditions = [
             "`bundles`.`gamespace_id`=%s"
         ]
@@ -75,6 +122,7 @@ class BundleQuery(object):
         ]
 
         if self.data_id:
+            tables.append("`data_bundles`")
             conditions.extend([
                 "`data_bundles`.`data_id`=%s",
                 "`data_bundles`.`bundle_id`=`bundles`.`bundle_id`",
@@ -96,31 +144,62 @@ class BundleQuery(object):
 
         if self.filters:
             for condition, values in format_conditions_json('bundle_filters', self.filters):
-                conditions.append(condition)
+                conditions.append("(" + condition + ")")
                 data.extend(values)
 
-        return conditions, data
+        return tables, conditions, data
 
-    async def query(self, one=False, count=False):
-        conditions, data = self.__values__()
+    async def count(self):
+        tables, conditions, data = self.__values__()
 
         query = """
-            SELECT {0} * FROM `bundles`, `data_bundles`
-            WHERE {1}
-        """.format(
-            "SQL_CALC_FOUND_ROWS" if count else "",
-            " AND ".join(conditions))
+            SELECT COUNT(*) AS `count` FROM {0}
+            WHERE {1};
+        """.format(", ".join(tables), " AND ".join(conditions))
 
-        query += """
+        key = (query, tuple(data))
+        result = BundleQuery.COUNT_CACHE.get(key)
+
+        if result is not None:
+            return result
+
+        try:
+            result = await self.db.get(query, *data)
+        except DatabaseError as e:
+            raise BundleQueryError("Failed to count bundles: " + e.args[1])
+
+        result = result["count"]
+        BundleQuery.COUNT_CACHE[key] = result
+        return result
+
+    @staticmethod
+    def columns(lean):
+        if lean:
+            return ", ".join("`bundles`.`{0}`".format(column) for column in BundleQuery.LEAN_COLUMNS)
+        return "`bundles`.*"
+
+    async def query(self, one=False, count=False):
+        tables, conditions, data = self.__values__()
+
+        if self.cursor:
+            conditions.append("`bundles`.`bundle_id`<%s")
+            data.append(BundleQuery.decode_cursor(self.cursor))
+
+        query = """
+            SELECT {0} FROM {1}
+            WHERE {2}
             ORDER BY `bundles`.`bundle_id` DESC
-        """
+        """.format(BundleQuery.columns(self.lean), ", ".join(tables), " AND ".join(conditions))
 
-        if self.limit:
+        if one:
             query += """
-                LIMIT %s,%s
+                LIMIT 1
+            """
+        elif self.limit:
+            query += """
+                LIMIT %s
             """
 
-            data.append(int(self.offset))
             data.append(int(self.limit))
 
         query += ";"
@@ -137,28 +216,271 @@ class BundleQuery(object):
             return BundleAdapter(result)
         else:
             try:
-                result = await self.db.query(query, *data)
+                items = list(map(BundleAdapter, await self.db.query(query, *data)))
             except DatabaseError as e:
                 raise BundleQueryError("Failed to query bundles: " + e.args[1])
 
-            count_result = 0
-
             if count:
-                count_result = await self.db.get(
-                    """
-                        SELECT FOUND_ROWS() AS count;
-                    """)
-                count_result = count_result["count"]
+                return (items, await self.count())
 
-            items = map(BundleAdapter, result)
+            return items
 
-            if count:
-                return (items, count_result)
+    async def stream(self):
+        """
+        Yields every matching bundle (newest first), reading them in pages of STREAM_BATCH_SIZE
+        (by `bundle_id`, as query_page does), so memory stays flat no matter how many bundles there are.
+        Use with `lean`, unless the filters and payload are needed.
+        """
 
-            return items
+        cursor, limit = self.cursor, self.limit
+        self.limit = BundleQuery.STREAM_BATCH_SIZE
+
+        try:
+            while True:
+                items = await self.query(one=False)
+
+                for bundle in items:
+                    yield bundle
+
+                if len(items) < self.limit:
+                    break
+
+                self.cursor = BundleQuery.encode_cursor(items[-1].bundle_id)
+        finally:
+            self.cursor, self.limit = cursor, limit
+
+    async def query_page(self, count=False):
+        """
+        Returns (items, next_cursor), or (items, next_cursor, approximate_count) if count is True.
+        The next_cursor is None on the last page.
+        """
+
+        items = await self.query(one=False)
+
+        if self.limit and len(items) >= self.limit:
+            next_cursor = BundleQuery.encode_cursor(items[-1].bundle_id)
+        else:
+            next_cursor = None
+
+        if count:
+            return (items, next_cursor, await self.count())
+
+        return (items, next_cursor)
+
+
+class UploadAbortedError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+class BundleUploadPipeline(object):
+    """
+    A queue of uploaded chunks bounded by their total size rather than by their number.
+    Once `max_size` bytes are waiting to be written, `put` blocks, so does the reading of the request body,
+    so an upload never takes more than `max_size` bytes of memory (plus one chunk) no matter how slow the disk is.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.chunks = deque()
+        self.size = 0
+        self.max_depth = 0
+        self.stall_time = 0.0
+        self.stalls = 0
+        self.error = None
+        self.finished = False
+        self.changed = Condition()
+
+    async def put(self, chunk):
+        if self.size and self.size + len(chunk) > self.max_size:
+            started = IOLoop.current().time()
+            self.stalls += 1
+
+            while self.error is None and self.size and self.size + len(chunk) > self.max_size:
+                await self.changed.wait()
+
+            self.stall_time += IOLoop.current().time() - started
+
+        if self.error is not None:
+            raise UploadAbortedError(self.error)
+
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+        self.max_depth = max(self.max_depth, self.size)
+        self.changed.notify_all()
+
+    def finish(self):
+        self.finished = True
+        self.changed.notify_all()
+
+    def abort(self, error):
+        self.error = error
+        self.changed.notify_all()
+
+    async def get(self):
+        """
+        Returns the next chunk, or None once all of them were consumed
+        """
+        while not self.chunks:
+            if self.error is not None:
+                raise UploadAbortedError(self.error)
+            if self.finished:
+                return None
+            await self.changed.wait()
+
+        chunk = self.chunks.popleft()
+        self.size -= len(chunk)
+        self.changed.notify_all()
+        return chunk
+
+    async def produce(self, write):
+        while True:
+            chunk = await self.get()
+            if chunk is None:
+                return
+            await write(chunk)
 
 
-class BundlesModel(Model):
+def remove_files(paths):
+    """
+    Runs on the executor: removes the files, returns the number of files actually removed
+    """
+    removed = 0
+
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.warning("Failed to remove '{0}': {1}".format(path, str(e)))
+        else:
+            removed += 1
+
+    return removed
+
+
+class FileReclaimer(object):
+    """
+    Removes the files of deleted bundles in the background, in batches on the executor,
+    so neither the IOLoop nor the request deleting them waits for the disk
+    """
+
+    BATCH_SIZE = 256
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.queue = deque()
+        self.running = False
+        self.reclaimed = 0
+
+    def reclaim(self, paths):
+        self.queue.extend(paths)
+
+        if self.queue and not self.running:
+            self.running = True
+            IOLoop.current().spawn_callback(self.__reclaim__)
+
+    async def __reclaim__(self):
+        try:
+            while self.queue:
+                batch = [self.queue.popleft() for i in range(0, min(len(self.queue), FileReclaimer.BATCH_SIZE))]
+                self.reclaimed += await IOLoop.current().run_in_executor(self.executor, remove_files, batch)
+        except Exception:
+            logging.exception("Failed to reclaim files")
+        finally:
+            self.running = False
+
+
+class BundleFileWriter(object):
+    """
+    Writes (and hashes) a bundle file on the executor, so the IOLoop never waits for the disk.
+    Incoming data is buffered up to `buffer_size` bytes while the previous write is still in progress,
+    at most one write is in progress at a time, so the file is written (and hashed) in order.
+    """
+
+    def __init__(self, executor, path, hash_method, buffer_size):
+        self.executor = executor
+        self.path = path
+        self.hash = hash_method()
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffered = 0
+        self.size = 0
+        self.pending = None
+        self.output_file = None
+
+    @run_on_executor
+    def __open__(self):
+        directory = os.path.dirname(self.path)
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        self.output_file = open(self.path, "wb")
+
+    @run_on_executor
+    def __write__(self, data):
+        self.output_file.write(data)
+        self.hash.update(data)
+
+    @run_on_executor
+    def __close__(self, remove=False):
+        if self.output_file is not None:
+            self.output_file.close()
+            self.output_file = None
+
+        if remove:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    async def open(self):
+        await self.__open__()
+
+    async def __wait__(self):
+        pending, self.pending = self.pending, None
+        if pending is not None:
+            await pending
+
+    async def flush(self):
+        await self.__wait__()
+
+        if self.buffer:
+            data = b"".join(self.buffer)
+            self.buffer = []
+            self.buffered = 0
+            self.pending = self.__write__(data)
+
+    async def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.size += len(data)
+
+        if self.buffered >= self.buffer_size:
+            await self.flush()
+
+    async def close(self):
+        """
+        Writes down the rest of the data, returns the hash of the file
+        """
+        await self.flush()
+        await self.__wait__()
+        await self.__close__()
+        return self.hash.hexdigest()
+
+    async def abort(self):
+        try:
+            await self.__wait__()
+        except OSError:
+            pass
+        # run_on_executor passes positional arguments only
+        await self.__close__(True)
+
+
+class BundlesModel(IndexedModel):
 
     STATUS_CREATED = "CREATED"
     STATUS_UPLOADED = "UPLOADED"
@@ -168,9 +490,21 @@ class BundlesModel(Model):
 
     HASH_METHOD = hashlib.sha256
 
-    def __init__(self, db):
+    INSERT_BATCH = 500
+    IMPORT_MANIFEST = "bundles.json"
+    IMPORT_BLOCK_SIZE = 1048576
+
+    BLOB_LOCK = "dlc:blob:{0}"
+    BLOB_LOCK_TIMEOUT = 60
+
+    def __init__(self, db, chunks):
         self.db = db
+        self.chunks = chunks
         self.data_location = options.data_location
+        self.content_addressed = options.content_addressed_storage
+        self.executor = ThreadPoolExecutor(max_workers=options.upload_io_threads)
+        self.write_buffer_size = options.upload_write_buffer_size
+        self.reclaimer = FileReclaimer(self.executor)
 
     def get_setup_db(self):
         return self.db
@@ -178,6 +512,12 @@ class BundlesModel(Model):
     def get_setup_tables(self):
         return ["bundles", "data_bundles"]
 
+    def get_setup_indexes(self):
+        return [("bundles", "bundles_lookup_idx"), ("bundles", "bundles_hash_idx")]
+
+    def get_setup_columns(self):
+        return [("bundles", "bundle_detached_at")]
+
     async def delete_bundle(self, gamespace_id, app_id, bundle_id):
 
         bundle = await self.get_bundle(gamespace_id, bundle_id)
@@ -200,12 +540,71 @@ class BundlesModel(Model):
         except DatabaseError as e:
             raise BundleError("Failed to delete bundle: " + e.args[1])
 
-        bundle_file = os.path.join(self.data_location, str(app_id), bundle.get_directory(), bundle.get_key())
+        self.reclaimer.reclaim([self.upload_path(app_id, bundle)])
 
-        try:
-            os.remove(bundle_file)
-        except OSError:
-            pass
+        if bundle.hash:
+            # other bundles may share the same content
+            self.reclaim_blobs([bundle.hash])
+
+    async def delete_data_bundles(self, db, gamespace_id, app_id, data_id):
+        """
+        Detaches every bundle from the data version and deletes the ones not delivered (and not shared with
+        other data versions) with a few set-based statements. Runs on the connection `db`, so it could be a part
+        of a bigger transaction, the caller commits.
+
+        Returns a list of files to reclaim (see FileReclaimer) and a list of blobs to reclaim (see reclaim_blobs)
+        once committed.
+        """
+
+        bundles = await db.query(
+            """
+            SELECT `bundle_id`, `bundle_name`, `bundle_key`, `bundle_hash`, `bundle_url`, `bundle_status`, `bundle_size`
+            FROM `bundles`
+            WHERE `gamespace_id`=%s AND `bundle_status`<>%s AND `bundle_id` IN (
+                SELECT `bundle_id` FROM `data_bundles` WHERE `data_id`=%s)
+              AND `bundle_id` NOT IN (
+                SELECT `bundle_id` FROM `data_bundles` WHERE `data_id`<>%s)
+            FOR UPDATE;
+            """, gamespace_id, BundlesModel.STATUS_DELIVERED, data_id, data_id)
+
+        # the delivered ones are kept, but attached to nothing from now on (see GarbageCollectorModel)
+        await db.execute(
+            """
+            UPDATE `bundles`
+            SET `bundle_detached_at`=NOW()
+            WHERE `gamespace_id`=%s AND `bundle_id` IN (
+                SELECT `bundle_id` FROM `data_bundles` WHERE `data_id`=%s)
+              AND `bundle_id` NOT IN (
+                SELECT `bundle_id` FROM `data_bundles` WHERE `data_id`<>%s);
+            """, gamespace_id, data_id, data_id)
+
+        await db.execute(
+            """
+            DELETE FROM `data_bundles`
+            WHERE `data_id`=%s AND `gamespace_id`=%s;
+            """, data_id, gamespace_id)
+
+        if not bundles:
+            return []
+
+        bundle_ids = [bundle["bundle_id"] for bundle in bundles]
+
+        for i in range(0, len(bundle_ids), BundlesModel.INSERT_BATCH):
+            batch = bundle_ids[i:i + BundlesModel.INSERT_BATCH]
+
+            # chunks, patches and uploads of the bundles are deleted along (ON DELETE CASCADE)
+            await db.execute(
+                """
+                DELETE FROM `bundles`
+                WHERE `gamespace_id`=%s AND `bundle_id` IN ({0});
+                """.format(", ".join(["%s"] * len(batch))), gamespace_id, *batch)
+
+        bundles = list(map(BundleAdapter, bundles))
+        files = [self.upload_path(app_id, bundle) for bundle in bundles]
+
+        hashes = list(set(bundle.hash for bundle in bundles if bundle.hash))
+
+        return files, hashes
 
     async def find_bundle(self, gamespace_id, data_id, bundle_name):
         try:
@@ -249,19 +648,160 @@ class BundlesModel(Model):
 
         return BundleAdapter(bundle)
 
+    async def find_delivered_bundles(self, gamespace_id, pairs):
+        """
+        Looks up many delivered bundles by (bundle_name, bundle_hash) pairs at once
+        """
+
+        if not pairs:
+            return []
+
+        data = [gamespace_id, BundlesModel.STATUS_DELIVERED]
+
+        for bundle_name, bundle_hash in pairs:
+            data.append(str(bundle_name))
+            data.append(str(bundle_hash))
+
+        try:
+            bundles = await self.db.query(
+                """
+                SELECT *
+                FROM `bundles`
+                WHERE `gamespace_id`=%s AND `bundle_status`=%s AND (`bundle_name`, `bundle_hash`) IN ({0});
+                """.format(", ".join(["(%s, %s)"] * len(pairs))), *data)
+        except DatabaseError as e:
+            raise BundleError("Failed to find bundles: " + e.args[1])
+
+        return list(map(BundleAdapter, bundles))
+
+    async def find_deployed_urls(self, gamespace_id, app_id, bundle_hashes):
+        """
+        Returns a dict of urls of bundles of the application already delivered with the same content,
+        keyed by the content hash
+        """
+
+        bundle_hashes = list(set(bundle_hash for bundle_hash in bundle_hashes if bundle_hash))
+
+        if not bundle_hashes:
+            return {}
+
+        try:
+            bundles = await self.db.query(
+                """
+                SELECT `bundles`.`bundle_hash`, `bundles`.`bundle_url`
+                FROM `bundles`, `data_bundles`, `datas`
+                WHERE `bundles`.`gamespace_id`=%s AND `bundles`.`bundle_status`=%s
+                    AND `bundles`.`bundle_url` IS NOT NULL AND `bundles`.`bundle_hash` IN ({0})
+                    AND `data_bundles`.`bundle_id`=`bundles`.`bundle_id`
+                    AND `datas`.`data_id`=`data_bundles`.`data_id` AND `datas`.`application_name`=%s;
+                """.format(", ".join(["%s"] * len(bundle_hashes))),
+                gamespace_id, BundlesModel.STATUS_DELIVERED, *bundle_hashes, app_id)
+        except DatabaseError as e:
+            raise BundleError("Failed to find deployed bundles: " + e.args[1])
+
+        return {
+            bundle["bundle_hash"]: bundle["bundle_url"]
+            for bundle in bundles
+        }
+
+    def reclaim_blobs(self, bundle_hashes):
+        """
+        Removes the blobs of the content nothing refers to anymore, in the background
+        """
+        if bundle_hashes:
+            IOLoop.current().spawn_callback(self.__reclaim_blobs__, list(bundle_hashes))
+
+    async def __reclaim_blobs__(self, bundle_hashes):
+        for bundle_hash in bundle_hashes:
+            try:
+                await self.reclaim_blob(bundle_hash)
+            except BundleError as e:
+                logging.warning(e.message)
+            except Exception:
+                logging.exception("Failed to reclaim blob {0}".format(bundle_hash))
+
+    async def reclaim_blob(self, bundle_hash):
+        """
+        Removes the blob if no bundle refers to it. Checked under the lock of the blob (see __store_blob__),
+        so the content cannot be claimed by a new upload in between. Returns True if removed.
+        """
+
+        try:
+            async with self.db.acquire() as db:
+                await self.__lock_blob__(db, bundle_hash)
+
+                try:
+                    referenced = await db.get(
+                        """
+                        SELECT `bundle_id`
+                        FROM `bundles`
+                        WHERE `bundle_hash`=%s
+                        LIMIT 1;
+                        """, bundle_hash)
+
+                    if referenced:
+                        return False
+
+                    removed = await IOLoop.current().run_in_executor(
+                        self.executor, remove_files, [self.blob_path(bundle_hash)])
+                finally:
+                    await self.__unlock_blob__(db, bundle_hash)
+        except DatabaseError as e:
+            raise BundleError("Failed to reclaim blob {0}: {1}".format(bundle_hash, e.args[1]))
+
+        return removed > 0
+
+    async def __lock_blob__(self, db, bundle_hash):
+        """
+        Takes a named lock of the blob on the connection, shared by every node using the same database
+        """
+        locked = await db.get(
+            """
+            SELECT GET_LOCK(%s, %s) AS `locked`;
+            """, BundlesModel.BLOB_LOCK.format(bundle_hash), BundlesModel.BLOB_LOCK_TIMEOUT)
+
+        if not locked or locked["locked"] != 1:
+            raise BundleError("Failed to lock blob " + bundle_hash)
+
+    async def __unlock_blob__(self, db, bundle_hash):
+        await db.get(
+            """
+            SELECT RELEASE_LOCK(%s) AS `released`;
+            """, BundlesModel.BLOB_LOCK.format(bundle_hash))
+
+    async def list_bundle_data_versions(self, gamespace_id, bundle_id):
+        """
+        Returns ids of the data versions the bundle is attached to
+        """
+        try:
+            rows = await self.db.query(
+                """
+                SELECT `data_id`
+                FROM `data_bundles`
+                WHERE `gamespace_id`=%s AND `bundle_id`=%s;
+                """, gamespace_id, bundle_id)
+        except DatabaseError as e:
+            raise BundleError("Failed to list data versions of the bundle: " + e.args[1])
+
+        return [row["data_id"] for row in rows]
+
     def bundles_query(self, gamespace_id):
         return BundleQuery(gamespace_id, self.db)
 
-    async def list_bundles(self, gamespace_id, data_id):
+    async def list_bundles(self, gamespace_id, data_id, lean=False):
+        """
+        Lists every bundle of the data version (newest first). Lean bundles have no filters and payload.
+        """
+
         try:
             bundles = await self.db.query(
                 """
-                SELECT *
+                SELECT {0}
                 FROM `bundles`, `data_bundles`
                 WHERE `bundles`.`gamespace_id`=%s AND `data_bundles`.`bundle_id`=`bundles`.`bundle_id`
                     AND `data_bundles`.`data_id`=%s
                 ORDER BY `bundles`.`bundle_id` DESC;
-                """, gamespace_id, data_id)
+                """.format(BundleQuery.columns(lean)), gamespace_id, data_id)
         except DatabaseError as e:
             raise BundleError("Failed to list bundles: " + e.args[1])
 
@@ -274,6 +814,15 @@ class BundlesModel(Model):
                     DELETE FROM `data_bundles`
                     WHERE `gamespace_id`=%s AND `bundle_id`=%s AND `data_id`=%s;
                 """, gamespace_id, bundle_id, data_id)
+
+            # the grace period of the garbage collector starts once the bundle is attached to nothing
+            await self.db.execute(
+                """
+                    UPDATE `bundles`
+                    SET `bundle_detached_at`=NOW()
+                    WHERE `gamespace_id`=%s AND `bundle_id`=%s AND `bundle_id` NOT IN (
+                        SELECT `bundle_id` FROM `data_bundles`);
+                """, gamespace_id, bundle_id)
         except DatabaseError:
             raise BundleError("Failed to detach bundle from data")
 
@@ -295,6 +844,13 @@ class BundlesModel(Model):
                     (`gamespace_id`, `bundle_id`, `data_id`)
                     VALUES (%s, %s, %s);
                 """, gamespace_id, bundle_id, data_id)
+
+            await self.db.execute(
+                """
+                    UPDATE `bundles`
+                    SET `bundle_detached_at`=NULL
+                    WHERE `gamespace_id`=%s AND `bundle_id`=%s;
+                """, gamespace_id, bundle_id)
         except DuplicateError:
             raise BundleError("Bundle already attached")
         except DatabaseError:
@@ -331,6 +887,205 @@ class BundlesModel(Model):
 
         return bundle_id
 
+    async def import_bundles(self, gamespace_id, data_id, bundles):
+        """
+        Creates many bundles at once and attaches them to the data version, in a single transaction.
+        Either every bundle gets created, or none of them.
+
+        :param bundles: a list of (bundle_name, bundle_filters, bundle_payload) tuples
+        :return: a list of created bundles (as BundleAdapter), in the same order
+        """
+
+        if not bundles:
+            return []
+
+        names = []
+        seen = set()
+        duplicates = set()
+
+        for bundle_name, bundle_filters, bundle_payload in bundles:
+            if not bundle_name:
+                raise BundleError("Bundle name should not be empty")
+            if not isinstance(bundle_filters, dict):
+                raise BundleError("bundle_filters of bundle '{0}' should be a dict".format(bundle_name))
+            if not isinstance(bundle_payload, dict):
+                raise BundleError("bundle_payload of bundle '{0}' should be a dict".format(bundle_name))
+            if bundle_name in seen:
+                duplicates.add(bundle_name)
+            seen.add(bundle_name)
+            names.append(bundle_name)
+
+        if duplicates:
+            raise BundleError("Duplicate bundle names: " + ", ".join(sorted(duplicates)))
+
+        keys = [random_string(32) for bundle in bundles]
+        created = {}
+
+        try:
+            async with self.db.acquire(auto_commit=False) as db:
+                # the connection goes back to the pool as it is, and the next acquire would commit it
+                try:
+                    await self.__import_bundles__(db, gamespace_id, data_id, bundles, names, keys, created)
+                    await db.commit()
+                except BaseException:
+                    await db.rollback()
+                    raise
+        except DatabaseError as e:
+            raise BundleError("Failed to import bundles: " + e.args[1])
+
+        return [created[bundle_key] for bundle_key in keys]
+
+    async def __import_bundles__(self, db, gamespace_id, data_id, bundles, names, keys, created):
+        # imports into the same data version wait for each other here, so none of them misses the names
+        # another one has just inserted
+        data = await db.get(
+            """
+            SELECT `data_id`
+            FROM `datas`
+            WHERE `data_id`=%s AND `gamespace_id`=%s
+            FOR UPDATE;
+            """, data_id, gamespace_id)
+
+        if not data:
+            raise BundleError("No such data version")
+
+        existing = await db.query(
+            """
+            SELECT `bundles`.`bundle_name`
+            FROM `bundles`, `data_bundles`
+            WHERE `bundles`.`gamespace_id`=%s AND `data_bundles`.`data_id`=%s
+                AND `data_bundles`.`bundle_id`=`bundles`.`bundle_id` AND `bundles`.`bundle_name` IN ({0});
+            """.format(", ".join(["%s"] * len(names))), gamespace_id, data_id, *names)
+
+        if existing:
+            raise BundleError("Bundles with such names already exist: " + ", ".join(
+                sorted(bundle["bundle_name"] for bundle in existing)))
+
+        for i in range(0, len(bundles), BundlesModel.INSERT_BATCH):
+            batch = bundles[i:i + BundlesModel.INSERT_BATCH]
+            batch_keys = keys[i:i + BundlesModel.INSERT_BATCH]
+            data = []
+
+            for (bundle_name, bundle_filters, bundle_payload), bundle_key in zip(batch, batch_keys):
+                data.extend([gamespace_id, bundle_name, BundlesModel.STATUS_CREATED,
+                             ujson.dumps(bundle_filters), ujson.dumps(bundle_payload), bundle_key])
+
+            # the id of the first row of the batch, the rest are not guaranteed to be consecutive
+            first_id = await db.insert(
+                """
+                INSERT INTO `bundles`
+                (`gamespace_id`, `bundle_name`, `bundle_status`,
+                    `bundle_filters`, `bundle_payload`, `bundle_key`)
+                VALUES {0};
+                """.format(", ".join(["(%s, %s, %s, %s, %s, %s)"] * len(batch))), *data)
+
+            rows = await db.query(
+                """
+                SELECT *
+                FROM `bundles`
+                WHERE `bundle_id`>=%s AND `gamespace_id`=%s AND `bundle_key` IN ({0});
+                """.format(", ".join(["%s"] * len(batch_keys))), first_id, gamespace_id, *batch_keys)
+
+            for row in rows:
+                created[row["bundle_key"]] = BundleAdapter(row)
+
+            data = []
+
+            for row in rows:
+                data.extend([gamespace_id, row["bundle_id"], data_id])
+
+            await db.execute(
+                """
+                INSERT INTO `data_bundles`
+                (`gamespace_id`, `bundle_id`, `data_id`)
+                VALUES {0};
+                """.format(", ".join(["(%s, %s, %s)"] * len(rows))), *data)
+
+    async def import_archive(self, gamespace_id, app_id, data_id, archive_path, concurrency):
+        """
+        Imports every file of a zip archive as a bundle (named after the file) and uploads its contents,
+        `concurrency` files at the same time.
+
+        Filters and payloads could be passed in an optional bundles.json file in the root of the archive,
+        as {"<bundle name>": {"filters": {...}, "payload": {...}}}
+        """
+
+        try:
+            archive = await self.__open_archive__(archive_path)
+        except (OSError, zipfile.BadZipFile) as e:
+            raise BundleError("Failed to open archive: " + str(e))
+
+        try:
+            members = [
+                member.filename for member in archive.infolist()
+                if not member.filename.endswith("/") and member.filename != BundlesModel.IMPORT_MANIFEST
+            ]
+
+            if BundlesModel.IMPORT_MANIFEST in archive.namelist():
+                try:
+                    manifest = ujson.loads(await self.__read_member__(archive, BundlesModel.IMPORT_MANIFEST))
+                except (OSError, ValueError) as e:
+                    raise BundleError("Corrupted {0}: {1}".format(BundlesModel.IMPORT_MANIFEST, str(e)))
+
+                if not isinstance(manifest, dict):
+                    raise BundleError("{0} should be a dict".format(BundlesModel.IMPORT_MANIFEST))
+            else:
+                manifest = {}
+
+            properties = []
+
+            for name in members:
+                entry = manifest.get(name) or {}
+                if not isinstance(entry, dict):
+                    raise BundleError("{0}: entry '{1}' should be a dict".format(BundlesModel.IMPORT_MANIFEST, name))
+                properties.append((name, entry.get("filters", {}), entry.get("payload", {})))
+
+            bundles = await self.import_bundles(gamespace_id, data_id, properties)
+
+            semaphore = Semaphore(max(1, concurrency))
+
+            async def upload(member, bundle):
+                async with semaphore:
+                    await self.upload_bundle(
+                        gamespace_id, app_id, bundle,
+                        lambda write: self.__stream_member__(archive, member, write))
+
+            # a failed file does not stop the others, the archive is closed once every upload is over
+            results = await asyncio.gather(
+                *[upload(member, bundle) for member, bundle in zip(members, bundles)], return_exceptions=True)
+
+            for result in results:
+                if isinstance(result, BundleError):
+                    raise result
+                if isinstance(result, Exception):
+                    raise BundleError("Failed to upload bundle: " + str(result))
+        finally:
+            archive.close()
+
+        return bundles
+
+    @run_on_executor
+    def __open_archive__(self, archive_path):
+        return zipfile.ZipFile(archive_path, "r")
+
+    @run_on_executor
+    def __read_member__(self, archive, member):
+        return archive.read(member)
+
+    async def __stream_member__(self, archive, member, write):
+        # members of the same archive could be read concurrently, each one has its own file handle
+        source = await IOLoop.current().run_in_executor(self.executor, archive.open, member)
+
+        try:
+            while True:
+                block = await IOLoop.current().run_in_executor(
+                    self.executor, source.read, BundlesModel.IMPORT_BLOCK_SIZE)
+                if not block:
+                    break
+                await write(block)
+        finally:
+            source.close()
+
     async def update_bundle_properties(self, gamespace_id, bundle_id, bundle_filters, bundle_payload):
 
         if not isinstance(bundle_filters, dict):
@@ -382,7 +1137,80 @@ class BundlesModel(Model):
         except DatabaseError as e:
             raise BundleError("Failed to update bundle status: " + e.args[1])
 
+    async def update_bundles_status(self, gamespace_id, bundle_ids, bundle_status):
+
+        if not bundle_ids:
+            return
+
+        try:
+            await self.db.execute(
+                """
+                UPDATE `bundles`
+                SET `bundle_status`=%s
+                WHERE `gamespace_id`=%s AND `bundle_id` IN ({0});
+                """.format(", ".join(["%s"] * len(bundle_ids))), bundle_status, gamespace_id, *bundle_ids)
+        except DatabaseError as e:
+            raise BundleError("Failed to update bundles status: " + e.args[1])
+
+    async def update_bundles_urls(self, gamespace_id, bundle_status, bundle_urls):
+        """
+        Same as update_bundle_url, but for many bundles at once
+        :param bundle_urls: a dict of bundle_id -> bundle_url
+        """
+
+        if not bundle_urls:
+            return
+
+        data = [bundle_status]
+
+        for bundle_id, bundle_url in bundle_urls.items():
+            data.append(bundle_id)
+            data.append(bundle_url)
+
+        data.append(gamespace_id)
+        data.extend(bundle_urls.keys())
+
+        try:
+            await self.db.execute(
+                """
+                UPDATE `bundles`
+                SET `bundle_status`=%s, `bundle_url`=CASE `bundle_id` {0} END
+                WHERE `gamespace_id`=%s AND `bundle_id` IN ({1});
+                """.format(
+                    " ".join(["WHEN %s THEN %s"] * len(bundle_urls)),
+                    ", ".join(["%s"] * len(bundle_urls))), *data)
+        except DatabaseError as e:
+            raise BundleError("Failed to update bundles status: " + e.args[1])
+
+    def blob_path(self, bundle_hash):
+        """
+        Location of a bundle content in the content addressed storage, shared by every application
+        """
+        if not bundle_hash:
+            return None
+        return os.path.join(storage_path(self.data_location, AREA_BLOBS), bundle_hash[:2], bundle_hash)
+
+    def __resolve_path__(self, app_id, bundle):
+        """
+        The blob of the bundle content, if there is one (regardless of content_addressed_storage, it could have been
+        enabled before), the own file of the bundle otherwise
+        """
+        if bundle.hash:
+            blob_file = self.blob_path(bundle.hash)
+            if os.path.isfile(blob_file):
+                return blob_file
+
+        return self.upload_path(app_id, bundle)
+
+    @run_on_executor
     def bundle_path(self, app_id, bundle):
+        return self.__resolve_path__(app_id, bundle)
+
+    @run_on_executor
+    def bundle_paths(self, app_id, bundles):
+        return [self.__resolve_path__(app_id, bundle) for bundle in bundles]
+
+    def upload_path(self, app_id, bundle):
         return os.path.join(self.data_location, str(app_id), bundle.get_directory(), bundle.get_key())
 
     def bundle_directory(self, app_id, bundle):
@@ -392,27 +1220,82 @@ class BundlesModel(Model):
 
         bundle_id = bundle.bundle_id
 
-        if not os.path.exists(self.bundle_directory(app_id, bundle)):
-            os.makedirs(self.bundle_directory(app_id, bundle))
+        # a bundle being re-uploaded may already point to a shared blob, never write into that
+        writer = BundleFileWriter(
+            self.executor, self.upload_path(app_id, bundle),
+            BundlesModel.HASH_METHOD, self.write_buffer_size)
+
+        await writer.open()
 
-        bundle_file = self.bundle_path(app_id, bundle)
+        try:
+            await producer(writer.write)
+            bundle_hash = await writer.close()
+        except BaseException:
+            await writer.abort()
+            raise
 
-        _h = BundlesModel.HASH_METHOD()
-        output_file = open(bundle_file, 'wb')
+        await self.complete_upload(gamespace_id, app_id, bundle_id, writer.path, bundle_hash, writer.size)
 
-        class Size:
-            bundle_size = 0
+    async def complete_upload(self, gamespace_id, app_id, bundle_id, bundle_file, bundle_hash, bundle_size):
+        """
+        Stores a just uploaded bundle file (see upload_path) and marks the bundle as uploaded
+        """
 
-        async def write(data):
-            output_file.write(data)
-            _h.update(data)
-            Size.bundle_size += len(data)
+        if self.content_addressed:
+            bundle_file = await self.__store_blob__(gamespace_id, bundle_id, bundle_file, bundle_hash)
 
-        await producer(write)
+        await self.update_bundle(
+            gamespace_id, bundle_id, bundle_hash, BundlesModel.STATUS_UPLOADED, bundle_size)
 
-        output_file.close()
+        try:
+            await self.chunks.schedule(gamespace_id, app_id, bundle_id, bundle_file, bundle_hash)
+        except ChunkError as e:
+            raise BundleError(e.message)
 
-        bundle_hash = _h.hexdigest()
+    async def __store_blob__(self, gamespace_id, bundle_id, bundle_file, bundle_hash):
+        """
+        Under the lock of the blob (see reclaim_blob), the bundle refers to the content first, and only then
+        the file is moved (or dropped, if the content is there already), so the blob could never be
+        reclaimed in between
+        """
 
-        await self.update_bundle(
-            gamespace_id, bundle_id, bundle_hash, BundlesModel.STATUS_UPLOADED, Size.bundle_size)
+        try:
+            async with self.db.acquire() as db:
+                await self.__lock_blob__(db, bundle_hash)
+
+                try:
+                    await db.execute(
+                        """
+                        UPDATE `bundles`
+                        SET `bundle_hash`=%s
+                        WHERE `bundle_id`=%s AND `gamespace_id`=%s;
+                        """, bundle_hash, bundle_id, gamespace_id)
+
+                    return await self.store_blob(bundle_file, bundle_hash)
+                finally:
+                    await self.__unlock_blob__(db, bundle_hash)
+        except DatabaseError as e:
+            raise BundleError("Failed to store bundle: " + e.args[1])
+        except OSError as e:
+            raise BundleError("Failed to store bundle: " + str(e))
+
+    @run_on_executor
+    def store_blob(self, bundle_file, bundle_hash):
+        """
+        Moves an uploaded file into the content addressed storage, or drops it if the same content is there already.
+        Returns the location of the blob.
+        """
+        blob_file = self.blob_path(bundle_hash)
+
+        if os.path.isfile(blob_file):
+            os.remove(bundle_file)
+            return blob_file
+
+        blob_directory = os.path.dirname(blob_file)
+
+        if not os.path.exists(blob_directory):
+            os.makedirs(blob_directory, exist_ok=True)
+
+        # atomic, so a concurrent upload of the same content would simply replace it with the same bytes
+        os.replace(bundle_file, blob_file)
+        return blob_file
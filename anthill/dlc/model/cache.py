@@ -0,0 +1,301 @@
+
+from tornado.ioloop import IOLoop
+from expiringdict import ExpiringDict
+from aioredis import RedisError
+from concurrent.futures import ThreadPoolExecutor
+
+import gzip
+import hashlib
+import logging
+import ujson
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class ManifestEntry(object):
+    """
+    A manifest, serialized and compressed (gzip, and brotli if the module is installed) only once,
+    when the entry is built. The compressed bodies are stored in the shared cache next to the plain one.
+    """
+
+    COMPRESS_MIN_SIZE = 512
+
+    def __init__(self, data_id, etag, body, encodings=None):
+        self.data_id = data_id
+        self.etag = etag
+        self.body = body
+        self.encodings = encodings or {}
+
+    @staticmethod
+    def dump(data_id, manifest):
+        """
+        Runs on the executor. The (strong) ETag is a hash of the body itself, so anything that changes
+        the body (a payload, an url, a new patch) changes the ETag as well
+        """
+        body = ujson.dumps(manifest, escape_forward_slashes=False)
+        data = body.encode("utf-8")
+        etag = hashlib.sha1(data).hexdigest()
+        encodings = {}
+
+        if len(data) >= ManifestEntry.COMPRESS_MIN_SIZE:
+            if brotli is not None:
+                encodings["br"] = brotli.compress(data, mode=brotli.MODE_TEXT, quality=9)
+
+            encodings["gzip"] = gzip.compress(data, compresslevel=9)
+
+        return ManifestEntry(data_id, etag, body, encodings)
+
+    def dumps(self):
+        """
+        A header line (json) followed by the plain body and the compressed ones, as they are
+        """
+        body = self.body.encode("utf-8")
+        encodings = sorted(self.encodings.items())
+
+        header = ujson.dumps({
+            "data_id": self.data_id,
+            "etag": self.etag,
+            "sizes": [len(body)] + [len(data) for encoding, data in encodings],
+            "encodings": [encoding for encoding, data in encodings]
+        })
+
+        return b"".join([header.encode("utf-8"), b"\n", body] + [data for encoding, data in encodings])
+
+    @staticmethod
+    def loads(raw):
+        header, separator, rest = raw.partition(b"\n")
+        header = ujson.loads(header.decode("utf-8"))
+
+        parts = []
+        offset = 0
+
+        for size in header["sizes"]:
+            parts.append(rest[offset:offset + size])
+            offset += size
+
+        if not separator or offset != len(rest):
+            raise ValueError("Corrupted manifest entry")
+
+        return ManifestEntry(
+            header["data_id"], header["etag"], parts[0].decode("utf-8"),
+            dict(zip(header["encodings"], parts[1:])))
+
+
+class ManifestCache(object):
+    """
+    Two-level cache of the /data manifests, application versions and delivered bundles:
+    a bounded in-process cache in front of the shared key/value storage (redis).
+
+    Every application has a generation number (stored in the key/value storage) that is a part of the
+    keys. Once something changes what a version of the application resolves to, the generation is bumped,
+    so the old entries become unreachable on every node and simply expire. Each node re-reads the generation
+    at most once per `generation_interval` seconds.
+    """
+
+    GENERATION_KEY = "dlc:gen:{0}"
+    MANIFEST_KEY = "dlc:manifests:{0}:{1}:{2}:{3}"
+    VERSION_KEY = "dlc:version:{0}:{1}:{2}"
+    BUNDLE_KEY = "dlc:bundle:{0}:{1}:{2}:{3}"
+    BUNDLES_GENERATION = "bundles:{0}"
+
+    def __init__(self, kv, max_size=4096, ttl=300, shared_ttl=3600, generation_interval=2, compress_threads=2):
+        self.kv = kv
+        # manifests are serialized and compressed there
+        self.executor = ThreadPoolExecutor(max_workers=compress_threads)
+        self.local = ExpiringDict(max_len=max_size, max_age_seconds=ttl)
+        self.shared_ttl = shared_ttl
+        self.generation_interval = generation_interval
+        self.generations = {}
+        # applications invalidated while the key/value storage was unreachable
+        self.pending = set()
+
+    @staticmethod
+    def loads_json(raw):
+        return ujson.loads(raw.decode("utf-8"))
+
+    @staticmethod
+    def normalize_env(env):
+        return ujson.dumps(env, sort_keys=True)
+
+    async def generation(self, app_name):
+        now = IOLoop.current().time()
+        generation = self.generations.get(app_name)
+
+        if generation is not None and generation[1] > now:
+            return generation[0]
+
+        try:
+            async with self.kv.acquire() as db:
+                if app_name in self.pending:
+                    # invalidated while the storage was unreachable, the other nodes have to know
+                    value = await db.incr(ManifestCache.GENERATION_KEY.format(app_name))
+                    self.pending.discard(app_name)
+                else:
+                    value = await db.get(ManifestCache.GENERATION_KEY.format(app_name))
+        except (RedisError, OSError):
+            logging.exception("Failed to get manifest generation of app '{0}'".format(app_name))
+            # keep using the last known generation until the storage is back
+            return generation[0] if generation is not None else 0
+
+        value = int(value) if value else 0
+
+        # never go back to a generation this node has already left behind
+        if generation is not None:
+            value = max(value, generation[0])
+
+        self.generations[app_name] = (value, now + self.generation_interval)
+        return value
+
+    async def key(self, app_name, version_name, env_key):
+        """
+        The key should be taken before resolving the manifest, so if the application is invalidated
+        while the manifest is being resolved, the result would be stored under the old generation
+        """
+        generation = await self.generation(app_name)
+        env_hash = hashlib.sha1(env_key.encode("utf-8")).hexdigest()
+        return ManifestCache.MANIFEST_KEY.format(app_name, generation, version_name, env_hash)
+
+    async def version_key(self, app_name, version_name):
+        generation = await self.generation(app_name)
+        return ManifestCache.VERSION_KEY.format(app_name, generation, version_name)
+
+    async def bundle_keys(self, gamespace_id, pairs):
+        """
+        Returns a dict of keys of delivered bundles, by (bundle_name, bundle_hash). The bundles of a gamespace
+        have a generation of their own, bumped once filters or payload of any of them change.
+        """
+        generation = await self.generation(ManifestCache.BUNDLES_GENERATION.format(gamespace_id))
+
+        return {
+            (bundle_name, bundle_hash): ManifestCache.BUNDLE_KEY.format(
+                gamespace_id, generation, bundle_name, bundle_hash)
+            for bundle_name, bundle_hash in pairs
+        }
+
+    async def invalidate_bundles(self, gamespace_id):
+        await self.invalidate(ManifestCache.BUNDLES_GENERATION.format(gamespace_id))
+
+    async def __get__(self, key, loads):
+        value = self.local.get(key)
+
+        if value is not None:
+            return value
+
+        try:
+            async with self.kv.acquire() as db:
+                raw = await db.get(key)
+        except (RedisError, OSError):
+            logging.exception("Failed to get '{0}' from the cache".format(key))
+            return None
+
+        if raw is None:
+            return None
+
+        try:
+            value = loads(raw)
+        except (ValueError, KeyError):
+            # written by an older version of the service, will be replaced
+            logging.warning("Corrupted cache entry '{0}'".format(key))
+            return None
+
+        self.local[key] = value
+        return value
+
+    async def __put__(self, key, value, dumps):
+        self.local[key] = value
+
+        try:
+            async with self.kv.acquire() as db:
+                await db.setex(key, self.shared_ttl, dumps(value))
+        except (RedisError, OSError):
+            logging.exception("Failed to put '{0}' into the cache".format(key))
+
+        return value
+
+    async def get(self, key):
+        return await self.__get__(key, ManifestEntry.loads)
+
+    async def build(self, data_id, manifest):
+        """
+        Builds a ManifestEntry on the executor, the IOLoop never waits for the compression
+        """
+        return await IOLoop.current().run_in_executor(self.executor, ManifestEntry.dump, data_id, manifest)
+
+    async def put(self, key, entry):
+        return await self.__put__(key, entry, ManifestEntry.dumps)
+
+    async def get_json(self, key):
+        return await self.__get__(key, ManifestCache.loads_json)
+
+    async def put_json(self, key, value):
+        return await self.__put__(key, value, ujson.dumps)
+
+    async def get_json_many(self, keys):
+        """
+        Returns a dict of the keys found, looking up the ones missing in the process with a single request
+        """
+        result = {}
+        missing = []
+
+        for key in keys:
+            value = self.local.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                result[key] = value
+
+        if not missing:
+            return result
+
+        try:
+            async with self.kv.acquire() as db:
+                values = await db.mget(*missing)
+        except (RedisError, OSError):
+            logging.exception("Failed to get {0} keys from the cache".format(len(missing)))
+            return result
+
+        for key, raw in zip(missing, values):
+            if raw is None:
+                continue
+            try:
+                value = ManifestCache.loads_json(raw)
+            except ValueError:
+                # a miss, will be replaced
+                logging.warning("Corrupted cache entry '{0}'".format(key))
+                continue
+            self.local[key] = value
+            result[key] = value
+
+        return result
+
+    async def put_json_many(self, values):
+        for key, value in values.items():
+            self.local[key] = value
+
+        if not values:
+            return
+
+        try:
+            async with self.kv.acquire() as db:
+                pipeline = db.pipeline()
+                for key, value in values.items():
+                    pipeline.setex(key, self.shared_ttl, ujson.dumps(value))
+                await pipeline.execute()
+        except (RedisError, OSError):
+            logging.exception("Failed to put {0} keys into the cache".format(len(values)))
+
+    async def invalidate(self, app_name):
+        generation = self.generations.get(app_name, (0, 0))[0] + 1
+
+        try:
+            async with self.kv.acquire() as db:
+                generation = max(generation, await db.incr(ManifestCache.GENERATION_KEY.format(app_name)))
+            self.pending.discard(app_name)
+        except (RedisError, OSError):
+            logging.exception("Failed to invalidate manifests of app '{0}', will be retried".format(app_name))
+            self.pending.add(app_name)
+
+        self.generations[app_name] = (generation, IOLoop.current().time() + self.generation_interval)
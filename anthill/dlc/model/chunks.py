@@ -0,0 +1,427 @@
+
+from tornado.ioloop import IOLoop
+
+from anthill.common.database import DatabaseError
+from anthill.common.model import Model
+from anthill.common.options import options
+
+from . storage import storage_path, AREA_CHUNKS
+
+from concurrent.futures import ProcessPoolExecutor
+
+import asyncio
+import hashlib
+import logging
+import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class ChunkError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+# 64-bit random (but fixed, so the cut points are the same on every node) value of each byte
+GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], "little") for i in range(0, 256)]
+GEAR_LIMIT = 0xFFFFFFFFFFFFFFFF
+GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint64) if numpy is not None else None
+
+# positions hashed at once by find_cut_numpy, so a cut found early does not cost the whole max_size
+NUMPY_BLOCK = 65536
+
+
+def chunk_mask(avg_size):
+    """
+    A mask of the highest bits of the gear hash, that are all zeroes once per `avg_size` bytes on average
+    """
+    bits = max(1, avg_size.bit_length() - 1)
+    return ((1 << bits) - 1) << (64 - bits)
+
+
+def find_cut(data, min_size, max_size, mask):
+    """
+    Returns the length of the next chunk of the data, the cut points depend only on the content around them,
+    so inserting or removing data shifts the cut points along with it (a content defined chunking)
+    """
+    n = min(len(data), max_size)
+
+    if n <= min_size:
+        return n
+
+    if numpy is not None:
+        return find_cut_numpy(data, min_size, n, mask)
+
+    gear = GEAR
+    h = 0
+
+    # no cuts before min_size, no need to hash these either
+    for i in range(min_size, n):
+        h = ((h << 1) + gear[data[i]]) & GEAR_LIMIT
+        if not h & mask:
+            return i + 1
+
+    return n
+
+
+def find_cut_numpy(data, min_size, n, mask):
+    """
+    Same as find_cut (the cut points are exactly the same), but hashes a block of positions at once:
+    the hash at a position is the sum of gear[byte] << distance over the 64 bytes up to it (the rest are
+    shifted out), so the hashes of a block are summed up in 6 vectorized steps, doubling the window every time.
+    """
+    values = numpy.frombuffer(data, dtype=numpy.uint8, count=n)
+    mask = numpy.uint64(mask)
+    start = min_size
+
+    while start < n:
+        end = min(n, start + NUMPY_BLOCK)
+        # 63 bytes before the block affect the hashes in it, none before min_size does
+        context = max(min_size, start - 63)
+        h = GEAR_ARRAY[values[context:end]]
+
+        shift = 1
+        while shift < 64:
+            h[shift:] = h[shift:] + (h[:-shift] << numpy.uint64(shift))
+            shift <<= 1
+
+        cuts = numpy.flatnonzero((h[start - context:] & mask) == 0)
+
+        if len(cuts):
+            return start + int(cuts[0]) + 1
+
+        start = end
+
+    return n
+
+
+def chunk_path(location, chunk_hash):
+    return os.path.join(location, chunk_hash[:2], chunk_hash)
+
+
+def chunk_file(path, location, min_size, avg_size, max_size, max_file_size):
+    """
+    Runs in a separate process: splits a file into content defined chunks, stores every chunk
+    (unless it's stored already) by its sha256 hash. Returns an ordered list of (hash, size),
+    or None if the file is bigger than max_file_size.
+    """
+    if os.path.getsize(path) > max_file_size:
+        return None
+
+    mask = chunk_mask(avg_size)
+    chunks = []
+    buffer = bytearray()
+    eof = False
+
+    with open(path, "rb") as f:
+        while buffer or not eof:
+            if not eof and len(buffer) < max_size:
+                block = f.read(max_size)
+                if block:
+                    buffer.extend(block)
+                else:
+                    eof = True
+                continue
+
+            cut = find_cut(buffer, min_size, max_size, mask)
+            chunk = bytes(buffer[:cut])
+            del buffer[:cut]
+
+            chunk_hash = hashlib.sha256(chunk).hexdigest()
+            chunks.append((chunk_hash, len(chunk)))
+
+            target = chunk_path(location, chunk_hash)
+
+            if os.path.isfile(target):
+                continue
+
+            directory = os.path.dirname(target)
+            if not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+
+            temp = "{0}.{1}.tmp".format(target, os.getpid())
+            with open(temp, "wb") as out:
+                out.write(chunk)
+            os.replace(temp, target)
+
+    return chunks
+
+
+class ChunksModel(Model):
+    """
+    An optional chunked representation of the bundles: every uploaded bundle is split into content defined
+    chunks, the manifest lists them in order, so the clients could download only the chunks they lack.
+
+    Chunks are stored once (under data_location/@dlc/chunks) no matter how many bundles share them,
+    and deployed once per application.
+
+    Splitting a big bundle takes a while, so it is done in the background once the upload is complete
+    (see schedule), and whatever is not split yet by the time the bundle is published is split then
+    (see ensure_chunked). The bundles bigger than `chunk_max_bundle_size` are never split; numpy (if installed)
+    makes the splitting some twenty times faster.
+    """
+
+    INSERT_BATCH = 500
+
+    def __init__(self, db):
+        self.db = db
+        self.enabled = options.chunked_bundles
+        self.location = storage_path(options.data_location, AREA_CHUNKS)
+        self.min_size = options.chunk_min_size
+        self.avg_size = options.chunk_avg_size
+        self.max_size = options.chunk_max_size
+        self.processes = options.chunk_processes
+        self.max_bundle_size = options.chunk_max_bundle_size
+        self.executor = None
+        # bundles being split in the background, by bundle id
+        self.pending = {}
+
+    def get_setup_db(self):
+        return self.db
+
+    def get_setup_tables(self):
+        return ["chunks", "bundle_chunks"]
+
+    def chunk_path(self, chunk_hash):
+        return chunk_path(self.location, chunk_hash)
+
+    async def delete_chunks(self, bundle_id):
+        try:
+            await self.db.execute(
+                """
+                DELETE FROM `bundle_chunks`
+                WHERE `bundle_id`=%s;
+                """, bundle_id)
+        except DatabaseError as e:
+            raise ChunkError("Failed to delete bundle chunks: " + e.args[1])
+
+    async def schedule(self, gamespace_id, app_id, bundle_id, path, bundle_hash):
+        """
+        Called once a new content of the bundle is uploaded: the chunks of the old content are dropped
+        right away, the new one is split in the background
+        """
+
+        # the bundle might have been split before, and it's a different content now
+        await self.delete_chunks(bundle_id)
+
+        if not self.enabled:
+            return
+
+        chunking = asyncio.ensure_future(
+            self.__chunk_in_background__(gamespace_id, app_id, bundle_id, path, bundle_hash))
+        self.pending[bundle_id] = chunking
+
+        def done(f):
+            if self.pending.get(bundle_id) is chunking:
+                self.pending.pop(bundle_id, None)
+
+        chunking.add_done_callback(done)
+
+    async def __chunk_in_background__(self, gamespace_id, app_id, bundle_id, path, bundle_hash):
+        try:
+            await self.chunk_bundle(gamespace_id, app_id, bundle_id, path, bundle_hash)
+        except ChunkError as e:
+            # would be split again upon publishing
+            logging.warning("Failed to split bundle {0} into chunks: {1}".format(bundle_id, e.message))
+        except Exception:
+            logging.exception("Failed to split bundle {0} into chunks".format(bundle_id))
+
+    async def ensure_chunked(self, gamespace_id, app_id, bundles, paths):
+        """
+        Makes sure every bundle is split (bundles and paths are lists of the same length), waits for the ones
+        being split in the background, and splits the ones that are not
+        """
+
+        if not self.enabled or not bundles:
+            return
+
+        for bundle in bundles:
+            chunking = self.pending.get(bundle.bundle_id)
+            if chunking is not None:
+                await asyncio.shield(chunking)
+
+        try:
+            rows = await self.db.query(
+                """
+                SELECT DISTINCT `bundle_id`
+                FROM `bundle_chunks`
+                WHERE `bundle_id` IN ({0});
+                """.format(", ".join(["%s"] * len(bundles))), *[bundle.bundle_id for bundle in bundles])
+        except DatabaseError as e:
+            raise ChunkError("Failed to list bundle chunks: " + e.args[1])
+
+        chunked = set(row["bundle_id"] for row in rows)
+
+        for bundle, path in zip(bundles, paths):
+            if bundle.size == 0 or bundle.size > self.max_bundle_size or bundle.bundle_id in chunked:
+                continue
+
+            await self.chunk_bundle(gamespace_id, app_id, bundle.bundle_id, path, bundle.hash)
+
+    async def chunk_bundle(self, gamespace_id, app_id, bundle_id, path, bundle_hash):
+        """
+        Splits a bundle into chunks (in a pool of processes) and writes the list down, unless the content of
+        the bundle has changed meanwhile
+        """
+
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.processes)
+
+        try:
+            chunks = await IOLoop.current().run_in_executor(
+                self.executor, chunk_file, path, self.location, self.min_size, self.avg_size, self.max_size,
+                self.max_bundle_size)
+        except OSError as e:
+            raise ChunkError("Failed to split bundle into chunks: " + str(e))
+
+        if chunks is None:
+            # too big, downloaded as a whole
+            return
+
+        try:
+            async with self.db.acquire(auto_commit=False) as db:
+                # the connection goes back to the pool as it is, and the next acquire would commit it
+                try:
+                    # also serializes the writers of the same bundle
+                    bundle = await db.get(
+                        """
+                        SELECT `bundle_hash`
+                        FROM `bundles`
+                        WHERE `bundle_id`=%s
+                        FOR UPDATE;
+                        """, bundle_id)
+
+                    if not bundle or bundle["bundle_hash"] != bundle_hash:
+                        await db.rollback()
+                        return
+
+                    await db.execute(
+                        """
+                        DELETE FROM `bundle_chunks`
+                        WHERE `bundle_id`=%s;
+                        """, bundle_id)
+
+                    distinct = list(set(chunks))
+
+                    for i in range(0, len(distinct), ChunksModel.INSERT_BATCH):
+                        batch = distinct[i:i + ChunksModel.INSERT_BATCH]
+                        data = []
+                        for chunk_hash, chunk_size in batch:
+                            data.extend([gamespace_id, app_id, chunk_hash, chunk_size])
+
+                        await db.execute(
+                            """
+                            INSERT IGNORE INTO `chunks`
+                            (`gamespace_id`, `application_name`, `chunk_hash`, `chunk_size`)
+                            VALUES {0};
+                            """.format(", ".join(["(%s, %s, %s, %s)"] * len(batch))), *data)
+
+                    for i in range(0, len(chunks), ChunksModel.INSERT_BATCH):
+                        batch = chunks[i:i + ChunksModel.INSERT_BATCH]
+                        data = []
+                        for index, (chunk_hash, chunk_size) in enumerate(batch, i):
+                            data.extend([bundle_id, index, chunk_hash])
+
+                        await db.execute(
+                            """
+                            INSERT INTO `bundle_chunks`
+                            (`bundle_id`, `chunk_index`, `chunk_hash`)
+                            VALUES {0};
+                            """.format(", ".join(["(%s, %s, %s)"] * len(batch))), *data)
+
+                    await db.commit()
+                except BaseException:
+                    await db.rollback()
+                    raise
+        except DatabaseError as e:
+            raise ChunkError("Failed to write bundle chunks: " + e.args[1])
+
+    async def list_undeployed_chunks(self, gamespace_id, app_id, bundle_ids):
+        """
+        Returns a list of distinct hashes of the chunks of the bundles not yet deployed
+        """
+
+        if not bundle_ids:
+            return []
+
+        try:
+            chunks = await self.db.query(
+                """
+                SELECT DISTINCT `chunks`.`chunk_hash`
+                FROM `bundle_chunks`, `chunks`
+                WHERE `bundle_chunks`.`bundle_id` IN ({0})
+                    AND `chunks`.`gamespace_id`=%s AND `chunks`.`application_name`=%s
+                    AND `chunks`.`chunk_hash`=`bundle_chunks`.`chunk_hash` AND `chunks`.`chunk_url` IS NULL;
+                """.format(", ".join(["%s"] * len(bundle_ids))), *bundle_ids, gamespace_id, app_id)
+        except DatabaseError as e:
+            raise ChunkError("Failed to list chunks: " + e.args[1])
+
+        return [chunk["chunk_hash"] for chunk in chunks]
+
+    async def update_chunks_urls(self, gamespace_id, app_id, chunk_urls):
+        """
+        Writes down urls of deployed chunks, chunk_urls is a dict of {chunk_hash: url}
+        """
+
+        chunk_urls = list(chunk_urls.items())
+
+        for i in range(0, len(chunk_urls), ChunksModel.INSERT_BATCH):
+            batch = chunk_urls[i:i + ChunksModel.INSERT_BATCH]
+            data = []
+
+            for chunk_hash, url in batch:
+                data.append(chunk_hash)
+                data.append(url)
+
+            data.extend([gamespace_id, app_id])
+            data.extend(chunk_hash for chunk_hash, url in batch)
+
+            try:
+                await self.db.execute(
+                    """
+                    UPDATE `chunks`
+                    SET `chunk_url`=CASE `chunk_hash` {0} END
+                    WHERE `gamespace_id`=%s AND `application_name`=%s AND `chunk_hash` IN ({1});
+                    """.format(
+                        " ".join(["WHEN %s THEN %s"] * len(batch)),
+                        ", ".join(["%s"] * len(batch))), *data)
+            except DatabaseError as e:
+                raise ChunkError("Failed to update chunks: " + e.args[1])
+
+    async def list_chunks(self, gamespace_id, app_id, bundle_ids):
+        """
+        Returns {bundle_id: [{"hash": ..., "size": ..., "url": ...}, ...]}, chunks are in order
+        """
+
+        if not bundle_ids:
+            return {}
+
+        try:
+            chunks = await self.db.query(
+                """
+                SELECT `bundle_chunks`.`bundle_id`, `chunks`.`chunk_hash`, `chunks`.`chunk_size`, `chunks`.`chunk_url`
+                FROM `bundle_chunks`, `chunks`
+                WHERE `bundle_chunks`.`bundle_id` IN ({0})
+                    AND `chunks`.`gamespace_id`=%s AND `chunks`.`application_name`=%s
+                    AND `chunks`.`chunk_hash`=`bundle_chunks`.`chunk_hash`
+                ORDER BY `bundle_chunks`.`bundle_id`, `bundle_chunks`.`chunk_index`;
+                """.format(", ".join(["%s"] * len(bundle_ids))), *bundle_ids, gamespace_id, app_id)
+        except DatabaseError as e:
+            raise ChunkError("Failed to list chunks: " + e.args[1])
+
+        result = {}
+
+        for chunk in chunks:
+            result.setdefault(chunk["bundle_id"], []).append({
+                "hash": chunk["chunk_hash"],
+                "size": chunk["chunk_size"],
+                "url": chunk["chunk_url"]
+            })
+
+        return result
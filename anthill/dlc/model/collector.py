@@ -0,0 +1,393 @@
+
+from tornado.ioloop import IOLoop
+
+from anthill.common.database import DatabaseError
+from anthill.common.model import Model
+from anthill.common.options import options
+
+from . bundle import BundlesModel
+from . storage import STORAGE_DIRECTORY, AREA_BLOBS, AREA_CHUNKS, AREA_UPLOADS, AREA_IMPORTS
+
+from collections import deque
+
+import asyncio
+import logging
+import os
+import time
+
+
+class CollectorError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+KIND_BUNDLE = "bundle"
+KIND_BLOB = "blob"
+KIND_CHUNK = "chunk"
+KIND_UPLOAD = "upload"
+KIND_TEMP = "temp"
+
+
+def scan_directory(path):
+    """
+    Runs on the executor: returns (files, directories) of a single directory, both sorted by name,
+    files are (name, size, mtime) tuples
+    """
+    files = []
+    directories = []
+
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.name)
+                    elif entry.is_file(follow_symlinks=False):
+                        stat = entry.stat(follow_symlinks=False)
+                        files.append((entry.name, stat.st_size, stat.st_mtime))
+                except OSError:
+                    continue
+    except FileNotFoundError:
+        pass
+
+    files.sort()
+    directories.sort()
+    return files, directories
+
+
+def merge_orphans(files, keys):
+    """
+    Merge-joins a list of (key, file) sorted by key with a sorted list of keys known to the database,
+    returns the files with no key in the database
+    """
+    orphans = []
+    i = 0
+
+    for key, f in files:
+        while i < len(keys) and keys[i] < key:
+            i += 1
+        if i < len(keys) and keys[i] == key:
+            continue
+        orphans.append(f)
+
+    return orphans
+
+
+class GarbageCollectorModel(Model):
+    """
+    Finds files under data_location nothing refers to anymore (a failed upload, a crashed delete,
+    a bundle deleted while its file was still there), and bundles detached from every data version.
+
+    The directory tree is walked one directory at a time, files of a directory are sorted and looked up
+    in the database in batches (merge-joined with the sorted rows), so neither the tree nor the table
+    is ever loaded into memory at once. A pass stops after `gc_max_time` seconds, the next one continues
+    from where it stopped; see `self.progress`.
+
+    Nothing younger than `gc_grace_period` is touched. Orphans are only reported, unless `gc_delete` is set.
+    """
+
+    def __init__(self, bundles, db):
+        self.bundles = bundles
+        self.db = db
+        self.location = options.data_location
+        self.enabled = options.gc_enabled
+        self.delete = options.gc_delete
+        self.interval = options.gc_interval
+        self.grace_period = options.gc_grace_period
+        self.max_time = options.gc_max_time
+        self.batch_size = options.gc_batch_size
+        self.application = None
+
+        # directories (relative to data_location) left to walk in the current cycle
+        self.pending = deque()
+        # last bundle checked for references in the current cycle, None once all of them are
+        self.rows_cursor = None
+        self.progress = {}
+
+    def get_setup_db(self):
+        return self.db
+
+    async def started(self, application):
+        await super(GarbageCollectorModel, self).started(application)
+
+        self.application = application
+
+        if self.enabled:
+            IOLoop.current().spawn_callback(self.__collect_loop__)
+
+    async def __collect_loop__(self):
+        while True:
+            try:
+                await self.collect()
+            except Exception:
+                logging.exception("Failed to collect garbage")
+
+            # a cycle interrupted by the time limit goes on after a pause as long as the pass itself
+            await asyncio.sleep(self.max_time if self.__in_cycle__() else self.interval)
+
+    def __in_cycle__(self):
+        return bool(self.pending) or self.rows_cursor is not None
+
+    def __start_cycle__(self):
+        self.pending = deque([""])
+        self.rows_cursor = 0
+        self.progress = {
+            "started": time.time(),
+            "files": 0,
+            "orphans": 0,
+            "orphan_bytes": 0,
+            "unreferenced_bundles": 0,
+            "deleted_bundles": 0,
+            "directories": 0
+        }
+
+    async def collect(self):
+        """
+        Runs a single pass (bounded by gc_max_time), starts a new cycle if the previous one is over
+        """
+
+        started = IOLoop.current().time()
+        deadline = started + self.max_time
+
+        if not self.__in_cycle__():
+            self.__start_cycle__()
+
+        before = dict(self.progress)
+
+        while self.rows_cursor is not None and IOLoop.current().time() < deadline:
+            await self.__collect_bundles__()
+
+        while self.pending and IOLoop.current().time() < deadline:
+            await self.__collect_directory__(self.pending.popleft())
+
+        self.progress["directories_left"] = len(self.pending)
+        self.progress["complete"] = not self.__in_cycle__()
+
+        if self.progress["complete"]:
+            logging.warning("Garbage collection: {0} orphaned files ({1} bytes), {2} unreferenced bundles{3}".format(
+                self.progress["orphans"], self.progress["orphan_bytes"], self.progress["unreferenced_bundles"],
+                ", deleted" if self.delete else ""))
+
+        if self.application is not None:
+            self.application.monitor_action("bundle_gc", values={
+                "time": IOLoop.current().time() - started,
+                "files": self.progress["files"] - before.get("files", 0),
+                "orphans": self.progress["orphans"] - before.get("orphans", 0),
+                "orphan_bytes": self.progress["orphan_bytes"] - before.get("orphan_bytes", 0),
+                "deleted_bundles": self.progress["deleted_bundles"] - before.get("deleted_bundles", 0),
+                "directories_left": self.progress["directories_left"]
+            })
+
+    async def __collect_bundles__(self):
+        """
+        Checks the next batch of bundles attached to no data version at all. Those detached for longer than
+        the grace period (`bundle_detached_at`, so it survives a restart and is the same on every node)
+        are deleted, their files become orphans and are collected later. Delivered bundles are never deleted,
+        a published data version could still point at them.
+        """
+
+        try:
+            rows = await self.db.query(
+                """
+                SELECT `bundle_id`, `bundle_detached_at` IS NULL AS `unmarked`,
+                    `bundle_detached_at` < DATE_SUB(NOW(), INTERVAL %s SECOND) AS `expired`
+                FROM `bundles`
+                WHERE `bundle_id`>%s AND `bundle_status`<>%s AND `bundle_id` NOT IN (
+                    SELECT `bundle_id` FROM `data_bundles`)
+                ORDER BY `bundle_id` ASC
+                LIMIT %s;
+                """, self.grace_period, self.rows_cursor, BundlesModel.STATUS_DELIVERED, self.batch_size)
+        except DatabaseError as e:
+            raise CollectorError("Failed to list unreferenced bundles: " + e.args[1])
+
+        # never attached to anything, or detached before the column was there
+        unmarked = [row["bundle_id"] for row in rows if row["unmarked"]]
+        expired = [row["bundle_id"] for row in rows if row["expired"]]
+
+        self.progress["unreferenced_bundles"] += len(rows)
+
+        try:
+            if unmarked:
+                await self.db.execute(
+                    """
+                    UPDATE `bundles`
+                    SET `bundle_detached_at`=NOW()
+                    WHERE `bundle_id` IN ({0}) AND `bundle_detached_at` IS NULL AND `bundle_id` NOT IN (
+                        SELECT `bundle_id` FROM `data_bundles`);
+                    """.format(", ".join(["%s"] * len(unmarked))), *unmarked)
+
+            if expired and self.delete:
+                # could have been attached again (or delivered) since
+                deleted = await self.db.execute(
+                    """
+                    DELETE FROM `bundles`
+                    WHERE `bundle_id` IN ({0}) AND `bundle_status`<>%s
+                      AND `bundle_detached_at` < DATE_SUB(NOW(), INTERVAL %s SECOND)
+                      AND `bundle_id` NOT IN (
+                        SELECT `bundle_id` FROM `data_bundles`);
+                    """.format(", ".join(["%s"] * len(expired))),
+                    *(expired + [BundlesModel.STATUS_DELIVERED, self.grace_period]))
+
+                self.progress["deleted_bundles"] += deleted or 0
+        except DatabaseError as e:
+            raise CollectorError("Failed to collect unreferenced bundles: " + e.args[1])
+
+        if len(rows) < self.batch_size:
+            self.rows_cursor = None
+        else:
+            self.rows_cursor = rows[-1]["bundle_id"]
+
+    async def __collect_directory__(self, relative):
+        files, directories = await IOLoop.current().run_in_executor(
+            self.bundles.executor, scan_directory, os.path.join(self.location, relative))
+
+        parts = relative.split(os.sep) if relative else []
+
+        # depth first, in order; the storage areas are one level deeper than the applications
+        if len(parts) < (4 if parts and parts[0] == STORAGE_DIRECTORY else 3):
+            self.pending.extendleft(reversed([os.path.join(relative, name) for name in directories]))
+
+        self.progress["directories"] += 1
+        self.progress["files"] += len(files)
+
+        if not parts:
+            return
+
+        threshold = time.time() - self.grace_period
+        kinds = {}
+
+        for name, size, mtime in files:
+            if mtime > threshold:
+                continue
+
+            kind, key = GarbageCollectorModel.__classify__(parts, name)
+
+            if kind is not None:
+                kinds.setdefault(kind, []).append((key, (os.path.join(self.location, relative, name), size)))
+
+        orphans = []
+        # the files to remove, but the blobs
+        files = []
+        blobs = []
+
+        for kind, entries in kinds.items():
+            entries.sort(key=lambda entry: entry[0])
+
+            for i in range(0, len(entries), self.batch_size):
+                batch = entries[i:i + self.batch_size]
+                keys = await self.__known_keys__(kind, [key for key, f in batch])
+                found = merge_orphans(batch, keys)
+                orphans.extend(found)
+
+                if kind == KIND_BLOB:
+                    blobs.extend(os.path.basename(path) for path, size in found)
+                else:
+                    files.extend(path for path, size in found)
+
+        if not orphans:
+            return
+
+        for path, size in orphans:
+            logging.info("Orphaned file '{0}' ({1} bytes)".format(path, size))
+
+        self.progress["orphans"] += len(orphans)
+        self.progress["orphan_bytes"] += sum(size for path, size in orphans)
+
+        if self.delete:
+            self.bundles.reclaimer.reclaim(files)
+            # a blob could be claimed by a new upload at any moment, so it is checked once again under its lock
+            self.bundles.reclaim_blobs(blobs)
+
+    @staticmethod
+    def __classify__(parts, name):
+        """
+        Returns (kind, key) of a file in the directory, the key is what the database knows the file by.
+        (None, None) for the files unknown to this service, those are never touched.
+        """
+
+        if name.endswith(".tmp"):
+            return KIND_TEMP, name
+
+        # data_location/@dlc/<area>/..., no application could be called like that
+        if parts[0] == STORAGE_DIRECTORY:
+            area = parts[1] if len(parts) > 1 else None
+
+            if area == AREA_BLOBS:
+                return (KIND_BLOB, name) if len(parts) == 3 else (None, None)
+
+            if area == AREA_CHUNKS:
+                return (KIND_CHUNK, name) if len(parts) == 3 else (None, None)
+
+            if area == AREA_UPLOADS:
+                if len(parts) == 2 and name.endswith(".part") and name[:-5].isdigit():
+                    return KIND_UPLOAD, int(name[:-5])
+                return None, None
+
+            if area == AREA_IMPORTS:
+                return (KIND_TEMP, name) if len(parts) == 2 else (None, None)
+
+            return None, None
+
+        # data_location/<app>/patches/<directory>/<patch>, deployed and removed right away
+        if len(parts) == 3 and parts[1] == "patches":
+            return KIND_TEMP, name
+
+        # data_location/<app>/<directory>/<bundle_id>_<bundle_key>
+        if len(parts) == 2 and parts[1] != "patches":
+            bundle_id, separator, bundle_key = name.partition("_")
+            if separator and bundle_id.isdigit():
+                return KIND_BUNDLE, (int(bundle_id), bundle_key)
+
+        return None, None
+
+    async def __known_keys__(self, kind, keys):
+        """
+        Returns a sorted list of the keys the database knows about
+        """
+
+        if kind == KIND_TEMP:
+            return []
+
+        try:
+            if kind == KIND_BUNDLE:
+                bundle_ids = list(set(bundle_id for bundle_id, bundle_key in keys))
+                rows = await self.db.query(
+                    """
+                    SELECT `bundle_id`, `bundle_key`
+                    FROM `bundles`
+                    WHERE `bundle_id` IN ({0})
+                    ORDER BY `bundle_id` ASC;
+                    """.format(", ".join(["%s"] * len(bundle_ids))), *bundle_ids)
+                return sorted((row["bundle_id"], row["bundle_key"]) for row in rows)
+
+            if kind == KIND_BLOB:
+                rows = await self.db.query(
+                    """
+                    SELECT DISTINCT `bundle_hash` AS `key`
+                    FROM `bundles`
+                    WHERE `bundle_hash` IN ({0});
+                    """.format(", ".join(["%s"] * len(keys))), *keys)
+            elif kind == KIND_CHUNK:
+                rows = await self.db.query(
+                    """
+                    SELECT DISTINCT `chunk_hash` AS `key`
+                    FROM `bundle_chunks`
+                    WHERE `chunk_hash` IN ({0});
+                    """.format(", ".join(["%s"] * len(keys))), *keys)
+            elif kind == KIND_UPLOAD:
+                rows = await self.db.query(
+                    """
+                    SELECT `upload_id` AS `key`
+                    FROM `bundle_uploads`
+                    WHERE `upload_id` IN ({0});
+                    """.format(", ".join(["%s"] * len(keys))), *keys)
+            else:
+                raise CollectorError("Unknown kind: " + kind)
+        except DatabaseError as e:
+            raise CollectorError("Failed to look up {0} files: {1}".format(kind, e.args[1]))
+
+        # sorted here, the database collation does not have to agree with python on the order
+        return sorted(row["key"] for row in rows)
@@ -1,11 +1,26 @@
 
 from tornado.ioloop import IOLoop
+from tornado.locks import Condition
+from expiringdict import ExpiringDict
 
-from anthill.common.model import Model
 from anthill.common.database import DatabaseError, ConstraintsError
+from anthill.common.options import options
 
-from . bundle import BundlesModel
+from . indexes import IndexedModel
+from . apps import ApplicationsModel, NoSuchApplicationError, ApplicationError
+from . bundle import BundlesModel, BundleError
 from . deploy import DeploymentError
+from . manifest import ManifestSnapshot
+from . patch import PatchError
+from . chunks import ChunkError
+from . integrity import IntegrityChecker
+from . jobs import PublishJobsModel, JobError
+
+from datetime import timedelta
+
+import asyncio
+import logging
+import ujson
 
 
 class DataError(Exception):
@@ -32,23 +47,51 @@ class DataAdapter(object):
         self.reason = data["version_status_reason"]
 
 
-class DatasModel(Model):
+class DatasModel(IndexedModel):
 
     STATUS_CREATED = 'CREATED'
     STATUS_PUBLISHING = 'PUBLISHING'
     STATUS_PUBLISHED = 'PUBLISHED'
     STATUS_ERROR = 'ERROR'
 
-    def __init__(self, bundles, deployment, db):
+    # version_status_reason is a varchar(255)
+    REASON_LIST_LENGTH = 180
+
+    def __init__(self, apps, bundles, deployment, patches, jobs, manifests, db, snapshots_cache_size=16):
+        self.apps = apps
         self.bundles = bundles
         self.deployment = deployment
+        self.patches = patches
+        self.jobs = jobs
+        self.manifests = manifests
         self.db = db
 
+        self.publish_workers = options.publish_workers
+        self.publish_poll_interval = options.publish_job_poll_interval
+        self.publish_wakeup = Condition()
+
+        # the files of the bundles are checked before anything gets deployed
+        self.verifier = IntegrityChecker(options.verify_processes) if options.verify_before_publish else None
+
+        # snapshots are kept by (data_id, generation of the application), so once the manifests of the
+        # application are invalidated (a bundle or the filters scheme changed), every node loads them again
+        self.snapshots = ExpiringDict(max_len=snapshots_cache_size, max_age_seconds=86400)
+        self.snapshots_loading = {}
+
     def get_setup_db(self):
         return self.db
 
     def get_setup_tables(self):
-        return ["datas"]
+        return ["datas", "data_manifests"]
+
+    def get_setup_indexes(self):
+        return [("datas", "datas_application_idx")]
+
+    async def started(self, application):
+        await super(DatasModel, self).started(application)
+
+        for i in range(0, self.publish_workers):
+            IOLoop.current().spawn_callback(self.__publish_worker__)
 
     async def delete_data_version(self, gamespace_id, app_id, data_id):
 
@@ -70,26 +113,40 @@ class DatasModel(Model):
         if data.status == DatasModel.STATUS_PUBLISHED:
             raise DataError("Cannot delete published data version")
 
-        bundles = await self.bundles.list_bundles(gamespace_id, data_id)
-
-        if bundles is not None:
-            for bundle in bundles:
-                if bundle.status == BundlesModel.STATUS_DELIVERED:
-                    continue
-
-                await self.bundles.delete_bundle(gamespace_id, app_id, data_id, bundle.bundle_id)
+        if data.status == DatasModel.STATUS_PUBLISHING:
+            raise DataError("Cannot delete data version being published")
 
         try:
-            await self.db.execute(
-                """
-                    DELETE FROM `datas`
-                    WHERE `data_id`=%s
-                """, data_id)
+            async with self.db.acquire(auto_commit=False) as db:
+                # the connection goes back to the pool as it is, and the next acquire would commit it
+                try:
+                    files, hashes = await self.bundles.delete_data_bundles(db, gamespace_id, app_id, data_id)
+
+                    await db.execute(
+                        """
+                            DELETE FROM `data_manifests`
+                            WHERE `data_id`=%s AND `gamespace_id`=%s
+                        """, data_id, gamespace_id)
+
+                    await db.execute(
+                        """
+                            DELETE FROM `datas`
+                            WHERE `data_id`=%s AND `gamespace_id`=%s
+                        """, data_id, gamespace_id)
+
+                    await db.commit()
+                except BaseException:
+                    await db.rollback()
+                    raise
         except ConstraintsError:
             raise VersionUsesDataError()
         except DatabaseError as e:
             raise DataError("Failed to delete data version: " + e.args[1])
 
+        # the rows are gone already, the files are removed in the background
+        self.bundles.reclaimer.reclaim(files)
+        self.bundles.reclaim_blobs(hashes)
+
     async def list_data_versions(self, gamespace_id, app_id, published=False):
         if published:
             try:
@@ -116,6 +173,22 @@ class DatasModel(Model):
 
             return list(map(DataAdapter, versions))
 
+    async def find_previous_data_version(self, gamespace_id, app_id, data_id):
+        """
+        Returns id of the most recent published data version of the application older than this one, or None
+        """
+        try:
+            previous = await self.db.get(
+                """
+                    SELECT MAX(`data_id`) AS `data_id`
+                    FROM `datas`
+                    WHERE `gamespace_id`=%s AND `application_name`=%s AND `version_status`=%s AND `data_id`<%s;
+                """, gamespace_id, app_id, DatasModel.STATUS_PUBLISHED, data_id)
+        except DatabaseError as e:
+            raise DataError("Failed to find previous data version: " + e.args[1])
+
+        return previous["data_id"] if previous else None
+
     async def get_data_version(self, gamespace_id, data_id):
         try:
             version = await self.db.get(
@@ -146,6 +219,49 @@ class DatasModel(Model):
 
         return result
 
+    async def clone_data_version(self, gamespace_id, app_id, data_id):
+        """
+        Creates a new data version with every delivered bundle of the existing one attached to it,
+        in a single set-based copy. Bundles not yet delivered are not shared (they still could be changed),
+        so they are not copied.
+        """
+
+        data = await self.get_data_version(gamespace_id, data_id)
+
+        if data.application_name != app_id:
+            raise NoSuchDataError()
+
+        try:
+            async with self.db.acquire(auto_commit=False) as db:
+                # the connection goes back to the pool as it is, and the next acquire would commit it
+                try:
+                    new_data_id = await db.insert(
+                        """
+                            INSERT INTO `datas`
+                            (`application_name`, `version_status`, `gamespace_id`)
+                            VALUES (%s, %s, %s)
+                        """, app_id, DatasModel.STATUS_CREATED, gamespace_id)
+
+                    await db.execute(
+                        """
+                            INSERT INTO `data_bundles`
+                            (`gamespace_id`, `bundle_id`, `data_id`)
+                            SELECT `data_bundles`.`gamespace_id`, `data_bundles`.`bundle_id`, %s
+                            FROM `data_bundles`, `bundles`
+                            WHERE `data_bundles`.`data_id`=%s AND `data_bundles`.`gamespace_id`=%s
+                                AND `bundles`.`bundle_id`=`data_bundles`.`bundle_id`
+                                AND `bundles`.`bundle_status`=%s
+                        """, new_data_id, data_id, gamespace_id, BundlesModel.STATUS_DELIVERED)
+
+                    await db.commit()
+                except BaseException:
+                    await db.rollback()
+                    raise
+        except DatabaseError as e:
+            raise DataError("Failed to clone data version: " + e.args[1])
+
+        return new_data_id
+
     async def update_data_version(self, gamespace_id, data_id, status, reason):
         try:
             await self.db.execute(
@@ -153,7 +269,7 @@ class DatasModel(Model):
                     UPDATE `datas`
                     SET `version_status`=%s, `version_status_reason`=%s
                     WHERE `data_id`=%s AND `gamespace_id`=%s
-                """, status, reason, data_id, gamespace_id)
+                """, status, reason[:255], data_id, gamespace_id)
         except DatabaseError as e:
             raise DataError("Failed to create data version: " + e.args[1])
 
@@ -167,7 +283,7 @@ class DatasModel(Model):
         if data.status == DatasModel.STATUS_PUBLISHING:
             raise DataError("This data version is already being published")
 
-        bundles = await self.bundles.list_bundles(gamespace_id, data_id)
+        bundles = await self.bundles.list_bundles(gamespace_id, data_id, lean=True)
 
         if not bundles:
             raise DataError("No bundles to publish")
@@ -179,12 +295,315 @@ class DatasModel(Model):
 
         await self.update_data_version(gamespace_id, data_id, DatasModel.STATUS_PUBLISHING, "")
 
-        async def process():
+        try:
+            await self.jobs.enqueue(gamespace_id, data_id)
+        except JobError as e:
+            await self.update_data_version(gamespace_id, data_id, DatasModel.STATUS_ERROR, e.message)
+            raise DataError(e.message)
+
+        self.publish_wakeup.notify()
+
+    async def __publish_worker__(self):
+        """
+        Processes the publish jobs one by one, see PublishJobsModel
+        """
+
+        try:
+            # the data versions left publishing by the nodes before the jobs were introduced
+            await self.jobs.recover(DatasModel.STATUS_PUBLISHING)
+        except JobError as e:
+            logging.error(e.message)
+
+        while True:
             try:
-                await self.deployment.deploy(gamespace_id, data.application_name, bundles)
-            except DeploymentError as e:
-                await self.update_data_version(gamespace_id, data_id, DatasModel.STATUS_ERROR, e.message)
-            else:
-                await self.update_data_version(gamespace_id, data_id, DatasModel.STATUS_PUBLISHED, "")
+                job = await self.jobs.claim()
+            except JobError as e:
+                logging.error(e.message)
+                job = None
+
+            if job is None:
+                await self.publish_wakeup.wait(timeout=timedelta(seconds=self.publish_poll_interval))
+                continue
+
+            try:
+                await self.__process_job__(job)
+            except Exception:
+                # the lease has to expire before someone retries it
+                logging.exception("Failed to process publish job {0}".format(job.job_id))
+
+    async def __process_job__(self, job):
+        gamespace_id = job.gamespace_id
+        data_id = job.data_id
+
+        if job.attempts > self.jobs.max_attempts:
+            await self.jobs.finish(job, PublishJobsModel.STATUS_FAILED,
+                                   DatasModel.STATUS_ERROR, "Publishing has failed too many times")
+            return
+
+        try:
+            data = await self.get_data_version(gamespace_id, data_id)
+        except NoSuchDataError:
+            await self.jobs.finish(job, PublishJobsModel.STATUS_FAILED)
+            return
+
+        progress = {}
+        lease = {"lost": False}
+
+        async def report(delivered, total):
+            progress["delivered"] = delivered
+            progress["total"] = total
+
+        publishing = asyncio.ensure_future(self.__publish__(gamespace_id, data, report))
+
+        async def heartbeat():
+            while True:
+                await asyncio.sleep(self.jobs.lease_time / 3.0)
+                try:
+                    renewed = await self.jobs.renew(job, progress.get("delivered"), progress.get("total"))
+                except JobError as e:
+                    logging.error(e.message)
+                    continue
+
+                if not renewed:
+                    # the lease has expired and the job is someone else's now, two nodes should never
+                    # deploy the same data version at once
+                    lease["lost"] = True
+                    publishing.cancel()
+                    return
+
+        keep_alive = asyncio.ensure_future(heartbeat())
+
+        try:
+            await publishing
+        except asyncio.CancelledError:
+            if not lease["lost"]:
+                raise
+            logging.error("Publish job {0} has lost its lease, stopped".format(job.job_id))
+        except (DeploymentError, DataError, PatchError) as e:
+            finished = await self.jobs.finish(
+                job, PublishJobsModel.STATUS_FAILED, DatasModel.STATUS_ERROR, e.message)
+            if not finished:
+                logging.error("Publish job {0} has failed after losing its lease: {1}".format(job.job_id, e.message))
+        except (BundleError, JobError, DatabaseError) as e:
+            logging.error("Publish job {0} will be retried: {1}".format(job.job_id, str(e)))
+            await self.jobs.release(job)
+        else:
+            finished = await self.jobs.finish(job, PublishJobsModel.STATUS_DONE, DatasModel.STATUS_PUBLISHED)
+            if not finished:
+                logging.error("Publish job {0} has lost its lease before it was finished".format(job.job_id))
+        finally:
+            keep_alive.cancel()
+            # even a failed deployment may have delivered some of the bundles
+            await self.manifests.invalidate(data.application_name)
+
+    async def __publish__(self, gamespace_id, data, progress):
+        """
+        Could be called again for the same data version after a crash, the bundles already delivered
+        are not deployed again
+        """
+
+        data_id = data.data_id
+        # neither deployment nor patches need the filters and the payload
+        bundles = await self.bundles.list_bundles(gamespace_id, data_id, lean=True)
+
+        await self.verify_bundles(data.application_name, bundles)
+        await self.deployment.deploy(gamespace_id, data.application_name, bundles, progress=progress)
+        previous_data_id = await self.find_previous_data_version(gamespace_id, data.application_name, data_id)
+        await self.patches.create_patches(gamespace_id, data.application_name, previous_data_id, bundles)
+        await self.build_manifest_snapshot(gamespace_id, data_id)
+
+    async def verify_bundles(self, app_id, bundles):
+        """
+        Checks presence, size and hash of every bundle to be deployed (if enabled, see verify_before_publish),
+        raises DataError listing every bad bundle at once
+        """
+
+        if self.verifier is None:
+            return
+
+        pending = [bundle for bundle in bundles if bundle.status != BundlesModel.STATUS_DELIVERED]
+
+        paths = await self.bundles.bundle_paths(app_id, pending)
+
+        problems = await self.verifier.check([
+            (bundle, path, bundle.size, bundle.hash)
+            for bundle, path in zip(pending, paths)
+        ])
+
+        if not problems:
+            return
+
+        described = ["{0} ({1})".format(bundle.name, status.lower()) for bundle, status, actual_size in problems]
+
+        logging.error("Cannot publish bundles of app '{0}', {1} bad bundle(s): {2}".format(
+            app_id, len(problems), ", ".join(described)))
+
+        # the status reason is limited, so the full list is only in the log
+        listed = []
+        length = 0
+
+        for description in described:
+            if length + len(description) > DatasModel.REASON_LIST_LENGTH:
+                break
+            listed.append(description)
+            length += len(description) + 2
+
+        message = "{0} bad bundle(s)".format(len(problems))
+
+        if listed:
+            message += ": " + ", ".join(listed)
+
+        if len(listed) < len(described):
+            message += " and {0} more, see the log".format(len(described) - len(listed))
+
+        raise DataError(message)
+
+    async def build_manifest_snapshot(self, gamespace_id, data_id, filters_scheme=None):
+        """
+        Writes down every delivered bundle of the data version, so the manifests could be resolved
+        without querying the bundles at all
+        """
+
+        try:
+            bundles = await self.bundles.list_bundles(gamespace_id, data_id)
+        except BundleError as e:
+            raise DataError(e.message)
+
+        bundles = [bundle for bundle in bundles if bundle.status == BundlesModel.STATUS_DELIVERED]
+        bundle_ids = [bundle.bundle_id for bundle in bundles]
+
+        data = await self.get_data_version(gamespace_id, data_id)
+
+        try:
+            patches = await self.patches.list_patches(gamespace_id, bundle_ids)
+            chunks = await self.bundles.chunks.list_chunks(gamespace_id, data.application_name, bundle_ids)
+        except (PatchError, ChunkError) as e:
+            raise DataError(e.message)
+
+        snapshot = ManifestSnapshot(data_id, [
+            ManifestSnapshot.dump_bundle(bundle, patches.get(bundle.bundle_id), chunks.get(bundle.bundle_id))
+            for bundle in bundles
+        ], filters_scheme)
+
+        try:
+            await self.db.insert(
+                """
+                    INSERT INTO `data_manifests`
+                    (`data_id`, `gamespace_id`, `manifest`)
+                    VALUES (%s, %s, %s)
+                    ON DUPLICATE KEY
+                    UPDATE `manifest`=VALUES(`manifest`);
+                """, data_id, gamespace_id, ujson.dumps(snapshot.bundles))
+        except DatabaseError as e:
+            raise DataError("Failed to write manifest snapshot: " + e.args[1])
+
+        return snapshot
+
+    async def get_manifest_snapshot(self, gamespace_id, app_name, data_id):
+        """
+        Returns the manifest snapshot of a published data version, or None if the data version
+        is not published yet. The snapshot is loaded once per data version and generation of the application.
+        """
+
+        if not data_id:
+            return None
+
+        key = (data_id, await self.manifests.generation(app_name))
+        snapshot = self.snapshots.get(key)
+
+        if snapshot is not None:
+            return snapshot
+
+        loading = self.snapshots_loading.get(key)
+
+        if loading is None:
+            loading = asyncio.ensure_future(self.__load_manifest_snapshot__(gamespace_id, data_id, key))
+            self.snapshots_loading[key] = loading
+
+            def loaded(f):
+                self.snapshots_loading.pop(key, None)
+
+            loading.add_done_callback(loaded)
+
+        return await asyncio.shield(loading)
+
+    async def refresh_manifests(self, gamespace_id, data_ids):
+        """
+        Called once anything the manifests of these data versions are resolved from has changed: rebuilds
+        the snapshots of the published ones, and invalidates the manifests of their applications
+        """
+
+        if not data_ids:
+            return
+
+        try:
+            datas = await self.db.query(
+                """
+                    SELECT `data_id`, `application_name`, `version_status`
+                    FROM `datas`
+                    WHERE `gamespace_id`=%s AND `data_id` IN ({0});
+                """.format(", ".join(["%s"] * len(data_ids))), gamespace_id, *data_ids)
+        except DatabaseError as e:
+            raise DataError("Failed to list data versions: " + e.args[1])
+
+        for data in datas:
+            if data["version_status"] == DatasModel.STATUS_PUBLISHED:
+                await self.build_manifest_snapshot(gamespace_id, data["data_id"])
+
+        for app_name in set(data["application_name"] for data in datas):
+            await self.manifests.invalidate(app_name)
+
+    async def update_bundle_properties(self, gamespace_id, bundle_id, bundle_filters, bundle_payload):
+        """
+        Updates filters and payload of the bundle, and the manifests of every data version it is attached to
+        """
+
+        try:
+            await self.bundles.update_bundle_properties(gamespace_id, bundle_id, bundle_filters, bundle_payload)
+            data_ids = await self.bundles.list_bundle_data_versions(gamespace_id, bundle_id)
+        except BundleError as e:
+            raise DataError(e.message)
+
+        await self.refresh_manifests(gamespace_id, data_ids)
+        await self.manifests.invalidate_bundles(gamespace_id)
+
+    async def __filters_scheme__(self, gamespace_id, app_id):
+        try:
+            settings = await self.apps.get_application(gamespace_id, app_id)
+        except NoSuchApplicationError:
+            return ApplicationsModel.DEFAULT_FILTERS_SCHEME
+        except ApplicationError as e:
+            raise DataError(e.message)
+
+        return settings.filters_scheme
+
+    async def __load_manifest_snapshot__(self, gamespace_id, data_id, key):
+        try:
+            manifest = await self.db.get(
+                """
+                    SELECT `data_manifests`.`manifest`, `datas`.`application_name`
+                    FROM `data_manifests`, `datas`
+                    WHERE `data_manifests`.`data_id`=%s AND `data_manifests`.`gamespace_id`=%s
+                        AND `datas`.`data_id`=`data_manifests`.`data_id`;
+                """, data_id, gamespace_id)
+        except DatabaseError as e:
+            raise DataError("Failed to get manifest snapshot: " + e.args[1])
+
+        if manifest:
+            filters_scheme = await self.__filters_scheme__(gamespace_id, manifest["application_name"])
+            snapshot = ManifestSnapshot(data_id, manifest["manifest"], filters_scheme)
+        else:
+            try:
+                data = await self.get_data_version(gamespace_id, data_id)
+            except NoSuchDataError:
+                return None
+
+            if data.status != DatasModel.STATUS_PUBLISHED:
+                return None
+
+            # published before the snapshots were introduced
+            filters_scheme = await self.__filters_scheme__(gamespace_id, data.application_name)
+            snapshot = await self.build_manifest_snapshot(gamespace_id, data_id, filters_scheme)
 
-        IOLoop.current().add_callback(process)
+        self.snapshots[key] = snapshot
+        return snapshot
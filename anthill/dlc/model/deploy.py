@@ -1,18 +1,27 @@
 
+from tornado.locks import Semaphore
+
 from . apps import NoSuchApplicationError, ApplicationError
-from . bundle import BundlesModel
+from . bundle import BundlesModel, BundleError
+from . chunks import ChunkError
 
 from anthill.common.model import Model
 from anthill.common.deployment import DeploymentError, DeploymentMethods
 
+import asyncio
+import logging
+
 
 class DeploymentModel(Model):
+
+    # delivered bundles are written down in batches of this size
+    FLUSH_SIZE = 50
+
     def __init__(self, bundles, apps):
         self.bundles = bundles
         self.apps = apps
 
-    async def deploy(self, gamespace_id, app_id, bundles):
-
+    async def __method__(self, gamespace_id, app_id):
         try:
             settings = await self.apps.get_application(gamespace_id, app_id)
         except NoSuchApplicationError:
@@ -23,20 +32,146 @@ class DeploymentModel(Model):
         m = DeploymentMethods.get(settings.deployment_method)()
         m.load(settings.deployment_data)
 
-        for bundle in bundles:
-            if bundle.status == BundlesModel.STATUS_DELIVERED:
-                continue
+        return settings, m
+
+    async def deploy_file(self, gamespace_id, app_id, path, directory, key):
+        """
+        Deploys a file other than a bundle (a patch, for example) the same way, returns its url
+        """
+
+        settings, m = await self.__method__(gamespace_id, app_id)
+        return await m.deploy(gamespace_id, path, directory, key)
+
+    async def deploy(self, gamespace_id, app_id, bundles, progress=None):
+        """
+        Deploys up to `deployment_concurrency` (see application settings) bundles at the same time.
+        A failed bundle does not stop the others, all of the failures are reported at the end.
+
+        Bundles already delivered are skipped, so a deployment interrupted halfway could be simply repeated.
+        The `progress` coroutine (if passed) is called with (delivered, total) as bundles get delivered.
+        """
+
+        settings, m = await self.__method__(gamespace_id, app_id)
+
+        pending = [bundle for bundle in bundles if bundle.status != BundlesModel.STATUS_DELIVERED]
+
+        if not pending:
+            return
 
-            await self.bundles.update_bundle_status(gamespace_id, bundle.bundle_id, BundlesModel.STATUS_DELIVERING)
+        # the bundles reused below are counted once they are flushed
+        done = [len(bundles) - len(pending)]
+        delivered = {}
+        failed = []
 
+        if self.bundles.content_addressed:
+            # the same content is already deployed, so there's nothing to upload again
+            try:
+                urls = await self.bundles.find_deployed_urls(
+                    gamespace_id, app_id, [bundle.hash for bundle in pending])
+            except BundleError as e:
+                raise DeploymentError(e.message)
+
+            for bundle in pending:
+                url = urls.get(bundle.hash)
+                if url:
+                    delivered[bundle.bundle_id] = url
+
+            pending = [bundle for bundle in pending if bundle.bundle_id not in delivered]
+
+        async def flush():
+            urls = dict(delivered)
+            delivered.clear()
+            await self.bundles.update_bundles_urls(gamespace_id, BundlesModel.STATUS_DELIVERED, urls)
+
+            done[0] += len(urls)
+            if progress is not None:
+                await progress(done[0], len(bundles))
+
+        async def deploy_bundle(bundle):
             try:
                 url = await m.deploy(
-                    gamespace_id, self.bundles.bundle_path(app_id, bundle),
+                    gamespace_id, await self.bundles.bundle_path(app_id, bundle),
                     bundle.get_directory(), str(bundle.get_key()))
             except DeploymentError as e:
-                await self.bundles.update_bundle_status(
-                    gamespace_id, bundle.bundle_id, BundlesModel.STATUS_ERROR)
-                raise e
-            else:
-                await self.bundles.update_bundle_url(
-                    gamespace_id, bundle.bundle_id, BundlesModel.STATUS_DELIVERED, url)
+                failed.append((bundle, e.message))
+                return
+            except Exception as e:
+                logging.exception("Failed to deploy bundle {0}".format(bundle.bundle_id))
+                failed.append((bundle, str(e)))
+                return
+
+            delivered[bundle.bundle_id] = url
+
+            if len(delivered) >= DeploymentModel.FLUSH_SIZE:
+                await flush()
+
+        semaphore = Semaphore(max(1, int(settings.deployment_concurrency)))
+
+        async def worker(bundle):
+            async with semaphore:
+                await deploy_bundle(bundle)
+
+        # chunks go first, so a delivered bundle always has its chunks delivered too
+        await self.__deploy_chunks__(gamespace_id, app_id, m, semaphore, bundles)
+
+        try:
+            await self.bundles.update_bundles_status(
+                gamespace_id, [bundle.bundle_id for bundle in pending], BundlesModel.STATUS_DELIVERING)
+
+            results = await asyncio.gather(*[worker(bundle) for bundle in pending], return_exceptions=True)
+            await flush()
+
+            for result in results:
+                if isinstance(result, BundleError):
+                    raise result
+
+            if failed:
+                await self.bundles.update_bundles_status(
+                    gamespace_id, [bundle.bundle_id for bundle, reason in failed], BundlesModel.STATUS_ERROR)
+        except BundleError as e:
+            raise DeploymentError(e.message)
+
+        if failed:
+            raise DeploymentError("Failed to deploy {0} bundle(s): {1}".format(
+                len(failed), ", ".join("{0} ({1})".format(bundle.name, reason) for bundle, reason in failed)))
+
+    async def __deploy_chunks__(self, gamespace_id, app_id, m, semaphore, bundles):
+        """
+        Deploys chunks of the bundles (see ChunksModel) not deployed yet, every chunk is deployed only once
+        """
+
+        chunks = self.bundles.chunks
+
+        # normally split in the background right after the upload
+        unsplit = [bundle for bundle in bundles if bundle.status != BundlesModel.STATUS_DELIVERED]
+
+        try:
+            await chunks.ensure_chunked(
+                gamespace_id, app_id, unsplit, await self.bundles.bundle_paths(app_id, unsplit))
+
+            pending = await chunks.list_undeployed_chunks(
+                gamespace_id, app_id, [bundle.bundle_id for bundle in bundles])
+        except ChunkError as e:
+            raise DeploymentError(e.message)
+
+        if not pending:
+            return
+
+        delivered = {}
+
+        async def deploy_chunk(chunk_hash):
+            async with semaphore:
+                delivered[chunk_hash] = await m.deploy(
+                    gamespace_id, chunks.chunk_path(chunk_hash), "chunks", chunk_hash)
+
+        results = await asyncio.gather(*[deploy_chunk(chunk_hash) for chunk_hash in pending], return_exceptions=True)
+
+        try:
+            await chunks.update_chunks_urls(gamespace_id, app_id, delivered)
+        except ChunkError as e:
+            raise DeploymentError(e.message)
+
+        errors = [result for result in results if isinstance(result, Exception)]
+
+        if errors:
+            raise DeploymentError("Failed to deploy {0} chunk(s): {1}".format(len(errors), str(errors[0])))
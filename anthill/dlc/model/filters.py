@@ -0,0 +1,397 @@
+
+"""
+In-memory evaluation of the bundle filters. Mirrors what `format_conditions_json('bundle_filters', env)`
+does in MySQL, so a client `env` selects the same bundles of a manifest snapshot as it would in the database.
+"""
+
+from bisect import bisect_left, bisect_right
+
+import json
+import re
+
+
+class FilterError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+MISSING = object()
+NUMBER_PREFIX = re.compile(r"\s*[+-]?(\d+(\.\d*)?|\.\d+)([eE][+-]?\d+)?")
+
+
+def extract(filters, path):
+    """
+    Same as JSON_EXTRACT, returns MISSING (NULL) if the path does not exist
+    """
+    value = filters
+    for key in path:
+        if not isinstance(value, dict) or key not in value:
+            return MISSING
+        value = value[key]
+    return value
+
+
+def unquote(value):
+    """
+    Same as CAST(JSON_UNQUOTE(...) AS CHAR) in a case insensitive collation
+    """
+    if isinstance(value, str):
+        text = value
+    elif isinstance(value, bool):
+        text = "true" if value else "false"
+    elif value is None:
+        text = "null"
+    elif isinstance(value, (int, float)):
+        text = str(value)
+    else:
+        text = json.dumps(value)
+    return text.rstrip(" ").lower()
+
+
+def to_number(value):
+    """
+    Same as MySQL does when a JSON_UNQUOTE'd string is compared with a number
+    """
+    if isinstance(value, bool) or value is None:
+        return 0
+    if isinstance(value, (int, float)):
+        return value
+    if not isinstance(value, str):
+        return 0
+    m = NUMBER_PREFIX.match(value)
+    if not m:
+        return 0
+    return float(m.group(0))
+
+
+def json_equal(value, expected):
+    """
+    Same as JSON_EXTRACT(...) = %s, the compared value is converted to JSON first
+    """
+    if isinstance(expected, str):
+        return isinstance(value, str) and value == expected
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return False
+    return value == expected
+
+
+def format_path(path):
+    return tuple(path.split("."))
+
+
+class Condition(object):
+    EQUAL = "="
+    GREATER = ">"
+    LESS = "<"
+    GREATER_OR_EQUAL = ">="
+    LESS_OR_EQUAL = "<="
+    NOT_EQUAL = "!="
+    BETWEEN = "between"
+    IN = "in"
+
+    def __init__(self, func, path, values):
+        self.func = func
+        self.path = path
+        self.values = values
+
+    def matches(self, filters):
+        value = extract(filters, self.path)
+
+        if value is MISSING:
+            return False
+
+        func = self.func
+
+        if func == Condition.EQUAL:
+            return unquote(value) == self.values[0]
+        if func == Condition.IN:
+            return any(json_equal(value, expected) for expected in self.values)
+
+        number = to_number(value)
+
+        if func == Condition.GREATER:
+            return number > self.values[0]
+        if func == Condition.LESS:
+            return number < self.values[0]
+        if func == Condition.GREATER_OR_EQUAL:
+            return number >= self.values[0]
+        if func == Condition.LESS_OR_EQUAL:
+            return number <= self.values[0]
+        if func == Condition.NOT_EQUAL:
+            return number != self.values[0]
+        if func == Condition.BETWEEN:
+            return self.values[0] <= number <= self.values[1]
+
+        return False
+
+
+def __value__(obj):
+    if "@value" not in obj:
+        raise FilterError("Value not passed")
+    return obj["@value"]
+
+
+def __number__(value, message="Bad value"):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise FilterError(message)
+    return value
+
+
+def __equal__(path, obj):
+    value = __value__(obj)
+    if not isinstance(value, (str, int, float, bool)):
+        raise FilterError("Bad value")
+    return Condition(Condition.EQUAL, format_path(path), [unquote(str(value))])
+
+
+def __compare__(func):
+    def parse(path, obj):
+        return Condition(func, format_path(path), [__number__(__value__(obj))])
+    return parse
+
+
+def __between__(path, obj):
+    if "@a" not in obj:
+        raise FilterError("@a is not passed")
+    if "@b" not in obj:
+        raise FilterError("@b is not passed")
+
+    return Condition(Condition.BETWEEN, format_path(path), [
+        __number__(obj["@a"], "Bad @a value"),
+        __number__(obj["@b"], "Bad @b value")])
+
+
+def __in__(path, obj):
+    if "@values" not in obj:
+        raise FilterError("@values is not passed")
+
+    values = obj["@values"]
+
+    if not isinstance(values, list):
+        raise FilterError("@values should be a list")
+
+    if not values:
+        raise FilterError("Empty @values")
+
+    for value in values:
+        if not isinstance(value, (str, int, float, bool)):
+            raise FilterError("Bad @value")
+
+    # unlike other conditions, the path is not split by dots here
+    return Condition(Condition.IN, (path,), [
+        int(value) if isinstance(value, bool) else value
+        for value in values])
+
+
+FUNCTIONS = {
+    Condition.EQUAL: __equal__,
+    Condition.GREATER: __compare__(Condition.GREATER),
+    Condition.LESS: __compare__(Condition.LESS),
+    Condition.GREATER_OR_EQUAL: __compare__(Condition.GREATER_OR_EQUAL),
+    Condition.LESS_OR_EQUAL: __compare__(Condition.LESS_OR_EQUAL),
+    Condition.NOT_EQUAL: __compare__(Condition.NOT_EQUAL),
+    Condition.BETWEEN: __between__,
+    Condition.IN: __in__
+}
+
+
+def parse_condition(path, obj):
+    if isinstance(obj, bool):
+        return __equal__(path, {"@value": "true" if obj else "false"})
+
+    if isinstance(obj, (str, float, int)):
+        return __equal__(path, {"@value": obj})
+
+    # if the value is the list, assume it's in_set @func
+    if isinstance(obj, list):
+        return __in__(path, {"@values": obj})
+
+    if isinstance(obj, dict):
+        if "@func" in obj:
+            func = obj["@func"]
+
+            if func not in FUNCTIONS:
+                raise FilterError("Not allowed condition!")
+
+            return FUNCTIONS[func](path, obj)
+
+    raise FilterError("Bad value!")
+
+
+def parse_conditions(env):
+    """
+    Parses a client `env` into a list of conditions, every one of them should match
+    """
+    if not isinstance(env, dict):
+        raise FilterError("Conditions expected to be a dict")
+
+    return [parse_condition(path, value) for path, value in env.items()]
+
+
+def matches(filters, conditions):
+    return all(condition.matches(filters) for condition in conditions)
+
+
+def scheme_paths(scheme, prefix=()):
+    """
+    Lists paths of every leaf property of a filters scheme (a JSON schema)
+    """
+    properties = scheme.get("properties") if isinstance(scheme, dict) else None
+
+    if not isinstance(properties, dict):
+        if prefix:
+            yield prefix
+        return
+
+    for name, prop in properties.items():
+        yield from scheme_paths(prop, prefix + (name,))
+
+
+def to_mask(bits, size):
+    """
+    Turns a list of bit numbers into a bitset, in a linear time
+    """
+    mask = bytearray((size + 7) >> 3)
+    for bit in bits:
+        mask[bit >> 3] |= 1 << (bit & 7)
+    return int.from_bytes(mask, "little")
+
+
+class PathIndex(object):
+    """
+    Bitsets (python ints, bit N stands for the bundle N) of every value a path has across the bundles
+    """
+
+    def __init__(self, filters, path):
+        present = []
+        text = {}
+        json_values = {}
+        by_number = {}
+
+        for bit, bundle_filters in enumerate(filters):
+            value = extract(bundle_filters, path)
+
+            if value is MISSING:
+                continue
+
+            present.append(bit)
+            text.setdefault(unquote(value), []).append(bit)
+
+            # strings and numbers never collide as keys, while 1 and 1.0 do, just like in JSON
+            if isinstance(value, str) or (isinstance(value, (int, float)) and not isinstance(value, bool)):
+                json_values.setdefault(value, []).append(bit)
+
+            by_number.setdefault(to_number(value), []).append(bit)
+
+        size = len(filters)
+
+        self.present = to_mask(present, size)
+        self.text = {key: to_mask(bits, size) for key, bits in text.items()}
+        self.json = {key: to_mask(bits, size) for key, bits in json_values.items()}
+        self.by_number = {key: to_mask(bits, size) for key, bits in by_number.items()}
+
+        self.numbers = None
+        self.prefix = None
+
+    def __below__(self, value, inclusive):
+        if self.numbers is None:
+            # compiled upon first comparison, prefix[i] is a bitset of bundles having i smallest numbers
+            self.numbers = sorted(self.by_number.keys())
+            self.prefix = [0]
+
+            prefix = 0
+            for number in self.numbers:
+                prefix |= self.by_number[number]
+                self.prefix.append(prefix)
+
+        return self.prefix[(bisect_right if inclusive else bisect_left)(self.numbers, value)]
+
+    def select(self, condition):
+        func = condition.func
+        values = condition.values
+
+        if func == Condition.EQUAL:
+            return self.text.get(values[0], 0)
+        if func == Condition.IN:
+            mask = 0
+            for value in values:
+                mask |= self.json.get(value, 0)
+            return mask
+        if func == Condition.GREATER:
+            return self.present ^ self.__below__(values[0], True)
+        if func == Condition.LESS:
+            return self.__below__(values[0], False)
+        if func == Condition.GREATER_OR_EQUAL:
+            return self.present ^ self.__below__(values[0], False)
+        if func == Condition.LESS_OR_EQUAL:
+            return self.__below__(values[0], True)
+        if func == Condition.NOT_EQUAL:
+            return self.present ^ self.by_number.get(values[0], 0)
+        if func == Condition.BETWEEN:
+            if values[0] > values[1]:
+                return 0
+            return self.__below__(values[1], True) ^ self.__below__(values[0], False)
+
+        return 0
+
+
+class FilterIndex(object):
+    """
+    Bundle filters compiled into bitsets once, so a set of conditions resolves into a set of bundles
+    with a few bitwise ANDs instead of evaluating every condition on every bundle.
+
+    Paths of the application's filters scheme are compiled upfront, any other path upon first use.
+    """
+
+    # paths come from the clients, so do not let them to grow the index indefinitely
+    MAX_PATHS = 256
+
+    def __init__(self, filters, scheme=None):
+        self.filters = filters
+        self.all = (1 << len(filters)) - 1
+        self.paths = {}
+
+        if scheme:
+            for path in scheme_paths(scheme):
+                self.paths[path] = PathIndex(self.filters, path)
+
+    def path(self, path):
+        index = self.paths.get(path)
+
+        if index is None:
+            index = PathIndex(self.filters, path)
+            if len(self.paths) < FilterIndex.MAX_PATHS:
+                self.paths[path] = index
+
+        return index
+
+    def select(self, conditions):
+        """
+        Returns a bitset of the bundles matching all of the conditions
+        """
+        mask = self.all
+
+        for condition in conditions:
+            if not mask:
+                break
+            mask &= self.path(condition.path).select(condition)
+
+        return mask
+
+    @staticmethod
+    def bits(mask):
+        """
+        Lists numbers of the set bits of the mask, in ascending order
+        """
+        mask = bin(mask)[:1:-1]
+        result = []
+        bit = mask.find("1")
+
+        while bit >= 0:
+            result.append(bit)
+            bit = mask.find("1", bit + 1)
+
+        return result
@@ -0,0 +1,74 @@
+
+from anthill.common.model import Model
+from anthill.common.database import DatabaseError
+
+import logging
+
+
+class IndexedModel(Model):
+    """
+    A model that also makes sure its tables have certain indexes (and columns), so they are added to
+    the tables created before the indexes were introduced.
+
+    Each index is described in sql/<index_name>.sql (usually an ALTER TABLE ... ADD INDEX),
+    each column in sql/<table_name>_<column_name>.sql (an ALTER TABLE ... ADD COLUMN)
+    """
+
+    def get_setup_indexes(self):
+        """
+        :return: A list of (table_name, index_name) tuples
+        """
+        return []
+
+    def get_setup_columns(self):
+        """
+        :return: A list of (table_name, column_name) tuples
+        """
+        return []
+
+    async def __setup_column__(self, table_name, column_name, application):
+        columns = await self.get_setup_db().get(
+            """
+                SHOW COLUMNS FROM `{0}` WHERE `Field`=%s;
+            """.format(table_name), column_name)
+
+        if columns:
+            return
+
+        with (open(application.module_path("sql/{0}_{1}.sql".format(table_name, column_name)))) as f:
+            sql = f.read()
+
+        try:
+            await self.get_setup_db().execute(sql)
+        except DatabaseError as e:
+            logging.error("Failed to add column '{0}' to '{1}': {2}".format(column_name, table_name, e.args[1]))
+        else:
+            logging.warning("Added column '{0}' to '{1}'".format(column_name, table_name))
+
+    async def __setup_index__(self, table_name, index_name, application):
+        indexes = await self.get_setup_db().get(
+            """
+                SHOW INDEX FROM `{0}` WHERE `Key_name`=%s;
+            """.format(table_name), index_name)
+
+        if indexes:
+            return
+
+        with (open(application.module_path("sql/{0}.sql".format(index_name)))) as f:
+            sql = f.read()
+
+        try:
+            await self.get_setup_db().execute(sql)
+        except DatabaseError as e:
+            logging.error("Failed to create index '{0}' on '{1}': {2}".format(index_name, table_name, e.args[1]))
+        else:
+            logging.warning("Created index '{0}' on '{1}'".format(index_name, table_name))
+
+    async def started(self, application):
+        await super(IndexedModel, self).started(application)
+
+        for table_name, column_name in self.get_setup_columns():
+            await self.__setup_column__(table_name, column_name, application)
+
+        for table_name, index_name in self.get_setup_indexes():
+            await self.__setup_index__(table_name, index_name, application)
@@ -0,0 +1,236 @@
+
+from tornado.ioloop import IOLoop
+from tornado.locks import Semaphore
+
+from anthill.common.database import DatabaseError
+from anthill.common.model import Model
+from anthill.common.options import options
+
+from . bundle import BundlesModel, BundleAdapter
+
+from concurrent.futures import ProcessPoolExecutor
+
+import asyncio
+import logging
+import mmap
+import os
+import time
+
+
+class IntegrityError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+STATUS_OK = "OK"
+STATUS_MISSING = "MISSING"
+STATUS_TRUNCATED = "TRUNCATED"
+STATUS_CORRUPTED = "CORRUPTED"
+
+BLOCK_SIZE = 1048576
+
+
+def check_file(path, expected_size, expected_hash, rate=0):
+    """
+    Runs in a separate process: hashes a file through a memory mapping, reading no faster than `rate`
+    bytes per second (if set). Returns a (status, size) tuple.
+    """
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return STATUS_MISSING, 0
+
+    if size != expected_size:
+        return STATUS_TRUNCATED, size
+
+    h = BundlesModel.HASH_METHOD()
+
+    if size:
+        started = time.monotonic()
+
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+
+            try:
+                for offset in range(0, size, BLOCK_SIZE):
+                    h.update(view[offset:offset + BLOCK_SIZE])
+
+                    if rate:
+                        # sleep until the average speed is back under the rate
+                        ahead = (offset + BLOCK_SIZE) / rate - (time.monotonic() - started)
+                        if ahead > 0:
+                            time.sleep(ahead)
+            finally:
+                view.release()
+
+    if h.hexdigest() != expected_hash:
+        return STATUS_CORRUPTED, size
+
+    return STATUS_OK, size
+
+
+class IntegrityChecker(object):
+    """
+    Checks presence, size and hash of many files at once, in a pool of processes
+    """
+
+    def __init__(self, processes, rate=0):
+        self.processes = max(1, processes)
+        self.rate = rate
+        self.executor = None
+
+    async def check(self, files):
+        """
+        Checks a list of (key, path, size, hash) tuples, returns a list of (key, status, actual_size)
+        for every file that failed the check
+        """
+
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.processes)
+
+        # the rate is shared among the processes
+        rate = self.rate // self.processes if self.rate else 0
+
+        # no point to queue up more than the processes could take
+        semaphore = Semaphore(self.processes * 2)
+
+        async def check(key, path, size, expected_hash):
+            async with semaphore:
+                status, actual_size = await IOLoop.current().run_in_executor(
+                    self.executor, check_file, path, size, expected_hash, rate)
+            return key, status, actual_size
+
+        results = await asyncio.gather(*[check(*f) for f in files])
+        return [result for result in results if result[1] != STATUS_OK]
+
+
+class ScrubberModel(Model):
+    """
+    Continuously walks over every uploaded bundle (by gamespace and application) and checks its file still
+    matches the size and the hash in the database. Problems are logged and kept in `self.problems`.
+    Hashing is throttled (see scrub_rate) so it could run on production nodes.
+    """
+
+    BATCH_SIZE = 100
+
+    def __init__(self, bundles, db):
+        self.bundles = bundles
+        self.db = db
+        self.enabled = options.scrub_bundles
+        self.interval = options.scrub_interval
+        self.checker = IntegrityChecker(options.scrub_processes, options.scrub_rate)
+        self.application = None
+        self.problems = {}
+
+    def get_setup_db(self):
+        return self.db
+
+    async def started(self, application):
+        await super(ScrubberModel, self).started(application)
+
+        self.application = application
+
+        if self.enabled:
+            IOLoop.current().spawn_callback(self.__scrub_loop__)
+
+    async def __scrub_loop__(self):
+        while True:
+            try:
+                await self.scrub()
+            except Exception:
+                logging.exception("Failed to scrub bundles")
+
+            await asyncio.sleep(self.interval)
+
+    async def __list_apps__(self):
+        try:
+            apps = await self.db.query(
+                """
+                SELECT DISTINCT `gamespace_id`, `application_name`
+                FROM `datas`
+                ORDER BY `gamespace_id`, `application_name`;
+                """)
+        except DatabaseError as e:
+            raise IntegrityError("Failed to list applications: " + e.args[1])
+
+        return [(app["gamespace_id"], app["application_name"]) for app in apps]
+
+    async def __list_bundles__(self, gamespace_id, app_id, after_bundle_id):
+        try:
+            bundles = await self.db.query(
+                """
+                SELECT *
+                FROM `bundles`
+                WHERE `gamespace_id`=%s AND `bundle_id`>%s AND `bundle_status` IN (%s, %s)
+                    AND `bundle_id` IN (
+                        SELECT `data_bundles`.`bundle_id`
+                        FROM `data_bundles`, `datas`
+                        WHERE `datas`.`data_id`=`data_bundles`.`data_id` AND `datas`.`application_name`=%s)
+                ORDER BY `bundle_id` ASC
+                LIMIT %s;
+                """, gamespace_id, after_bundle_id, BundlesModel.STATUS_UPLOADED, BundlesModel.STATUS_DELIVERED,
+                app_id, ScrubberModel.BATCH_SIZE)
+        except DatabaseError as e:
+            raise IntegrityError("Failed to list bundles: " + e.args[1])
+
+        return list(map(BundleAdapter, bundles))
+
+    async def scrub_application(self, gamespace_id, app_id):
+        """
+        Checks every uploaded bundle of the application, returns a list of (bundle, status, actual_size)
+        """
+
+        problems = []
+        after_bundle_id = 0
+
+        while True:
+            bundles = await self.__list_bundles__(gamespace_id, app_id, after_bundle_id)
+
+            if not bundles:
+                break
+
+            after_bundle_id = bundles[-1].bundle_id
+
+            paths = await self.bundles.bundle_paths(app_id, bundles)
+
+            problems.extend(await self.checker.check([
+                (bundle, path, bundle.size, bundle.hash)
+                for bundle, path in zip(bundles, paths)
+            ]))
+
+            if len(bundles) < ScrubberModel.BATCH_SIZE:
+                break
+
+        return problems
+
+    async def scrub(self):
+        started = IOLoop.current().time()
+        checked_apps = 0
+        total = {}
+
+        for gamespace_id, app_id in await self.__list_apps__():
+            problems = await self.scrub_application(gamespace_id, app_id)
+            checked_apps += 1
+
+            for bundle, status, actual_size in problems:
+                total[status] = total.get(status, 0) + 1
+                logging.error("Bundle {0} ('{1}' of app '{2}' in gamespace {3}) is {4}: expected {5} bytes, "
+                              "got {6}".format(bundle.bundle_id, bundle.name, app_id, gamespace_id,
+                                               status.lower(), bundle.size, actual_size))
+
+            self.problems[(gamespace_id, app_id)] = [
+                (bundle.bundle_id, status, actual_size)
+                for bundle, status, actual_size in problems
+            ]
+
+        if self.application is not None:
+            self.application.monitor_action("bundle_scrub", values={
+                "time": IOLoop.current().time() - started,
+                "apps": checked_apps,
+                "missing": total.get(STATUS_MISSING, 0),
+                "truncated": total.get(STATUS_TRUNCATED, 0),
+                "corrupted": total.get(STATUS_CORRUPTED, 0)
+            })
@@ -0,0 +1,216 @@
+
+from anthill.common.database import DatabaseError
+from anthill.common.model import Model
+
+import uuid
+
+
+class JobError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+class JobAdapter(object):
+    def __init__(self, data):
+        self.job_id = data["job_id"]
+        self.gamespace_id = data["gamespace_id"]
+        self.data_id = data["data_id"]
+        self.status = data["job_status"]
+        self.lease_owner = data["job_lease_owner"]
+        self.attempts = data["job_attempts"]
+        self.progress = data["job_progress"]
+        self.total = data["job_total"]
+
+
+class PublishJobsModel(Model):
+    """
+    A persistent queue of data versions to publish. A job is claimed by a worker (on any node) with a lease,
+    that is renewed while the job is being processed. If the node dies, the lease expires and the job is claimed
+    again by someone else, at most `max_attempts` times.
+    """
+
+    STATUS_QUEUED = "QUEUED"
+    STATUS_RUNNING = "RUNNING"
+    STATUS_DONE = "DONE"
+    STATUS_FAILED = "FAILED"
+
+    def __init__(self, db, lease_time=60, max_attempts=5):
+        self.db = db
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+
+    def get_setup_db(self):
+        return self.db
+
+    def get_setup_tables(self):
+        return ["publish_jobs"]
+
+    async def enqueue(self, gamespace_id, data_id):
+        try:
+            await self.db.execute(
+                """
+                INSERT INTO `publish_jobs`
+                (`gamespace_id`, `data_id`, `job_status`)
+                VALUES (%s, %s, %s)
+                ON DUPLICATE KEY UPDATE `job_status`=VALUES(`job_status`), `job_lease_owner`=NULL,
+                    `job_lease_until`=NULL, `job_attempts`=0, `job_progress`=0, `job_total`=0;
+                """, gamespace_id, data_id, PublishJobsModel.STATUS_QUEUED)
+        except DatabaseError as e:
+            raise JobError("Failed to enqueue publishing: " + e.args[1])
+
+    async def recover(self, publishing_status):
+        """
+        Enqueues every data version stuck in the publishing status without a job
+        """
+
+        try:
+            await self.db.execute(
+                """
+                INSERT IGNORE INTO `publish_jobs`
+                (`gamespace_id`, `data_id`, `job_status`)
+                SELECT `datas`.`gamespace_id`, `datas`.`data_id`, %s
+                FROM `datas`
+                WHERE `datas`.`version_status`=%s AND `datas`.`data_id` NOT IN (
+                    SELECT `publish_jobs`.`data_id` FROM `publish_jobs`);
+                """, PublishJobsModel.STATUS_QUEUED, publishing_status)
+        except DatabaseError as e:
+            raise JobError("Failed to recover publish jobs: " + e.args[1])
+
+    async def claim(self):
+        """
+        Claims a queued job, or a running one with the lease expired (its worker has died).
+        Returns None if there's nothing to do.
+        """
+
+        owner = uuid.uuid4().hex
+
+        try:
+            await self.db.execute(
+                """
+                UPDATE `publish_jobs`
+                SET `job_status`=%s, `job_lease_owner`=%s,
+                    `job_lease_until`=DATE_ADD(NOW(), INTERVAL %s SECOND), `job_attempts`=`job_attempts`+1
+                WHERE `job_status` IN (%s, %s) AND (`job_lease_until` IS NULL OR `job_lease_until`<NOW())
+                ORDER BY `job_id` ASC
+                LIMIT 1;
+                """, PublishJobsModel.STATUS_RUNNING, owner, self.lease_time,
+                PublishJobsModel.STATUS_QUEUED, PublishJobsModel.STATUS_RUNNING)
+
+            job = await self.db.get(
+                """
+                SELECT *
+                FROM `publish_jobs`
+                WHERE `job_lease_owner`=%s;
+                """, owner)
+        except DatabaseError as e:
+            raise JobError("Failed to claim a job: " + e.args[1])
+
+        if not job:
+            return None
+
+        return JobAdapter(job)
+
+    async def renew(self, job, progress=None, total=None):
+        """
+        Extends the lease of the job (optionally, writes down its progress).
+        Returns False if the job is not owned by the worker anymore (the lease has expired and the job
+        has been claimed by someone else).
+        """
+
+        fields = ["`job_lease_until`=DATE_ADD(NOW(), INTERVAL %s SECOND)"]
+        data = [self.lease_time]
+
+        if progress is not None:
+            fields.append("`job_progress`=%s")
+            data.append(progress)
+
+        if total is not None:
+            fields.append("`job_total`=%s")
+            data.append(total)
+
+        try:
+            renewed = await self.db.execute(
+                """
+                UPDATE `publish_jobs`
+                SET {0}
+                WHERE `job_id`=%s AND `job_lease_owner`=%s;
+                """.format(", ".join(fields)), *data, job.job_id, job.lease_owner)
+        except DatabaseError as e:
+            raise JobError("Failed to renew a job: " + e.args[1])
+
+        return bool(renewed)
+
+    async def release(self, job):
+        """
+        Puts the job back into the queue, for it to be retried.
+        Returns False if the job is not owned by the worker anymore.
+        """
+
+        try:
+            released = await self.db.execute(
+                """
+                UPDATE `publish_jobs`
+                SET `job_status`=%s, `job_lease_owner`=NULL, `job_lease_until`=NULL
+                WHERE `job_id`=%s AND `job_lease_owner`=%s;
+                """, PublishJobsModel.STATUS_QUEUED, job.job_id, job.lease_owner)
+        except DatabaseError as e:
+            raise JobError("Failed to release a job: " + e.args[1])
+
+        return bool(released)
+
+    async def finish(self, job, status, version_status=None, version_status_reason=""):
+        """
+        Marks the job as finished, and (optionally) updates the status of its data version in the same
+        transaction, only if the job is still owned by the worker. Returns False if it is not.
+        """
+
+        try:
+            async with self.db.acquire(auto_commit=False) as db:
+                # the connection goes back to the pool as it is, and the next acquire would commit it
+                try:
+                    finished = await db.execute(
+                        """
+                        UPDATE `publish_jobs`
+                        SET `job_status`=%s, `job_lease_owner`=NULL, `job_lease_until`=NULL
+                        WHERE `job_id`=%s AND `job_lease_owner`=%s;
+                        """, status, job.job_id, job.lease_owner)
+
+                    if not finished:
+                        await db.rollback()
+                        return False
+
+                    if version_status is not None:
+                        await db.execute(
+                            """
+                            UPDATE `datas`
+                            SET `version_status`=%s, `version_status_reason`=%s
+                            WHERE `data_id`=%s AND `gamespace_id`=%s;
+                            """, version_status, version_status_reason[:255], job.data_id, job.gamespace_id)
+
+                    await db.commit()
+                except BaseException:
+                    await db.rollback()
+                    raise
+        except DatabaseError as e:
+            raise JobError("Failed to finish a job: " + e.args[1])
+
+        return True
+
+    async def get_job(self, gamespace_id, data_id):
+        try:
+            job = await self.db.get(
+                """
+                SELECT *
+                FROM `publish_jobs`
+                WHERE `data_id`=%s AND `gamespace_id`=%s;
+                """, data_id, gamespace_id)
+        except DatabaseError as e:
+            raise JobError("Failed to get a job: " + e.args[1])
+
+        if not job:
+            return None
+
+        return JobAdapter(job)
@@ -0,0 +1,67 @@
+
+from . filters import parse_conditions, FilterIndex
+
+
+class ManifestSnapshot(object):
+    """
+    Immutable list of delivered bundles of a published data version, built once upon publishing.
+    Filters of the bundles are compiled into a FilterIndex once the snapshot is loaded.
+    """
+
+    def __init__(self, data_id, bundles, filters_scheme=None):
+        self.data_id = data_id
+        self.bundles = bundles
+        self.index = FilterIndex([bundle["filters"] for bundle in bundles], filters_scheme)
+
+    @staticmethod
+    def dump_bundle(bundle, patches=None, chunks=None):
+        result = {
+            "name": bundle.name,
+            "hash": bundle.hash,
+            "url": bundle.url,
+            "size": bundle.size,
+            "payload": bundle.payload,
+            "filters": bundle.filters
+        }
+
+        if patches:
+            result["patches"] = patches
+
+        # only if every chunk is delivered, otherwise the bundle is downloaded as a whole
+        if chunks and all(chunk["url"] for chunk in chunks):
+            result["chunks"] = chunks
+
+        return result
+
+    @staticmethod
+    def dump_entry(bundle):
+        entry = {
+            "hash": bundle["hash"],
+            "url": bundle["url"],
+            "size": bundle["size"],
+            "payload": bundle["payload"]
+        }
+
+        # {from_hash: {"url": ..., "size": ...}}
+        patches = bundle.get("patches")
+        if patches:
+            entry["patches"] = patches
+
+        # [{"hash": ..., "size": ..., "url": ...}, ...] in order
+        chunks = bundle.get("chunks")
+        if chunks:
+            entry["chunks"] = chunks
+
+        return entry
+
+    def filter(self, env):
+        mask = self.index.select(parse_conditions(env))
+        return [self.bundles[bit] for bit in FilterIndex.bits(mask)]
+
+    def manifest(self, env):
+        return {
+            "bundles": {
+                bundle["name"]: ManifestSnapshot.dump_entry(bundle)
+                for bundle in self.filter(env)
+            }
+        }
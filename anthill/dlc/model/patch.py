@@ -0,0 +1,223 @@
+
+from tornado.ioloop import IOLoop
+
+from anthill.common.database import DatabaseError
+from anthill.common.deployment import DeploymentError
+from anthill.common.model import Model
+from anthill.common.options import options
+
+from . bundle import BundlesModel, BundleAdapter
+
+from concurrent.futures import ProcessPoolExecutor
+
+import asyncio
+import logging
+import os
+
+try:
+    import bsdiff4
+except ImportError:
+    bsdiff4 = None
+
+
+class PatchError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+def make_patch(old_path, new_path, patch_path):
+    """
+    Runs in a separate process: writes a binary delta turning the old file into the new one
+    """
+    directory = os.path.dirname(patch_path)
+    if not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+
+    bsdiff4.file_diff(old_path, new_path, patch_path)
+    return os.path.getsize(patch_path)
+
+
+class PatchesModel(Model):
+    """
+    Binary deltas from the bundle of the same name in the previous published data version (of the same application)
+    to the new one, so the clients having the old bundle could download a patch instead of the whole bundle.
+
+    Deltas are made upon publishing, in a pool of processes, and deployed next to the bundles.
+    A delta that could not be made is simply skipped, the clients can always download the whole bundle.
+    """
+
+    # a patch bigger than that (compared to the bundle) is not worth it
+    MAX_PATCH_RATIO = 0.5
+
+    def __init__(self, bundles, deployment, db):
+        self.bundles = bundles
+        self.deployment = deployment
+        self.db = db
+        self.data_location = options.data_location
+        self.enabled = options.delta_patches
+        self.processes = options.delta_processes
+        self.max_size = options.delta_max_size
+        self.executor = None
+
+        if self.enabled and bsdiff4 is None:
+            logging.warning("Delta patches are disabled: 'bsdiff4' module is not installed")
+            self.enabled = False
+
+    def get_setup_db(self):
+        return self.db
+
+    def get_setup_tables(self):
+        return ["bundle_patches"]
+
+    def patch_path(self, app_id, bundle, previous):
+        return os.path.join(self.data_location, str(app_id), "patches", bundle.get_directory(),
+                            PatchesModel.patch_key(bundle, previous))
+
+    @staticmethod
+    def patch_key(bundle, previous):
+        return "{0}_{1}.patch".format(bundle.get_key(), previous.bundle_id)
+
+    async def find_previous_bundles(self, gamespace_id, previous_data_id, bundles):
+        """
+        Returns a dict of the delivered bundles of the same name from the previous data version,
+        keyed by the bundle id. Bundles not changed since are not included.
+        """
+
+        if not bundles or not previous_data_id:
+            return {}
+
+        names = list(set(bundle.name for bundle in bundles))
+
+        try:
+            previous = await self.db.query(
+                """
+                SELECT `bundles`.*
+                FROM `bundles`, `data_bundles`
+                WHERE `data_bundles`.`data_id`=%s AND `bundles`.`bundle_id`=`data_bundles`.`bundle_id`
+                    AND `bundles`.`gamespace_id`=%s AND `bundles`.`bundle_status`=%s
+                    AND `bundles`.`bundle_name` IN ({0});
+                """.format(", ".join(["%s"] * len(names))),
+                previous_data_id, gamespace_id, BundlesModel.STATUS_DELIVERED, *names)
+        except DatabaseError as e:
+            raise PatchError("Failed to find previous bundles: " + e.args[1])
+
+        previous = {bundle["bundle_name"]: BundleAdapter(bundle) for bundle in previous}
+
+        result = {}
+
+        for bundle in bundles:
+            p = previous.get(bundle.name)
+            if p is not None and p.hash and p.hash != bundle.hash and p.bundle_id != bundle.bundle_id:
+                result[bundle.bundle_id] = p
+
+        return result
+
+    async def __existing__(self, bundle_ids):
+        try:
+            patches = await self.db.query(
+                """
+                SELECT `bundle_id`, `from_hash`
+                FROM `bundle_patches`
+                WHERE `bundle_id` IN ({0});
+                """.format(", ".join(["%s"] * len(bundle_ids))), *bundle_ids)
+        except DatabaseError as e:
+            raise PatchError("Failed to list patches: " + e.args[1])
+
+        return set((patch["bundle_id"], patch["from_hash"]) for patch in patches)
+
+    async def __create_patch__(self, gamespace_id, app_id, bundle, previous):
+        patch_path = self.patch_path(app_id, bundle, previous)
+
+        previous_path, bundle_path = await self.bundles.bundle_paths(app_id, [previous, bundle])
+
+        try:
+            patch_size = await IOLoop.current().run_in_executor(
+                self.executor, make_patch, previous_path, bundle_path, patch_path)
+        except Exception as e:
+            logging.warning("Failed to make a patch for bundle {0}: {1}".format(bundle.bundle_id, str(e)))
+            # could be written partially
+            self.bundles.reclaimer.reclaim([patch_path])
+            return
+
+        try:
+            if patch_size > bundle.size * PatchesModel.MAX_PATCH_RATIO:
+                return
+
+            try:
+                patch_url = await self.deployment.deploy_file(
+                    gamespace_id, app_id, patch_path, "patches", PatchesModel.patch_key(bundle, previous))
+            except DeploymentError as e:
+                logging.warning("Failed to deploy a patch for bundle {0}: {1}".format(bundle.bundle_id, e.message))
+                return
+
+            try:
+                await self.db.insert(
+                    """
+                    INSERT INTO `bundle_patches`
+                    (`gamespace_id`, `bundle_id`, `from_bundle_id`, `from_hash`, `patch_url`, `patch_size`)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                    ON DUPLICATE KEY UPDATE `patch_url`=VALUES(`patch_url`), `patch_size`=VALUES(`patch_size`);
+                    """, gamespace_id, bundle.bundle_id, previous.bundle_id, previous.hash, patch_url, patch_size)
+            except DatabaseError as e:
+                logging.warning("Failed to write a patch for bundle {0}: {1}".format(bundle.bundle_id, e.args[1]))
+        finally:
+            # deployed (or not worth it), the local copy is not needed anymore, removed in the background
+            self.bundles.reclaimer.reclaim([patch_path])
+
+    async def create_patches(self, gamespace_id, app_id, previous_data_id, bundles):
+        """
+        Makes and deploys patches for every bundle of the data version changed since the previous data version
+        (the most recent published one older than this, see DatasModel.find_previous_data_version)
+        """
+
+        if not self.enabled:
+            return
+
+        previous = await self.find_previous_bundles(gamespace_id, previous_data_id, bundles)
+
+        if not previous:
+            return
+
+        existing = await self.__existing__(list(previous.keys()))
+
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.processes)
+
+        await asyncio.gather(*[
+            self.__create_patch__(gamespace_id, app_id, bundle, previous[bundle.bundle_id])
+            for bundle in bundles
+            if bundle.bundle_id in previous and (bundle.bundle_id, previous[bundle.bundle_id].hash) not in existing
+            # diffing loads both files into memory at once
+            and bundle.size <= self.max_size and previous[bundle.bundle_id].size <= self.max_size
+        ])
+
+    async def list_patches(self, gamespace_id, bundle_ids):
+        """
+        Returns {bundle_id: {from_hash: {"url": ..., "size": ...}}}
+        """
+
+        if not bundle_ids:
+            return {}
+
+        try:
+            patches = await self.db.query(
+                """
+                SELECT `bundle_id`, `from_hash`, `patch_url`, `patch_size`
+                FROM `bundle_patches`
+                WHERE `gamespace_id`=%s AND `bundle_id` IN ({0});
+                """.format(", ".join(["%s"] * len(bundle_ids))), gamespace_id, *bundle_ids)
+        except DatabaseError as e:
+            raise PatchError("Failed to list patches: " + e.args[1])
+
+        result = {}
+
+        for patch in patches:
+            result.setdefault(patch["bundle_id"], {})[patch["from_hash"]] = {
+                "url": patch["patch_url"],
+                "size": patch["patch_size"]
+            }
+
+        return result
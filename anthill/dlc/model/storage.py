@@ -0,0 +1,56 @@
+
+import logging
+import os
+
+# the files of the service itself are kept under data_location/@dlc, next to the directories of the applications;
+# an application name could be anything like "blobs", but never has an "@" in it
+STORAGE_DIRECTORY = "@dlc"
+
+AREA_BLOBS = "blobs"
+AREA_CHUNKS = "chunks"
+AREA_UPLOADS = "uploads"
+AREA_IMPORTS = "imports"
+
+AREAS = [AREA_BLOBS, AREA_CHUNKS, AREA_UPLOADS, AREA_IMPORTS]
+
+
+def storage_path(location, area):
+    return os.path.join(location, STORAGE_DIRECTORY, area)
+
+
+def is_legacy_area(path, area):
+    """
+    Tells a storage area (as it used to be kept, straight under data_location) from the directory
+    of an application with the same name. Bundles of an application are kept in single character
+    directories (and patches), blobs and chunks in two character ones, uploads and imports have none.
+    """
+
+    with os.scandir(path) as entries:
+        directories = [entry.name for entry in entries if entry.is_dir(follow_symlinks=False)]
+
+    if area in (AREA_BLOBS, AREA_CHUNKS):
+        return all(len(name) == 2 for name in directories)
+
+    return not directories
+
+
+def move_legacy_areas(location):
+    """
+    Called once upon startup: moves the storage areas kept straight under data_location by the previous
+    versions of the service into STORAGE_DIRECTORY
+    """
+
+    for area in AREAS:
+        legacy = os.path.join(location, area)
+        target = storage_path(location, area)
+
+        if not os.path.isdir(legacy) or not is_legacy_area(legacy, area):
+            continue
+
+        if os.path.exists(target):
+            logging.warning("Both '{0}' and '{1}' exist, please merge them".format(legacy, target))
+            continue
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.rename(legacy, target)
+        logging.info("Moved '{0}' to '{1}'".format(legacy, target))
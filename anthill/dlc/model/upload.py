@@ -0,0 +1,394 @@
+
+from tornado.locks import Lock
+from expiringdict import ExpiringDict
+
+from anthill.common import run_on_executor
+from anthill.common.database import DatabaseError
+from anthill.common.model import Model
+from anthill.common.options import options
+
+from . bundle import BundlesModel, BundleError, NoSuchBundleError
+from . storage import storage_path, AREA_UPLOADS
+
+import logging
+import os
+
+
+class UploadError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+class NoSuchUploadError(Exception):
+    pass
+
+
+class UploadAdapter(object):
+    def __init__(self, data):
+        self.upload_id = data["upload_id"]
+        self.application_name = data["application_name"]
+        self.gamespace_id = data["gamespace_id"]
+        self.bundle_id = data["bundle_id"]
+        self.size = data["upload_size"]
+        self.hash = data["upload_hash"]
+        self.created = data["upload_created"]
+
+    def dump(self):
+        return {
+            "upload_id": str(self.upload_id),
+            "bundle_id": str(self.bundle_id),
+            "size": self.size,
+            "hash": self.hash
+        }
+
+
+def merge_ranges(chunks):
+    """
+    Turns a list of (offset, size) chunks, sorted by offset, into a list of [start, end) ranges
+    """
+    ranges = []
+
+    for offset, size in chunks:
+        end = offset + size
+        if ranges and offset <= ranges[-1][1]:
+            ranges[-1][1] = max(ranges[-1][1], end)
+        else:
+            ranges.append([offset, end])
+
+    return ranges
+
+
+class UploadDigest(object):
+    """
+    A running hash of the contiguous prefix of an upload, [0, offset), advanced as the chunks arrive
+    """
+
+    def __init__(self):
+        self.hash = BundlesModel.HASH_METHOD()
+        self.offset = 0
+        # some chunks past the offset have been written already
+        self.ahead = False
+        self.lock = Lock()
+
+
+class UploadsModel(Model):
+    """
+    Resumable uploads of bundles: an upload session is created for a bundle, then chunks are written
+    at their offsets in any order (and any number of times), and the upload is finalized once every byte
+    is there. Sessions survive a restart, chunks are written straight into a preallocated file.
+
+    The hash is computed while the chunks arrive (see UploadDigest), so finalizing only hashes what is left.
+    The state of a hash cannot leave the process, so if the upload is finalized on another node (or after a restart)
+    the whole file is hashed then.
+    """
+
+    READ_BLOCK_SIZE = 1048576
+
+    def __init__(self, bundles, db):
+        self.bundles = bundles
+        self.db = db
+        self.executor = bundles.executor
+        self.uploads_location = storage_path(options.data_location, AREA_UPLOADS)
+        self.max_chunk_size = options.upload_chunk_max_size
+        self.digests = ExpiringDict(max_len=4096, max_age_seconds=86400)
+
+    def get_setup_db(self):
+        return self.db
+
+    def get_setup_tables(self):
+        return ["bundle_uploads", "bundle_upload_chunks"]
+
+    def upload_path(self, upload_id):
+        return os.path.join(self.uploads_location, "{0}.part".format(upload_id))
+
+    @run_on_executor
+    def __allocate__(self, path, size):
+        if not os.path.exists(self.uploads_location):
+            os.makedirs(self.uploads_location, exist_ok=True)
+
+        with open(path, "wb") as f:
+            f.truncate(size)
+
+    @run_on_executor
+    def __write_chunk__(self, path, offset, data):
+        with open(path, "r+b") as f:
+            os.pwrite(f.fileno(), data, offset)
+
+    @run_on_executor
+    def __digest__(self, path, digest=None):
+        """
+        Hashes the file from the offset of the digest (or from the start), returns the hex digest
+        """
+        if digest is None:
+            digest = UploadDigest()
+
+        with open(path, "rb") as f:
+            f.seek(digest.offset)
+            while True:
+                block = f.read(UploadsModel.READ_BLOCK_SIZE)
+                if not block:
+                    break
+                digest.hash.update(block)
+                digest.offset += len(block)
+
+        return digest.hash.hexdigest()
+
+    @run_on_executor
+    def __update_digest__(self, digest, data):
+        digest.hash.update(data)
+        digest.offset += len(data)
+
+    @run_on_executor
+    def __advance_digest__(self, path, digest, end):
+        with open(path, "rb") as f:
+            f.seek(digest.offset)
+            while digest.offset < end:
+                block = f.read(min(UploadsModel.READ_BLOCK_SIZE, end - digest.offset))
+                if not block:
+                    break
+                digest.hash.update(block)
+                digest.offset += len(block)
+
+    @run_on_executor
+    def __move__(self, path, target):
+        directory = os.path.dirname(target)
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        os.replace(path, target)
+
+    @run_on_executor
+    def __remove__(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    async def create_upload(self, gamespace_id, app_id, data_id, bundle_id, upload_size, upload_hash=None):
+
+        if upload_size < 0:
+            raise UploadError("Bad upload size")
+
+        if upload_size >= 1 << 32:
+            raise UploadError("Bundle is too big")
+
+        if upload_hash is not None:
+            upload_hash = upload_hash.lower()
+            if len(upload_hash) != 64:
+                raise UploadError("Bad sha256 hash")
+
+        try:
+            bundle = await self.bundles.get_bundle(gamespace_id, bundle_id, data_id)
+        except NoSuchBundleError:
+            raise UploadError("No such bundle")
+        except BundleError as e:
+            raise UploadError(e.message)
+
+        if bundle.status == BundlesModel.STATUS_DELIVERED:
+            raise UploadError("Cannot upload bundle that is already published.")
+
+        try:
+            upload_id = await self.db.insert(
+                """
+                INSERT INTO `bundle_uploads`
+                (`gamespace_id`, `application_name`, `bundle_id`, `upload_size`, `upload_hash`)
+                SELECT %s, `datas`.`application_name`, %s, %s, %s
+                FROM `datas`
+                WHERE `datas`.`data_id`=%s AND `datas`.`gamespace_id`=%s AND `datas`.`application_name`=%s;
+                """, gamespace_id, bundle.bundle_id, upload_size, upload_hash, data_id, gamespace_id, app_id)
+        except DatabaseError as e:
+            raise UploadError("Failed to create upload: " + e.args[1])
+
+        if not upload_id:
+            raise UploadError("No such data version")
+
+        try:
+            await self.__allocate__(self.upload_path(upload_id), upload_size)
+        except OSError as e:
+            await self.delete_upload(gamespace_id, upload_id)
+            raise UploadError("Failed to allocate upload: " + str(e))
+
+        return upload_id
+
+    async def get_upload(self, gamespace_id, upload_id):
+        try:
+            upload = await self.db.get(
+                """
+                SELECT *
+                FROM `bundle_uploads`
+                WHERE `upload_id`=%s AND `gamespace_id`=%s;
+                """, upload_id, gamespace_id)
+        except DatabaseError as e:
+            raise UploadError("Failed to get upload: " + e.args[1])
+
+        if not upload:
+            raise NoSuchUploadError()
+
+        return UploadAdapter(upload)
+
+    async def write_chunk(self, gamespace_id, upload_id, chunk_offset, data):
+        """
+        Writes a chunk at its offset. Writing the same chunk again is fine, so a client may simply retry.
+        """
+
+        upload = await self.get_upload(gamespace_id, upload_id)
+
+        if not data:
+            raise UploadError("Empty chunk")
+
+        if len(data) > self.max_chunk_size:
+            raise UploadError("Chunk is too big, {0} bytes max".format(self.max_chunk_size))
+
+        if chunk_offset < 0 or chunk_offset + len(data) > upload.size:
+            raise UploadError("Chunk is out of the upload")
+
+        try:
+            await self.__write_chunk__(self.upload_path(upload.upload_id), chunk_offset, data)
+        except OSError as e:
+            raise UploadError("Failed to write chunk: " + str(e))
+
+        # only recorded once the data is on the disk, so a chunk listed is always there
+        try:
+            await self.db.execute(
+                """
+                INSERT INTO `bundle_upload_chunks`
+                (`upload_id`, `chunk_offset`, `chunk_size`)
+                VALUES (%s, %s, %s)
+                ON DUPLICATE KEY UPDATE `chunk_size`=GREATEST(`chunk_size`, VALUES(`chunk_size`));
+                """, upload.upload_id, chunk_offset, len(data))
+        except DatabaseError as e:
+            raise UploadError("Failed to write chunk: " + e.args[1])
+
+        try:
+            await self.__hash_chunk__(upload, chunk_offset, data)
+        except OSError as e:
+            # the upload would simply be hashed at once on finalize
+            self.digests.pop(upload.upload_id, None)
+            logging.warning("Failed to hash upload {0}: {1}".format(upload.upload_id, str(e)))
+
+    async def __hash_chunk__(self, upload, chunk_offset, data):
+        """
+        Advances the running hash of the upload over the contiguous prefix
+        """
+
+        digest = self.digests.get(upload.upload_id)
+
+        if digest is None:
+            if chunk_offset != 0:
+                # the upload has started somewhere else, or before a restart
+                return
+            digest = UploadDigest()
+            self.digests[upload.upload_id] = digest
+
+        async with digest.lock:
+            if chunk_offset < digest.offset:
+                # the data already hashed could have changed, so the hash is no good anymore
+                self.digests.pop(upload.upload_id, None)
+                return
+
+            if chunk_offset > digest.offset:
+                digest.ahead = True
+                return
+
+            # the chunks arrive in order, the data is hashed as it is
+            await self.__update_digest__(digest, data)
+
+            if not digest.ahead:
+                return
+
+            # the chunks written ahead before are right after the hashed prefix now
+            upload, ranges = await self.list_ranges(upload.gamespace_id, upload.upload_id)
+
+            if ranges and ranges[0][0] == 0 and ranges[0][1] > digest.offset:
+                await self.__advance_digest__(self.upload_path(upload.upload_id), digest, ranges[0][1])
+
+            digest.ahead = len(ranges) > 1
+
+    async def list_ranges(self, gamespace_id, upload_id):
+        """
+        Returns the upload and a list of [start, end) ranges of the data already uploaded
+        """
+
+        upload = await self.get_upload(gamespace_id, upload_id)
+
+        try:
+            chunks = await self.db.query(
+                """
+                SELECT `chunk_offset`, `chunk_size`
+                FROM `bundle_upload_chunks`
+                WHERE `upload_id`=%s
+                ORDER BY `chunk_offset` ASC;
+                """, upload.upload_id)
+        except DatabaseError as e:
+            raise UploadError("Failed to list upload chunks: " + e.args[1])
+
+        return upload, merge_ranges((chunk["chunk_offset"], chunk["chunk_size"]) for chunk in chunks)
+
+    async def finalize_upload(self, gamespace_id, upload_id):
+        """
+        Checks every byte is uploaded and the hash matches, then replaces the bundle file atomically
+        """
+
+        upload, ranges = await self.list_ranges(gamespace_id, upload_id)
+
+        if upload.size and ranges != [[0, upload.size]]:
+            raise UploadError("Upload is not complete")
+
+        try:
+            bundle = await self.bundles.get_bundle(gamespace_id, upload.bundle_id)
+        except NoSuchBundleError:
+            raise UploadError("No such bundle")
+        except BundleError as e:
+            raise UploadError(e.message)
+
+        if bundle.status == BundlesModel.STATUS_DELIVERED:
+            raise UploadError("Cannot upload bundle that is already published.")
+
+        path = self.upload_path(upload.upload_id)
+        digest = self.digests.pop(upload.upload_id, None)
+
+        try:
+            if digest is not None:
+                async with digest.lock:
+                    # only the data not hashed while uploading is read
+                    bundle_hash = await self.__digest__(path, digest)
+            else:
+                bundle_hash = await self.__digest__(path)
+        except OSError as e:
+            raise UploadError("Failed to read upload: " + str(e))
+
+        if upload.hash and upload.hash != bundle_hash:
+            raise UploadError("Hash mismatch, the upload is corrupted")
+
+        bundle_file = self.bundles.upload_path(upload.application_name, bundle)
+
+        try:
+            await self.__move__(path, bundle_file)
+        except OSError as e:
+            raise UploadError("Failed to store upload: " + str(e))
+
+        try:
+            await self.bundles.complete_upload(
+                gamespace_id, upload.application_name, bundle.bundle_id, bundle_file, bundle_hash, upload.size)
+        except BundleError as e:
+            raise UploadError(e.message)
+
+        await self.delete_upload(gamespace_id, upload.upload_id)
+
+        return bundle_hash
+
+    async def delete_upload(self, gamespace_id, upload_id):
+        try:
+            await self.db.execute(
+                """
+                DELETE FROM `bundle_uploads`
+                WHERE `upload_id`=%s AND `gamespace_id`=%s;
+                """, upload_id, gamespace_id)
+        except DatabaseError as e:
+            raise UploadError("Failed to delete upload: " + e.args[1])
+
+        self.digests.pop(upload_id, None)
+        await self.__remove__(self.upload_path(upload_id))
@@ -106,4 +106,244 @@ else:
            default="http://dlc-dev.anthill/download/",
            help="DLC content prefix URL",
            group="dlc",
-           type=str)
\ No newline at end of file
+           type=str)
+
+# Manifest cache
+
+define("manifest_cache_size",
+       default=4096,
+       help="Maximum number of /data manifests kept in memory of each process",
+       group="dlc",
+       type=int)
+
+define("manifest_cache_ttl",
+       default=300,
+       help="Maximum time (in seconds) a /data manifest is kept in memory of each process",
+       group="dlc",
+       type=int)
+
+define("manifest_cache_shared_ttl",
+       default=3600,
+       help="Time (in seconds) a /data manifest is kept in the regular cache (redis), shared across the nodes",
+       group="dlc",
+       type=int)
+
+define("manifest_cache_generation_interval",
+       default=2,
+       help="How often (in seconds) a node re-checks if manifests of an application were invalidated by another node",
+       group="dlc",
+       type=int)
+
+define("manifest_snapshots_cache_size",
+       default=16,
+       help="Maximum number of published data version snapshots kept in memory of each process",
+       group="dlc",
+       type=int)
+
+# Bundle storage
+
+define("content_addressed_storage",
+       default=False,
+       help="Store uploaded bundles by their content hash, so identical bundles share one file and one deployment",
+       group="dlc",
+       type=bool)
+
+define("upload_io_threads",
+       default=4,
+       help="Number of threads writing (and hashing) uploaded bundles, so uploads never block the requests",
+       group="dlc",
+       type=int)
+
+define("upload_write_buffer_size",
+       default=1048576,
+       help="Maximum size (in bytes) of an uploaded data buffered in memory while the previous write is in progress",
+       group="dlc",
+       type=int)
+
+define("upload_buffer_size",
+       default=8388608,
+       help="Maximum size (in bytes) of an upload received but not yet written, reading of the request waits beyond that",
+       group="dlc",
+       type=int)
+
+define("upload_chunk_max_size",
+       default=16777216,
+       help="Maximum size (in bytes) of a single chunk of a resumable upload",
+       group="dlc",
+       type=int)
+
+define("import_concurrency",
+       default=4,
+       help="Number of files of an imported archive written to the disk at the same time",
+       group="dlc",
+       type=int)
+
+# Delta patches
+
+define("delta_patches",
+       default=False,
+       help="Make binary patches from the previous version of a bundle upon publishing (requires bsdiff4)",
+       group="dlc",
+       type=bool)
+
+define("delta_processes",
+       default=2,
+       help="Number of processes making the binary patches",
+       group="dlc",
+       type=int)
+
+define("delta_max_size",
+       default=268435456,
+       help="No patches for the bundles bigger than that (in bytes), a process making a patch holds both "
+            "versions of the bundle in memory, and a lot more while diffing",
+       group="dlc",
+       type=int)
+
+# Chunked bundles
+
+define("chunked_bundles",
+       default=False,
+       help="Split uploaded bundles into content defined chunks, so the clients could download only the chunks they lack",
+       group="dlc",
+       type=bool)
+
+define("chunk_min_size",
+       default=262144,
+       help="Minimum size (in bytes) of a bundle chunk",
+       group="dlc",
+       type=int)
+
+define("chunk_avg_size",
+       default=1048576,
+       help="Average size (in bytes) of a bundle chunk",
+       group="dlc",
+       type=int)
+
+define("chunk_max_size",
+       default=4194304,
+       help="Maximum size (in bytes) of a bundle chunk",
+       group="dlc",
+       type=int)
+
+define("chunk_processes",
+       default=2,
+       help="Number of processes splitting the bundles into chunks",
+       group="dlc",
+       type=int)
+
+define("chunk_max_bundle_size",
+       default=1073741824,
+       help="Bundles bigger than that (in bytes) are not split, and downloaded as a whole. A process splits "
+            "around 100MB a second with numpy installed (the 'chunks' extra), and only a few MB without it",
+       group="dlc",
+       type=int)
+
+# Downloads
+
+define("serve_downloads",
+       default=False,
+       help="Serve the deployed files from data_runtime_location at /download/ (see data_host_location)",
+       group="dlc",
+       type=bool)
+
+# Integrity
+
+define("scrub_bundles",
+       default=False,
+       help="Continuously check the files of the uploaded bundles still match their size and hash",
+       group="dlc",
+       type=bool)
+
+define("scrub_interval",
+       default=3600,
+       help="Time (in seconds) between the bundle checks",
+       group="dlc",
+       type=int)
+
+define("scrub_processes",
+       default=1,
+       help="Number of processes hashing the bundles upon the checks",
+       group="dlc",
+       type=int)
+
+define("scrub_rate",
+       default=33554432,
+       help="Maximum speed (in bytes per second, 0 for unlimited) the files are read at upon the checks",
+       group="dlc",
+       type=int)
+
+define("verify_before_publish",
+       default=False,
+       help="Check presence, size and hash of every bundle file before a data version gets deployed",
+       group="dlc",
+       type=bool)
+
+define("verify_processes",
+       default=4,
+       help="Number of processes hashing the bundles before a data version gets deployed",
+       group="dlc",
+       type=int)
+
+# Publishing
+
+define("publish_workers",
+       default=1,
+       help="Number of data versions this node publishes at the same time",
+       group="dlc",
+       type=int)
+
+define("publish_job_poll_interval",
+       default=5,
+       help="Time (in seconds) between checks for publish jobs queued by the other nodes",
+       group="dlc",
+       type=int)
+
+define("publish_job_lease",
+       default=60,
+       help="Time (in seconds) a publish job stays claimed by a node without a heartbeat",
+       group="dlc",
+       type=int)
+
+define("publish_job_max_attempts",
+       default=5,
+       help="Number of times a publish job is retried before the data version is marked as failed",
+       group="dlc",
+       type=int)
+
+# Garbage collection
+
+define("gc_enabled",
+       default=False,
+       help="Look for files in data_location nothing refers to, and for bundles not attached to any data version",
+       group="dlc",
+       type=bool)
+
+define("gc_delete",
+       default=False,
+       help="Delete what the garbage collection finds (otherwise, it is only reported)",
+       group="dlc",
+       type=bool)
+
+define("gc_interval",
+       default=86400,
+       help="Time (in seconds) between the garbage collection cycles",
+       group="dlc",
+       type=int)
+
+define("gc_grace_period",
+       default=604800,
+       help="Time (in seconds) a file or an unattached bundle should stay unreferenced before it is collected",
+       group="dlc",
+       type=int)
+
+define("gc_max_time",
+       default=300,
+       help="Maximum time (in seconds) of a single garbage collection pass, the next one continues from there",
+       group="dlc",
+       type=int)
+
+define("gc_batch_size",
+       default=500,
+       help="Number of files (or bundles) looked up in the database at once upon the garbage collection",
+       group="dlc",
+       type=int)
@@ -6,6 +6,14 @@ from . model.deploy import DeploymentModel
 from . model.bundle import BundlesModel
 from . model.data import DatasModel
 from . model.apps import ApplicationsModel
+from . model.cache import ManifestCache
+from . model.upload import UploadsModel
+from . model.patch import PatchesModel
+from . model.chunks import ChunksModel
+from . model.integrity import ScrubberModel
+from . model.jobs import PublishJobsModel
+from . model.collector import GarbageCollectorModel
+from . model.storage import move_legacy_areas
 
 from . import handler
 from . import admin
@@ -30,13 +38,35 @@ class DLCServer(server.Server):
 
         self.data_host_location = options.data_host_location
 
-        self.app_versions = ApplicationsModel(self.db)
-        self.bundles = BundlesModel(self.db)
+        # before anything looks for the files there
+        move_legacy_areas(options.data_location)
+
+        self.manifests = ManifestCache(
+            self.cache,
+            max_size=options.manifest_cache_size,
+            ttl=options.manifest_cache_ttl,
+            shared_ttl=options.manifest_cache_shared_ttl,
+            generation_interval=options.manifest_cache_generation_interval)
+
+        self.app_versions = ApplicationsModel(self.db, self.manifests)
+        self.chunks = ChunksModel(self.db)
+        self.bundles = BundlesModel(self.db, self.chunks)
+        self.uploads = UploadsModel(self.bundles, self.db)
+        self.scrubber = ScrubberModel(self.bundles, self.db)
+        self.collector = GarbageCollectorModel(self.bundles, self.db)
         self.deployment = DeploymentModel(self.bundles, self.app_versions)
-        self.datas = DatasModel(self.bundles, self.deployment, self.db)
+        self.patches = PatchesModel(self.bundles, self.deployment, self.db)
+        self.jobs = PublishJobsModel(
+            self.db,
+            lease_time=options.publish_job_lease,
+            max_attempts=options.publish_job_max_attempts)
+        self.datas = DatasModel(
+            self.app_versions, self.bundles, self.deployment, self.patches, self.jobs, self.manifests, self.db,
+            snapshots_cache_size=options.manifest_snapshots_cache_size)
 
     def get_models(self):
-        return [self.datas, self.bundles, self.deployment, self.app_versions]
+        return [self.datas, self.jobs, self.bundles, self.chunks, self.uploads, self.patches, self.deployment,
+                self.app_versions, self.scrubber, self.collector]
 
     def get_admin(self):
         return {
@@ -47,6 +77,7 @@ class DLCServer(server.Server):
             "bundle": admin.BundleController,
             "new_bundle": admin.NewBundleController,
             "attach_bundle": admin.AttachBundleController,
+            "import_bundles": admin.ImportBundlesController,
             "app_settings": admin.ApplicationSettingsController
         }
 
@@ -58,11 +89,20 @@ class DLCServer(server.Server):
         }
 
     def get_handlers(self):
-        return [
+        handlers = [
             (r"/bundle", handler.FetchBundleHandler),
+            (r"/bundles", handler.FetchBundlesHandler),
+            (r"/upload", handler.UploadsHandler),
+            (r"/upload/([0-9]+)", handler.UploadHandler),
+            (r"/upload/([0-9]+)/finalize", handler.FinalizeUploadHandler),
             (r"/data/([a-z0-9_-]+)/([a-z0-9_\.-]+)", handler.AppVersionHandler),
         ]
 
+        if options.serve_downloads:
+            handlers.append((r"/download/(.+)", handler.DownloadHandler, dict(root=options.data_runtime_location)))
+
+        return handlers
+
 
 if __name__ == "__main__":
     stt = server.init()
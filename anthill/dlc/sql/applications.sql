@@ -5,6 +5,7 @@ CREATE TABLE `applications` (
   `deployment_data` json NOT NULL,
   `filters_scheme` json NOT NULL,
   `payload_scheme` json NOT NULL,
+  `deployment_concurrency` int(10) unsigned DEFAULT NULL,
   PRIMARY KEY (`application_name`),
   UNIQUE KEY `application_name` (`application_name`,`gamespace_id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
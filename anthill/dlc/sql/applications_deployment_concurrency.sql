@@ -0,0 +1 @@
+ALTER TABLE `applications` ADD COLUMN `deployment_concurrency` int(10) unsigned DEFAULT NULL;
\ No newline at end of file
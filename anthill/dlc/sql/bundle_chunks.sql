@@ -0,0 +1,8 @@
+CREATE TABLE `bundle_chunks` (
+  `bundle_id` int(11) unsigned NOT NULL,
+  `chunk_index` int(11) unsigned NOT NULL,
+  `chunk_hash` varchar(64) NOT NULL,
+  PRIMARY KEY (`bundle_id`,`chunk_index`),
+  KEY `chunk_hash` (`chunk_hash`),
+  CONSTRAINT `bundle_chunks_ibfk_1` FOREIGN KEY (`bundle_id`) REFERENCES `bundles` (`bundle_id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
@@ -0,0 +1,12 @@
+CREATE TABLE `bundle_patches` (
+  `patch_id` int(11) unsigned NOT NULL AUTO_INCREMENT,
+  `gamespace_id` int(11) unsigned NOT NULL,
+  `bundle_id` int(11) unsigned NOT NULL,
+  `from_bundle_id` int(11) unsigned NOT NULL,
+  `from_hash` varchar(64) NOT NULL,
+  `patch_url` varchar(512) NOT NULL,
+  `patch_size` int(11) unsigned NOT NULL,
+  PRIMARY KEY (`patch_id`),
+  UNIQUE KEY `bundle_from_hash` (`bundle_id`,`from_hash`),
+  CONSTRAINT `bundle_patches_ibfk_1` FOREIGN KEY (`bundle_id`) REFERENCES `bundles` (`bundle_id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
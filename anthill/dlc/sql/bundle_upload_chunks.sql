@@ -0,0 +1,7 @@
+CREATE TABLE `bundle_upload_chunks` (
+  `upload_id` int(11) unsigned NOT NULL,
+  `chunk_offset` bigint(20) unsigned NOT NULL,
+  `chunk_size` int(11) unsigned NOT NULL,
+  PRIMARY KEY (`upload_id`,`chunk_offset`),
+  CONSTRAINT `bundle_upload_chunks_ibfk_1` FOREIGN KEY (`upload_id`) REFERENCES `bundle_uploads` (`upload_id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
@@ -0,0 +1,12 @@
+CREATE TABLE `bundle_uploads` (
+  `upload_id` int(11) unsigned NOT NULL AUTO_INCREMENT,
+  `gamespace_id` int(11) unsigned NOT NULL,
+  `application_name` varchar(255) NOT NULL,
+  `bundle_id` int(11) unsigned NOT NULL,
+  `upload_size` bigint(20) unsigned NOT NULL,
+  `upload_hash` varchar(64) DEFAULT NULL,
+  `upload_created` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`upload_id`),
+  KEY `bundle_id` (`bundle_id`),
+  CONSTRAINT `bundle_uploads_ibfk_1` FOREIGN KEY (`bundle_id`) REFERENCES `bundles` (`bundle_id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
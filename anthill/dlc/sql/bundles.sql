@@ -9,5 +9,6 @@ CREATE TABLE `bundles` (
   `bundle_status` enum('CREATED','UPLOADED','DELIVERING','DELIVERED','ERROR') NOT NULL DEFAULT 'CREATED',
   `bundle_filters` json NOT NULL,
   `bundle_payload` json NOT NULL,
+  `bundle_detached_at` datetime DEFAULT NULL,
   PRIMARY KEY (`bundle_id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
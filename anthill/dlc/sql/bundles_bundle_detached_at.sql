@@ -0,0 +1 @@
+ALTER TABLE `bundles` ADD COLUMN `bundle_detached_at` datetime DEFAULT NULL;
\ No newline at end of file
@@ -0,0 +1 @@
+ALTER TABLE `bundles` ADD INDEX `bundles_hash_idx` (`bundle_hash`);
\ No newline at end of file
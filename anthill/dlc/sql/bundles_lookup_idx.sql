@@ -0,0 +1 @@
+ALTER TABLE `bundles` ADD INDEX `bundles_lookup_idx` (`gamespace_id`, `bundle_name`, `bundle_hash`, `bundle_status`);
\ No newline at end of file
@@ -0,0 +1,8 @@
+CREATE TABLE `chunks` (
+  `gamespace_id` int(11) unsigned NOT NULL,
+  `application_name` varchar(255) NOT NULL,
+  `chunk_hash` varchar(64) NOT NULL,
+  `chunk_size` int(11) unsigned NOT NULL,
+  `chunk_url` varchar(512) DEFAULT NULL,
+  PRIMARY KEY (`gamespace_id`,`application_name`,`chunk_hash`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
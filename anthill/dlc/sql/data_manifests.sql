@@ -0,0 +1,7 @@
+CREATE TABLE `data_manifests` (
+  `data_id` int(11) unsigned NOT NULL,
+  `gamespace_id` int(11) unsigned NOT NULL,
+  `manifest` json NOT NULL,
+  PRIMARY KEY (`data_id`),
+  CONSTRAINT `data_manifests_ibfk_1` FOREIGN KEY (`data_id`) REFERENCES `datas` (`data_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
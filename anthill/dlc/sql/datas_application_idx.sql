@@ -0,0 +1 @@
+ALTER TABLE `datas` ADD INDEX `datas_application_idx` (`application_name`, `gamespace_id`, `version_status`);
\ No newline at end of file
@@ -0,0 +1,16 @@
+CREATE TABLE `publish_jobs` (
+  `job_id` int(11) unsigned NOT NULL AUTO_INCREMENT,
+  `gamespace_id` int(11) unsigned NOT NULL,
+  `data_id` int(11) unsigned NOT NULL,
+  `job_status` enum('QUEUED','RUNNING','DONE','FAILED') NOT NULL DEFAULT 'QUEUED',
+  `job_lease_owner` varchar(64) DEFAULT NULL,
+  `job_lease_until` datetime DEFAULT NULL,
+  `job_attempts` int(11) unsigned NOT NULL DEFAULT '0',
+  `job_progress` int(11) unsigned NOT NULL DEFAULT '0',
+  `job_total` int(11) unsigned NOT NULL DEFAULT '0',
+  `job_created` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`job_id`),
+  UNIQUE KEY `data_id` (`data_id`),
+  KEY `job_status` (`job_status`,`job_lease_until`),
+  CONSTRAINT `publish_jobs_ibfk_1` FOREIGN KEY (`data_id`) REFERENCES `datas` (`data_id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
@@ -0,0 +1,81 @@
+
+from anthill.common.database import DatabaseError
+
+import re
+
+
+class FakeDatabase(object):
+    """
+    Records the statements run through anthill.common.database.Database (and its connections), a statement
+    is answered with the last result registered for a pattern it matches, or fails with the error registered.
+    The log has COMMIT, ROLLBACK and RELEASE next to the statements, so the transactions can be checked.
+    """
+
+    def __init__(self):
+        self.results = []
+        self.log = []
+
+    def on(self, pattern, result=None, error=None):
+        self.results.insert(0, (re.compile(pattern, re.S), result, error))
+
+    def fail(self, pattern, error=None):
+        self.on(pattern, error=error or DatabaseError(1, "Failed: " + pattern))
+
+    def __run__(self, method, query, args):
+        query = " ".join(query.split())
+        self.log.append(query)
+
+        for pattern, result, error in self.results:
+            if pattern.search(query):
+                if error is not None:
+                    raise error
+                return result(*args) if callable(result) else result
+
+        return [] if method == "query" else None if method == "get" else 0
+
+    def statements(self, prefix):
+        return [query for query in self.log if query.startswith(prefix)]
+
+    def acquire(self, auto_commit=True):
+        return FakeConnection(self)
+
+    async def execute(self, query, *args):
+        return self.__run__("execute", query, args)
+
+    async def get(self, query, *args):
+        return self.__run__("get", query, args)
+
+    async def insert(self, query, *args):
+        return self.__run__("insert", query, args)
+
+    async def query(self, query, *args):
+        return self.__run__("query", query, args)
+
+
+class FakeConnection(object):
+    def __init__(self, database):
+        self.database = database
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.database.log.append("RELEASE")
+
+    async def commit(self):
+        self.database.log.append("COMMIT")
+
+    async def rollback(self):
+        self.database.log.append("ROLLBACK")
+
+    async def execute(self, query, *args):
+        return self.database.__run__("execute", query, args)
+
+    async def get(self, query, *args):
+        return self.database.__run__("get", query, args)
+
+    async def insert(self, query, *args):
+        return self.database.__run__("insert", query, args)
+
+    async def query(self, query, *args):
+        return self.database.__run__("query", query, args)
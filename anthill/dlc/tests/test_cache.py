@@ -0,0 +1,97 @@
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from anthill.dlc.model.cache import ManifestCache, ManifestEntry
+
+from unittest import TestCase
+
+import gzip
+import ujson
+
+
+class FakeStorage(object):
+    """
+    A key/value storage in memory, in place of redis
+    """
+
+    def __init__(self, values):
+        self.values = values
+
+    def acquire(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def get(self, key):
+        return self.values.get(key)
+
+    async def mget(self, *keys):
+        return [self.values.get(key) for key in keys]
+
+    async def setex(self, key, ttl, value):
+        self.values[key] = value.encode("utf-8") if isinstance(value, str) else value
+
+
+class TestManifestCache(AsyncTestCase):
+    @gen_test
+    async def test_json_many(self):
+        cache = ManifestCache(FakeStorage({
+            "a": ujson.dumps({"url": "a"}).encode("utf-8"),
+            "b": b"{corrupted",
+            "c": b"\xff\xfe"
+        }))
+
+        await cache.put_json("d", {"url": "d"})
+
+        self.assertEqual(await cache.get_json_many(["a", "b", "c", "d", "e"]), {"a": {"url": "a"}, "d": {"url": "d"}})
+
+    @gen_test
+    async def test_json(self):
+        cache = ManifestCache(FakeStorage({"a": b"{corrupted"}))
+
+        self.assertIsNone(await cache.get_json("a"))
+        self.assertEqual(await cache.put_json("a", {"url": "a"}), {"url": "a"})
+        self.assertEqual(await cache.get_json("a"), {"url": "a"})
+
+
+class TestManifestEntry(TestCase):
+    def test_small(self):
+        entry = ManifestEntry.dump(5, {"bundles": {}})
+        loaded = ManifestEntry.loads(entry.dumps())
+
+        self.assertEqual(loaded.data_id, 5)
+        self.assertEqual(loaded.etag, entry.etag)
+        self.assertEqual(ujson.loads(loaded.body), {"bundles": {}})
+        # not worth compressing
+        self.assertEqual(loaded.encodings, {})
+
+    def test_compressed(self):
+        manifest = {"bundles": {"bundle_{0}".format(i): {"url": "http://example.com/{0}".format(i)}
+                                for i in range(0, 100)}}
+
+        entry = ManifestEntry.dump(5, manifest)
+        loaded = ManifestEntry.loads(entry.dumps())
+
+        self.assertEqual(loaded.body, entry.body)
+        self.assertEqual(loaded.encodings, entry.encodings)
+        self.assertEqual(gzip.decompress(loaded.encodings["gzip"]).decode("utf-8"), entry.body)
+
+    def test_etag(self):
+        a = ManifestEntry.dump(5, {"bundles": {"a": {"url": "http://example.com/a"}}})
+        b = ManifestEntry.dump(5, {"bundles": {"a": {"url": "http://example.com/b"}}})
+
+        self.assertEqual(a.etag, ManifestEntry.dump(5, {"bundles": {"a": {"url": "http://example.com/a"}}}).etag)
+        self.assertNotEqual(a.etag, b.etag)
+
+    def test_corrupted(self):
+        raw = ManifestEntry.dump(5, {"bundles": {}}).dumps()
+
+        with self.assertRaises(ValueError):
+            ManifestEntry.loads(raw[:-1])
+
+        with self.assertRaises(ValueError):
+            ManifestEntry.loads(raw + b"!")
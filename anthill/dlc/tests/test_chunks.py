@@ -0,0 +1,169 @@
+
+from unittest import TestCase, skipIf
+from tornado.testing import AsyncTestCase, gen_test
+
+from anthill.dlc import options as _opts
+from anthill.dlc.model import chunks
+from anthill.dlc.model.chunks import ChunksModel, chunk_mask, chunk_file, find_cut
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . database import FakeDatabase
+
+import os
+import random
+import shutil
+import tempfile
+
+
+class TestChunks(TestCase):
+    MIN_SIZE = 256
+    AVG_SIZE = 1024
+    MAX_SIZE = 4096
+
+    def cuts(self, data):
+        mask = chunk_mask(TestChunks.AVG_SIZE)
+        result = []
+        offset = 0
+
+        while offset < len(data):
+            offset += find_cut(memoryview(data)[offset:], TestChunks.MIN_SIZE, TestChunks.MAX_SIZE, mask)
+            result.append(offset)
+
+        return result
+
+    def test_mask(self):
+        self.assertEqual(chunk_mask(1024), ((1 << 10) - 1) << 54)
+        self.assertEqual(chunk_mask(1), 1 << 63)
+        self.assertEqual(bin(chunk_mask(65536)).count("1"), 16)
+
+    def test_bounds(self):
+        mask = chunk_mask(TestChunks.AVG_SIZE)
+
+        self.assertEqual(find_cut(b"", TestChunks.MIN_SIZE, TestChunks.MAX_SIZE, mask), 0)
+        self.assertEqual(find_cut(b"a" * 100, TestChunks.MIN_SIZE, TestChunks.MAX_SIZE, mask), 100)
+        # nothing to cut at, so a chunk is as large as it could be
+        self.assertEqual(find_cut(b"\0" * 10000, TestChunks.MIN_SIZE, TestChunks.MAX_SIZE, mask),
+                         TestChunks.MAX_SIZE)
+
+        rnd = random.Random(1)
+        data = bytes(rnd.getrandbits(8) for i in range(0, 65536))
+        cuts = self.cuts(data)
+        sizes = [b - a for a, b in zip([0] + cuts, cuts)]
+
+        self.assertEqual(cuts[-1], len(data))
+        self.assertTrue(all(size <= TestChunks.MAX_SIZE for size in sizes))
+        self.assertTrue(all(size > TestChunks.MIN_SIZE for size in sizes[:-1]))
+        # content defined, not every chunk is the max size
+        self.assertGreater(len(cuts), len(data) // TestChunks.MAX_SIZE)
+
+    def test_content_defined(self):
+        rnd = random.Random(2)
+        data = bytes(rnd.getrandbits(8) for i in range(0, 65536))
+        inserted = data[:1000] + b"inserted" + data[1000:]
+
+        original = set(self.cuts(data))
+        shifted = set(cut - len(b"inserted") for cut in self.cuts(inserted))
+
+        # an insertion only moves the cut points around it
+        self.assertGreater(len(original & shifted), len(original) - 3)
+
+    @skipIf(chunks.numpy is None, "numpy is not installed")
+    def test_numpy(self):
+        rnd = random.Random(3)
+        numpy = chunks.numpy
+
+        # the cut points are exactly the same, around the blocks and min_size as well
+        for i in range(0, 40):
+            data = bytes(rnd.getrandbits(8) for j in range(0, rnd.randint(0, chunks.NUMPY_BLOCK * 3)))
+            min_size = rnd.choice([0, 1, 63, 64, 100, 4096])
+            max_size = min_size + rnd.choice([1, 63, 64, 65, 5000, chunks.NUMPY_BLOCK, chunks.NUMPY_BLOCK * 3])
+            mask = chunk_mask(rnd.choice([16, 256, 4096, 1048576]))
+
+            expected = find_cut(data, min_size, max_size, mask)
+
+            try:
+                chunks.numpy = None
+                self.assertEqual(find_cut(data, min_size, max_size, mask), expected)
+            finally:
+                chunks.numpy = numpy
+
+
+class TestChunkFile(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.path = os.path.join(self.location, "bundle")
+
+        rnd = random.Random(4)
+        with open(self.path, "wb") as f:
+            f.write(bytes(rnd.getrandbits(8) for i in range(0, 100000)))
+
+    def tearDown(self):
+        shutil.rmtree(self.location, ignore_errors=True)
+
+    def test_chunk_file(self):
+        result = chunk_file(self.path, os.path.join(self.location, "chunks"), 256, 1024, 4096, 1000000)
+
+        self.assertEqual(sum(size for chunk_hash, size in result), 100000)
+
+        with open(self.path, "rb") as f:
+            content = f.read()
+
+        stored = b""
+        for chunk_hash, size in result:
+            with open(chunks.chunk_path(os.path.join(self.location, "chunks"), chunk_hash), "rb") as f:
+                stored += f.read()
+
+        self.assertEqual(stored, content)
+
+    def test_too_big(self):
+        self.assertIsNone(chunk_file(self.path, os.path.join(self.location, "chunks"), 256, 1024, 4096, 99999))
+        self.assertFalse(os.path.exists(os.path.join(self.location, "chunks")))
+
+
+class TestChunkBundle(AsyncTestCase):
+    def setUp(self):
+        super(TestChunkBundle, self).setUp()
+
+        self.location = tempfile.mkdtemp()
+        self.path = os.path.join(self.location, "bundle")
+
+        with open(self.path, "wb") as f:
+            f.write(os.urandom(10000))
+
+        self.db = FakeDatabase()
+        self.db.on(r"FOR UPDATE", {"bundle_hash": "abc"})
+
+        self.chunks = ChunksModel(self.db)
+        self.chunks.location = os.path.join(self.location, "chunks")
+        self.chunks.executor = ThreadPoolExecutor(max_workers=1)
+
+    def tearDown(self):
+        self.chunks.executor.shutdown()
+        shutil.rmtree(self.location, ignore_errors=True)
+        super(TestChunkBundle, self).tearDown()
+
+    @gen_test
+    async def test_chunk_bundle(self):
+        await self.chunks.chunk_bundle(1, "game", 5, self.path, "abc")
+
+        self.assertEqual(len(self.db.statements("INSERT INTO `bundle_chunks`")), 1)
+        self.assertEqual(self.db.log[-2:], ["COMMIT", "RELEASE"])
+
+    @gen_test
+    async def test_changed(self):
+        # uploaded once again meanwhile
+        await self.chunks.chunk_bundle(1, "game", 5, self.path, "def")
+
+        self.assertEqual(self.db.statements("INSERT"), [])
+        self.assertEqual(self.db.log[-2:], ["ROLLBACK", "RELEASE"])
+
+    @gen_test
+    async def test_failed(self):
+        self.db.fail(r"^INSERT INTO `bundle_chunks`")
+
+        with self.assertRaises(chunks.ChunkError):
+            await self.chunks.chunk_bundle(1, "game", 5, self.path, "abc")
+
+        self.assertNotIn("COMMIT", self.db.log)
+        self.assertEqual(self.db.log[-2:], ["ROLLBACK", "RELEASE"])
@@ -0,0 +1,64 @@
+
+from unittest import TestCase
+
+from anthill.dlc.model.collector import GarbageCollectorModel, merge_orphans
+from anthill.dlc.model.collector import KIND_BUNDLE, KIND_BLOB, KIND_CHUNK, KIND_UPLOAD, KIND_TEMP
+
+
+class TestCollector(TestCase):
+    def test_merge_orphans(self):
+        files = [(1, "a"), (2, "b"), (3, "c"), (5, "e")]
+
+        self.assertEqual(merge_orphans(files, [1, 2, 3, 5]), [])
+        self.assertEqual(merge_orphans(files, []), ["a", "b", "c", "e"])
+        self.assertEqual(merge_orphans(files, [2, 4, 5]), ["a", "c"])
+        self.assertEqual(merge_orphans(files, [0, 6, 7]), ["a", "b", "c", "e"])
+        self.assertEqual(merge_orphans([], [1, 2]), [])
+
+    def test_merge_orphans_tuples(self):
+        files = [((1, "abc"), "1_abc"), ((1, "def"), "1_def"), ((2, "abc"), "2_abc")]
+
+        self.assertEqual(merge_orphans(files, [(1, "def")]), ["1_abc", "2_abc"])
+
+    def test_classify(self):
+        classify = GarbageCollectorModel.__classify__
+
+        self.assertEqual(classify(["game", "a"], "15_abcdef"), (KIND_BUNDLE, (15, "abcdef")))
+        self.assertEqual(classify(["@dlc", "blobs", "ab"], "abcdef"), (KIND_BLOB, "abcdef"))
+        self.assertEqual(classify(["@dlc", "chunks", "ab"], "abcdef"), (KIND_CHUNK, "abcdef"))
+        self.assertEqual(classify(["@dlc", "uploads"], "42.part"), (KIND_UPLOAD, 42))
+        self.assertEqual(classify(["@dlc", "imports"], "import.zip"), (KIND_TEMP, "import.zip"))
+        self.assertEqual(classify(["game", "patches", "a"], "1_2.patch"), (KIND_TEMP, "1_2.patch"))
+        self.assertEqual(classify(["game", "a"], "15_abcdef.tmp"), (KIND_TEMP, "15_abcdef.tmp"))
+
+    def test_classify_applications(self):
+        classify = GarbageCollectorModel.__classify__
+
+        # applications named like the storage areas are just applications
+        for app_name in ["blobs", "chunks", "uploads", "imports"]:
+            self.assertEqual(classify([app_name, "a"], "15_abcdef"), (KIND_BUNDLE, (15, "abcdef")), app_name)
+            self.assertEqual(classify([app_name, "patches", "a"], "1_2.patch"), (KIND_TEMP, "1_2.patch"), app_name)
+            self.assertEqual(classify([app_name], "import.zip"), (None, None), app_name)
+            self.assertEqual(classify([app_name, "ab"], "abcdef"), (None, None), app_name)
+
+    def test_classify_unknown(self):
+        classify = GarbageCollectorModel.__classify__
+
+        # never touched
+        for parts, name in [
+            (["game", "a"], "readme.txt"),
+            (["game", "a"], "abc_def"),
+            (["game"], "15_abcdef"),
+            (["game", "a", "b"], "15_abcdef"),
+            (["game", "patches"], "15_abcdef"),
+            (["@dlc"], "abcdef"),
+            (["@dlc", "blobs"], "abcdef"),
+            (["@dlc", "chunks", "ab", "cd"], "abcdef"),
+            (["@dlc", "uploads"], "42"),
+            (["@dlc", "uploads"], "abc.part"),
+            (["@dlc", "uploads", "a"], "42.part"),
+            (["@dlc", "imports", "a"], "import.zip"),
+            (["@dlc", "other"], "15_abcdef"),
+            (["@dlc", "other", "a"], "15_abcdef")
+        ]:
+            self.assertEqual(classify(parts, name), (None, None), "{0}/{1}".format("/".join(parts), name))
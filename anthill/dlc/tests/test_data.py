@@ -0,0 +1,98 @@
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from anthill.common.database import ConstraintsError
+
+from anthill.dlc import options as _opts
+from anthill.dlc.model.data import DatasModel, DataError, VersionUsesDataError
+
+from . database import FakeDatabase
+
+
+class FakeReclaimer(object):
+    def __init__(self):
+        self.files = []
+
+    def reclaim(self, files):
+        self.files.extend(files)
+
+
+class FakeBundles(object):
+    def __init__(self):
+        self.reclaimer = FakeReclaimer()
+        self.hashes = []
+
+    def reclaim_blobs(self, hashes):
+        self.hashes.extend(hashes)
+
+    async def delete_data_bundles(self, db, gamespace_id, app_id, data_id):
+        await db.execute("DELETE FROM `bundles` WHERE `data_id`=%s;", data_id)
+        return ["file"], ["hash"]
+
+
+class TestDataTransactions(AsyncTestCase):
+    def setUp(self):
+        super(TestDataTransactions, self).setUp()
+
+        self.db = FakeDatabase()
+        self.db.on(r"FROM `datas` WHERE", {
+            "data_id": 5, "application_name": "game",
+            "version_status": DatasModel.STATUS_CREATED, "version_status_reason": ""
+        })
+
+        self.bundles = FakeBundles()
+        self.datas = DatasModel(None, self.bundles, None, None, None, None, self.db)
+
+    def check_rolled_back(self):
+        self.assertEqual(self.db.log[-2:], ["ROLLBACK", "RELEASE"])
+        self.assertNotIn("COMMIT", self.db.log)
+
+    @gen_test
+    async def test_delete(self):
+        await self.datas.delete_data_version(1, "game", 5)
+
+        self.assertEqual(self.db.log[-2:], ["COMMIT", "RELEASE"])
+        self.assertEqual(len(self.db.statements("DELETE FROM `datas`")), 1)
+        self.assertEqual(self.bundles.reclaimer.files, ["file"])
+        self.assertEqual(self.bundles.hashes, ["hash"])
+
+    @gen_test
+    async def test_delete_in_use(self):
+        self.db.on(r"^DELETE FROM `datas`", error=ConstraintsError(1451, "Cannot delete a parent row"))
+
+        with self.assertRaises(VersionUsesDataError):
+            await self.datas.delete_data_version(1, "game", 5)
+
+        self.check_rolled_back()
+        # nothing is removed from the disk either
+        self.assertEqual(self.bundles.reclaimer.files, [])
+
+    @gen_test
+    async def test_delete_failed(self):
+        self.db.fail(r"^DELETE FROM `data_manifests`")
+
+        with self.assertRaises(DataError):
+            await self.datas.delete_data_version(1, "game", 5)
+
+        self.check_rolled_back()
+        # nothing is removed from the disk either
+        self.assertEqual(self.bundles.reclaimer.files, [])
+
+    @gen_test
+    async def test_clone(self):
+        self.db.on(r"^INSERT INTO `datas`", 6)
+
+        self.assertEqual(await self.datas.clone_data_version(1, "game", 5), 6)
+        self.assertEqual(len(self.db.statements("INSERT INTO `data_bundles`")), 1)
+        self.assertEqual(self.db.log[-2:], ["COMMIT", "RELEASE"])
+
+    @gen_test
+    async def test_clone_failed(self):
+        self.db.on(r"^INSERT INTO `datas`", 6)
+        self.db.fail(r"^INSERT INTO `data_bundles`")
+
+        with self.assertRaises(DataError):
+            await self.datas.clone_data_version(1, "game", 5)
+
+        # no empty data version is left behind
+        self.check_rolled_back()
@@ -0,0 +1,122 @@
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from anthill.common.deployment import DeploymentMethod, DeploymentMethods, DeploymentError
+
+from anthill.dlc.model.bundle import BundleAdapter, BundlesModel
+from anthill.dlc.model.deploy import DeploymentModel
+
+
+class FakeDeploymentMethod(DeploymentMethod):
+    failing = set()
+
+    async def deploy(self, gamespace_id, source_file_path, target_directory_name, target_file_name):
+        if target_file_name in FakeDeploymentMethod.failing:
+            raise DeploymentError("Failed to deploy " + target_file_name)
+        return "http://example.com/{0}/{1}".format(target_directory_name, target_file_name)
+
+
+class FakeSettings(object):
+    deployment_method = "fake"
+    deployment_data = {}
+    deployment_concurrency = 2
+
+
+class FakeApps(object):
+    async def get_application(self, gamespace_id, app_id):
+        return FakeSettings()
+
+
+class FakeChunks(object):
+    async def ensure_chunked(self, gamespace_id, app_id, bundles, paths):
+        pass
+
+    async def list_undeployed_chunks(self, gamespace_id, app_id, bundle_ids):
+        return []
+
+
+class FakeBundles(object):
+    def __init__(self, content_addressed, deployed):
+        self.content_addressed = content_addressed
+        self.deployed = deployed
+        self.chunks = FakeChunks()
+        self.urls = {}
+        self.statuses = {}
+
+    async def find_deployed_urls(self, gamespace_id, app_id, hashes):
+        return {bundle_hash: url for bundle_hash, url in self.deployed.items() if bundle_hash in hashes}
+
+    async def update_bundles_urls(self, gamespace_id, status, urls):
+        self.urls.update(urls)
+
+    async def update_bundles_status(self, gamespace_id, bundle_ids, status):
+        for bundle_id in bundle_ids:
+            self.statuses[bundle_id] = status
+
+    async def bundle_path(self, app_id, bundle):
+        return "/tmp/" + bundle.get_key()
+
+    async def bundle_paths(self, app_id, bundles):
+        return {bundle.bundle_id: "/tmp/" + bundle.get_key() for bundle in bundles}
+
+
+def bundle(bundle_id, status=BundlesModel.STATUS_UPLOADED):
+    return BundleAdapter({
+        "bundle_id": bundle_id, "bundle_name": "bundle_{0}".format(bundle_id),
+        "bundle_hash": "hash_{0}".format(bundle_id),
+        "bundle_url": "", "bundle_status": status, "bundle_size": 1, "bundle_key": "key"
+    })
+
+
+class TestDeployment(AsyncTestCase):
+    def setUp(self):
+        super(TestDeployment, self).setUp()
+        DeploymentMethods.METHODS["fake"] = FakeDeploymentMethod
+        FakeDeploymentMethod.failing = set()
+        self.progress = []
+
+    def tearDown(self):
+        DeploymentMethods.METHODS.pop("fake", None)
+        super(TestDeployment, self).tearDown()
+
+    async def report(self, done, total):
+        self.progress.append((done, total))
+
+    @gen_test
+    async def test_progress(self):
+        bundles = FakeBundles(False, {})
+        deployment = DeploymentModel(bundles, FakeApps())
+        items = [bundle(1, BundlesModel.STATUS_DELIVERED)] + [bundle(i) for i in range(2, 6)]
+
+        await deployment.deploy(1, "game", items, progress=self.report)
+
+        self.assertEqual(sorted(bundles.urls), [2, 3, 4, 5])
+        self.assertEqual(self.progress[-1], (5, 5))
+
+    @gen_test
+    async def test_progress_reused(self):
+        # two bundles have their content deployed already
+        bundles = FakeBundles(True, {"hash_2": "http://example.com/2", "hash_3": "http://example.com/3"})
+        deployment = DeploymentModel(bundles, FakeApps())
+        items = [bundle(1, BundlesModel.STATUS_DELIVERED)] + [bundle(i) for i in range(2, 6)]
+
+        await deployment.deploy(1, "game", items, progress=self.report)
+
+        self.assertEqual(bundles.urls[2], "http://example.com/2")
+        self.assertEqual(sorted(bundles.urls), [2, 3, 4, 5])
+        self.assertTrue(all(done <= total for done, total in self.progress), self.progress)
+        self.assertEqual(self.progress[-1], (5, 5))
+
+    @gen_test
+    async def test_failed(self):
+        FakeDeploymentMethod.failing = {"3_key"}
+
+        bundles = FakeBundles(False, {})
+        deployment = DeploymentModel(bundles, FakeApps())
+
+        with self.assertRaises(DeploymentError):
+            await deployment.deploy(1, "game", [bundle(i) for i in range(1, 5)], progress=self.report)
+
+        self.assertEqual(sorted(bundles.urls), [1, 2, 4])
+        self.assertEqual(bundles.statuses[3], BundlesModel.STATUS_ERROR)
+        self.assertEqual(self.progress[-1], (3, 4))
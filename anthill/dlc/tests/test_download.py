@@ -0,0 +1,118 @@
+
+from tornado.testing import AsyncHTTPTestCase
+from tornado.web import Application
+
+from anthill.dlc.handler import DownloadHandler, parse_range
+
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+
+class TestRanges(TestCase):
+    def test_parse_range(self):
+        self.assertEqual(parse_range("bytes=0-99", 1000), (0, 100))
+        self.assertEqual(parse_range("bytes=100-", 1000), (100, 1000))
+        self.assertEqual(parse_range(" bytes=0-0 ", 1000), (0, 1))
+        # the last N bytes
+        self.assertEqual(parse_range("bytes=-100", 1000), (900, 1000))
+        self.assertEqual(parse_range("bytes=-5000", 1000), (0, 1000))
+        # past the end of the file
+        self.assertEqual(parse_range("bytes=500-5000", 1000), (500, 1000))
+
+    def test_unsatisfiable(self):
+        start, end = parse_range("bytes=1000-", 1000)
+        self.assertGreaterEqual(start, end)
+
+        start, end = parse_range("bytes=-0", 1000)
+        self.assertGreaterEqual(start, end)
+
+    def test_whole_file(self):
+        for header in ["", "bytes=", "bytes=-", "bytes=0-99,200-299", "items=0-99", "bytes=a-b"]:
+            self.assertIsNone(parse_range(header, 1000), header)
+
+
+class FakeBundles(object):
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=2)
+
+
+class TestDownloadHandler(AsyncHTTPTestCase):
+    # a few blocks of DownloadHandler.CHUNK_SIZE, and a part of one
+    CONTENT = os.urandom(DownloadHandler.CHUNK_SIZE * 2 + 1000)
+    CHUNK_HASH = hashlib.sha256(b"chunk").hexdigest()
+
+    def get_app(self):
+        self.root = tempfile.mkdtemp()
+
+        os.makedirs(os.path.join(self.root, "game", "a"))
+        os.makedirs(os.path.join(self.root, "chunks"))
+
+        with open(os.path.join(self.root, "game", "a", "1_abc"), "wb") as f:
+            f.write(TestDownloadHandler.CONTENT)
+
+        with open(os.path.join(self.root, "chunks", TestDownloadHandler.CHUNK_HASH), "wb") as f:
+            f.write(b"chunk")
+
+        application = Application([(r"/download/(.+)", DownloadHandler, dict(root=self.root))])
+        application.bundles = FakeBundles()
+        return application
+
+    def tearDown(self):
+        self._app.bundles.executor.shutdown()
+        shutil.rmtree(self.root, ignore_errors=True)
+        super(TestDownloadHandler, self).tearDown()
+
+    def test_whole(self):
+        response = self.fetch("/download/game/a/1_abc")
+
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, TestDownloadHandler.CONTENT)
+        self.assertEqual(response.headers["Accept-Ranges"], "bytes")
+
+        # not modified
+        response = self.fetch("/download/game/a/1_abc", headers={"If-None-Match": response.headers["Etag"]})
+        self.assertEqual(response.code, 304)
+
+    def test_range(self):
+        start = DownloadHandler.CHUNK_SIZE - 10
+        end = DownloadHandler.CHUNK_SIZE * 2 + 10
+
+        response = self.fetch("/download/game/a/1_abc", headers={"Range": "bytes={0}-{1}".format(start, end - 1)})
+
+        self.assertEqual(response.code, 206)
+        self.assertEqual(response.body, TestDownloadHandler.CONTENT[start:end])
+        self.assertEqual(response.headers["Content-Range"], "bytes {0}-{1}/{2}".format(
+            start, end - 1, len(TestDownloadHandler.CONTENT)))
+
+    def test_if_range(self):
+        response = self.fetch("/download/game/a/1_abc", headers={"Range": "bytes=0-9", "If-Range": '"other"'})
+
+        self.assertEqual(response.code, 200)
+        self.assertEqual(len(response.body), len(TestDownloadHandler.CONTENT))
+
+    def test_unsatisfiable(self):
+        response = self.fetch("/download/game/a/1_abc", headers={"Range": "bytes=100000000-"})
+
+        self.assertEqual(response.code, 416)
+
+    def test_head(self):
+        response = self.fetch("/download/game/a/1_abc", method="HEAD")
+
+        self.assertEqual(response.code, 200)
+        self.assertEqual(int(response.headers["Content-Length"]), len(TestDownloadHandler.CONTENT))
+
+    def test_chunk(self):
+        response = self.fetch("/download/chunks/" + TestDownloadHandler.CHUNK_HASH)
+
+        self.assertEqual(response.body, b"chunk")
+        self.assertEqual(response.headers["Etag"], '"{0}"'.format(TestDownloadHandler.CHUNK_HASH))
+
+    def test_missing(self):
+        self.assertEqual(self.fetch("/download/game/a/2_abc").code, 404)
+        self.assertEqual(self.fetch("/download/game/a").code, 404)
+        self.assertEqual(self.fetch("/download/../" + os.path.basename(self.root)).code, 403)
@@ -0,0 +1,74 @@
+
+
+from unittest import TestCase
+
+from anthill.dlc.model.filters import parse_conditions, matches, FilterError
+
+
+class TestFilters(TestCase):
+    def check(self, env, filters, expected):
+        self.assertEqual(matches(filters, parse_conditions(env)), expected,
+                         "{0} should {1}match {2}".format(env, "" if expected else "not ", filters))
+
+    def test_equal(self):
+        self.check({"platform": "ios"}, {"platform": "ios"}, True)
+        self.check({"platform": "ios"}, {"platform": "android"}, False)
+        # a case insensitive collation, trailing spaces are ignored
+        self.check({"platform": "IOS"}, {"platform": "ios "}, True)
+        self.check({"version": 5}, {"version": 5}, True)
+        self.check({"version": 5}, {"version": "5"}, True)
+        self.check({"hd": True}, {"hd": True}, True)
+        self.check({"hd": True}, {"hd": False}, False)
+
+    def test_missing(self):
+        self.check({"platform": "ios"}, {}, False)
+        self.check({"platform": {"@func": ">", "@value": 1}}, {"other": 5}, False)
+
+    def test_nested(self):
+        self.check({"device.gpu": "mali"}, {"device": {"gpu": "mali"}}, True)
+        self.check({"device.gpu": "mali"}, {"device": "mali"}, False)
+
+    def test_compare(self):
+        self.check({"level": {"@func": ">", "@value": 5}}, {"level": 6}, True)
+        self.check({"level": {"@func": ">", "@value": 5}}, {"level": 5}, False)
+        self.check({"level": {"@func": ">=", "@value": 5}}, {"level": 5}, True)
+        self.check({"level": {"@func": "<", "@value": 5}}, {"level": 4}, True)
+        self.check({"level": {"@func": "<=", "@value": 5}}, {"level": 6}, False)
+        self.check({"level": {"@func": "!=", "@value": 5}}, {"level": 6}, True)
+        # a string is compared by its numeric prefix, as MySQL does
+        self.check({"level": {"@func": ">", "@value": 5}}, {"level": "10abc"}, True)
+        self.check({"level": {"@func": ">", "@value": 5}}, {"level": "abc"}, False)
+
+    def test_between(self):
+        env = {"level": {"@func": "between", "@a": 5, "@b": 10}}
+
+        self.check(env, {"level": 5}, True)
+        self.check(env, {"level": 10}, True)
+        self.check(env, {"level": 11}, False)
+
+    def test_in(self):
+        self.check({"platform": ["ios", "android"]}, {"platform": "android"}, True)
+        self.check({"platform": ["ios", "android"]}, {"platform": "windows"}, False)
+        self.check({"level": {"@func": "in", "@values": [1, 2]}}, {"level": 2}, True)
+        self.check({"level": {"@func": "in", "@values": [1, 2]}}, {"level": "2"}, False)
+
+    def test_every_condition(self):
+        env = {"platform": "ios", "level": {"@func": ">", "@value": 5}}
+
+        self.check(env, {"platform": "ios", "level": 6}, True)
+        self.check(env, {"platform": "ios", "level": 1}, False)
+        self.check({}, {"platform": "ios"}, True)
+
+    def test_errors(self):
+        for env in [
+            [],
+            {"level": {"@func": "like", "@value": 5}},
+            {"level": {"@func": ">"}},
+            {"level": {"@func": ">", "@value": "5"}},
+            {"level": {"@func": "between", "@a": 5}},
+            {"level": {"@func": "in", "@values": []}},
+            {"level": {"@func": "in", "@values": 5}},
+            {"level": None}
+        ]:
+            with self.assertRaises(FilterError, msg=str(env)):
+                parse_conditions(env)
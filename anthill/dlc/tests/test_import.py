@@ -0,0 +1,73 @@
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from anthill.dlc import options as _opts
+from anthill.dlc.model.bundle import BundlesModel, BundleError
+
+from . database import FakeDatabase
+
+
+class TestImportBundles(AsyncTestCase):
+    def setUp(self):
+        super(TestImportBundles, self).setUp()
+
+        self.db = FakeDatabase()
+        self.db.on(r"FROM `datas` WHERE .* FOR UPDATE", {"data_id": 5})
+        self.db.on(r"^INSERT INTO `bundles`", 100)
+        self.db.on(r"^SELECT \* FROM `bundles`", self.inserted)
+
+        self.bundles = BundlesModel(self.db, None)
+
+    def tearDown(self):
+        self.bundles.executor.shutdown()
+        super(TestImportBundles, self).tearDown()
+
+    @staticmethod
+    def inserted(first_id, gamespace_id, *keys):
+        # in a different order, on purpose
+        return [{
+            "bundle_id": first_id + i, "bundle_name": "bundle_{0}".format(i), "bundle_hash": "",
+            "bundle_url": "", "bundle_status": BundlesModel.STATUS_CREATED, "bundle_size": 0,
+            "bundle_key": key
+        } for i, key in reversed(list(enumerate(keys)))]
+
+    @gen_test
+    async def test_import(self):
+        created = await self.bundles.import_bundles(1, 5, [("bundle_0", {}, {}), ("bundle_1", {"a": 1}, {})])
+
+        self.assertEqual([bundle.bundle_id for bundle in created], [100, 101])
+        self.assertEqual(self.db.log[-2:], ["COMMIT", "RELEASE"])
+
+    @gen_test
+    async def test_empty(self):
+        self.assertEqual(await self.bundles.import_bundles(1, 5, []), [])
+        self.assertEqual(self.db.log, [])
+
+    @gen_test
+    async def test_existing(self):
+        self.db.on(r"`bundle_name` IN", [{"bundle_name": "bundle_1"}])
+
+        with self.assertRaises(BundleError):
+            await self.bundles.import_bundles(1, 5, [("bundle_0", {}, {}), ("bundle_1", {}, {})])
+
+        self.assertEqual(self.db.statements("INSERT"), [])
+        self.assertEqual(self.db.log[-2:], ["ROLLBACK", "RELEASE"])
+
+    @gen_test
+    async def test_failed(self):
+        self.db.fail(r"^INSERT INTO `data_bundles`")
+
+        with self.assertRaises(BundleError):
+            await self.bundles.import_bundles(1, 5, [("bundle_0", {}, {}), ("bundle_1", {}, {})])
+
+        self.assertEqual(len(self.db.statements("INSERT INTO `bundles`")), 1)
+        self.assertNotIn("COMMIT", self.db.log)
+        self.assertEqual(self.db.log[-2:], ["ROLLBACK", "RELEASE"])
+
+    @gen_test
+    async def test_bad_input(self):
+        for bundles in [[("", {}, {})], [("a", [], {})], [("a", {}, None)], [("a", {}, {}), ("a", {}, {})]]:
+            with self.assertRaises(BundleError):
+                await self.bundles.import_bundles(1, 5, bundles)
+
+        self.assertEqual(self.db.log, [])
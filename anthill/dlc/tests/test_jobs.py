@@ -0,0 +1,46 @@
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from anthill.dlc.model.jobs import PublishJobsModel, JobAdapter, JobError
+
+from . database import FakeDatabase
+
+
+class TestPublishJobs(AsyncTestCase):
+    def setUp(self):
+        super(TestPublishJobs, self).setUp()
+
+        self.db = FakeDatabase()
+        self.jobs = PublishJobsModel(self.db)
+        self.job = JobAdapter({
+            "job_id": 1, "gamespace_id": 1, "data_id": 5, "job_status": PublishJobsModel.STATUS_RUNNING,
+            "job_lease_owner": "node", "job_attempts": 1, "job_progress": 0, "job_total": 0
+        })
+
+    @gen_test
+    async def test_finish(self):
+        self.db.on(r"^UPDATE `publish_jobs`", 1)
+
+        self.assertTrue(await self.jobs.finish(self.job, PublishJobsModel.STATUS_DONE, "PUBLISHED"))
+        self.assertEqual(len(self.db.statements("UPDATE `datas`")), 1)
+        self.assertEqual(self.db.log[-2:], ["COMMIT", "RELEASE"])
+
+    @gen_test
+    async def test_finish_lost(self):
+        # the lease has been taken over by another worker
+        self.db.on(r"^UPDATE `publish_jobs`", 0)
+
+        self.assertFalse(await self.jobs.finish(self.job, PublishJobsModel.STATUS_DONE, "PUBLISHED"))
+        self.assertEqual(self.db.statements("UPDATE `datas`"), [])
+        self.assertEqual(self.db.log[-2:], ["ROLLBACK", "RELEASE"])
+
+    @gen_test
+    async def test_finish_failed(self):
+        self.db.on(r"^UPDATE `publish_jobs`", 1)
+        self.db.fail(r"^UPDATE `datas`")
+
+        with self.assertRaises(JobError):
+            await self.jobs.finish(self.job, PublishJobsModel.STATUS_DONE, "PUBLISHED")
+
+        self.assertNotIn("COMMIT", self.db.log)
+        self.assertEqual(self.db.log[-2:], ["ROLLBACK", "RELEASE"])
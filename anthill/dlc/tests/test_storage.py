@@ -0,0 +1,61 @@
+
+from unittest import TestCase
+
+from anthill.dlc.model.storage import move_legacy_areas, storage_path
+
+import os
+import shutil
+import tempfile
+
+
+class TestStorage(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def make(self, *path):
+        os.makedirs(os.path.dirname(os.path.join(self.root, *path)), exist_ok=True)
+        with open(os.path.join(self.root, *path), "wb") as f:
+            f.write(b"test")
+
+    def test_move_legacy(self):
+        self.make("blobs", "ab", "abcdef")
+        self.make("chunks", "cd", "cdef")
+        self.make("uploads", "42.part")
+        self.make("imports", "import.zip")
+        self.make("game", "a", "15_abcdef")
+
+        move_legacy_areas(self.root)
+
+        self.assertTrue(os.path.isfile(os.path.join(storage_path(self.root, "blobs"), "ab", "abcdef")))
+        self.assertTrue(os.path.isfile(os.path.join(storage_path(self.root, "chunks"), "cd", "cdef")))
+        self.assertTrue(os.path.isfile(os.path.join(storage_path(self.root, "uploads"), "42.part")))
+        self.assertTrue(os.path.isfile(os.path.join(storage_path(self.root, "imports"), "import.zip")))
+        self.assertTrue(os.path.isfile(os.path.join(self.root, "game", "a", "15_abcdef")))
+
+        for area in ["blobs", "chunks", "uploads", "imports"]:
+            self.assertFalse(os.path.exists(os.path.join(self.root, area)), area)
+
+    def test_applications(self):
+        # applications named like the storage areas stay where they are
+        self.make("blobs", "a", "15_abcdef")
+        self.make("uploads", "b", "16_abcdef")
+        self.make("imports", "patches", "a", "1_2.patch")
+
+        move_legacy_areas(self.root)
+
+        self.assertTrue(os.path.isfile(os.path.join(self.root, "blobs", "a", "15_abcdef")))
+        self.assertTrue(os.path.isfile(os.path.join(self.root, "uploads", "b", "16_abcdef")))
+        self.assertTrue(os.path.isfile(os.path.join(self.root, "imports", "patches", "a", "1_2.patch")))
+        self.assertFalse(os.path.exists(os.path.join(self.root, "@dlc")))
+
+    def test_both(self):
+        self.make("uploads", "42.part")
+        self.make("@dlc", "uploads", "43.part")
+
+        move_legacy_areas(self.root)
+
+        self.assertTrue(os.path.isfile(os.path.join(self.root, "uploads", "42.part")))
+        self.assertTrue(os.path.isfile(os.path.join(storage_path(self.root, "uploads"), "43.part")))
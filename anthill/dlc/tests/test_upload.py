@@ -0,0 +1,65 @@
+
+from unittest import TestCase
+from tornado.testing import AsyncTestCase, gen_test
+
+from anthill.dlc import options as _opts
+from anthill.dlc.model.bundle import BundlesModel
+from anthill.dlc.model.upload import UploadsModel, UploadDigest, merge_ranges
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . database import FakeDatabase
+
+import os
+import shutil
+import tempfile
+
+
+class TestRanges(TestCase):
+    def test_merge_ranges(self):
+        self.assertEqual(merge_ranges([]), [])
+        self.assertEqual(merge_ranges([(0, 10), (10, 10), (30, 5)]), [[0, 20], [30, 35]])
+        # overlapping and contained chunks
+        self.assertEqual(merge_ranges([(0, 10), (5, 10), (6, 2), (20, 1)]), [[0, 15], [20, 21]])
+
+
+class FakeBundles(object):
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=2)
+
+
+class TestDigest(AsyncTestCase):
+    def setUp(self):
+        super(TestDigest, self).setUp()
+
+        self.root = tempfile.mkdtemp()
+        self.bundles = FakeBundles()
+        self.uploads = UploadsModel(self.bundles, FakeDatabase())
+        self.path = os.path.join(self.root, "1.part")
+        self.content = os.urandom(UploadsModel.READ_BLOCK_SIZE + 1000)
+
+        with open(self.path, "wb") as f:
+            f.write(self.content)
+
+    def tearDown(self):
+        self.bundles.executor.shutdown()
+        shutil.rmtree(self.root, ignore_errors=True)
+        super(TestDigest, self).tearDown()
+
+    @gen_test
+    async def test_digest(self):
+        expected = BundlesModel.HASH_METHOD(self.content).hexdigest()
+
+        self.assertEqual(await self.uploads.__digest__(self.path), expected)
+
+    @gen_test
+    async def test_resume(self):
+        # a part arrived with the chunks, the rest is hashed when the upload is finalized
+        digest = UploadDigest()
+
+        await self.uploads.__update_digest__(digest, self.content[:100])
+        await self.uploads.__advance_digest__(self.path, digest, 5000)
+        self.assertEqual(digest.offset, 5000)
+
+        self.assertEqual(await self.uploads.__digest__(self.path, digest),
+                         BundlesModel.HASH_METHOD(self.content).hexdigest())
@@ -0,0 +1,57 @@
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from anthill.dlc.model.bundle import BundleFileWriter
+
+from concurrent.futures import ThreadPoolExecutor
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+
+class TestBundleFileWriter(AsyncTestCase):
+    def setUp(self):
+        super(TestBundleFileWriter, self).setUp()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.location = tempfile.mkdtemp()
+        self.path = os.path.join(self.location, "app", "a", "1_abc")
+
+    def tearDown(self):
+        self.executor.shutdown()
+        shutil.rmtree(self.location, ignore_errors=True)
+        super(TestBundleFileWriter, self).tearDown()
+
+    @gen_test
+    async def test_close(self):
+        writer = BundleFileWriter(self.executor, self.path, hashlib.sha256, 4)
+        await writer.open()
+
+        for data in [b"ab", b"cde", b"fghij", b"k"]:
+            await writer.write(data)
+
+        self.assertEqual(await writer.close(), hashlib.sha256(b"abcdefghijk").hexdigest())
+        self.assertEqual(writer.size, 11)
+
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), b"abcdefghijk")
+
+    @gen_test
+    async def test_abort(self):
+        writer = BundleFileWriter(self.executor, self.path, hashlib.sha256, 4)
+        await writer.open()
+
+        await writer.write(b"abcdefgh")
+        await writer.write(b"ijk")
+        self.assertTrue(os.path.isfile(self.path))
+
+        await writer.abort()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertIsNone(writer.output_file)
+
+    @gen_test
+    async def test_abort_not_opened(self):
+        writer = BundleFileWriter(self.executor, self.path, hashlib.sha256, 4)
+        await writer.abort()
+        self.assertFalse(os.path.exists(self.path))
@@ -0,0 +1,142 @@
+
+"""
+Compares throughput of the built-in /download/ handler (DownloadHandler) with tornado's plain
+StaticFileHandler serving the same file, and optionally with any other static server (--url).
+
+Every client downloads the whole file (and then a set of random ranges) in a loop:
+
+    python benchmarks/download.py --size 256 --clients 8 --seconds 10
+    python benchmarks/download.py --url http://127.0.0.1:8080/bench.bin
+
+The file is created in a temporary folder, the servers are started in a separate process.
+"""
+
+from anthill.dlc.handler import DownloadHandler
+
+from tornado.ioloop import IOLoop
+from tornado.web import Application, StaticFileHandler
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import argparse
+import http.client
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+
+
+FILE_NAME = "bench.bin"
+BLOCK = 1048576
+
+
+def serve(root, port, ready):
+    app = Application([
+        (r"/download/(.+)", DownloadHandler, dict(root=root)),
+        (r"/static/(.+)", StaticFileHandler, dict(path=root)),
+    ])
+    app.listen(port)
+    ready.set()
+    IOLoop.current().start()
+
+
+def download(url, seconds, ranges, size, seed):
+    rnd = random.Random(seed)
+    parsed = urlparse(url)
+    connection = http.client.HTTPConnection(parsed.hostname, parsed.port)
+    received = 0
+    requests = 0
+    deadline = time.perf_counter() + seconds
+
+    try:
+        while time.perf_counter() < deadline:
+            headers = {}
+            expected = size
+
+            if ranges:
+                start = rnd.randint(0, size - 1)
+                end = min(size, start + rnd.randint(1, 4 * BLOCK))
+                headers["Range"] = "bytes={0}-{1}".format(start, end - 1)
+                expected = end - start
+
+            connection.request("GET", parsed.path, headers=headers)
+            response = connection.getresponse()
+
+            while True:
+                data = response.read(BLOCK)
+                if not data:
+                    break
+                received += len(data)
+
+            if response.status not in (200, 206):
+                raise AssertionError("{0} responded with {1}".format(url, response.status))
+
+            if response.status == 206 and expected != int(response.getheader("Content-Length")):
+                raise AssertionError("{0} responded with a wrong range".format(url))
+
+            requests += 1
+    finally:
+        connection.close()
+
+    return received, requests
+
+
+def measure(name, url, args, size, ranges):
+    with ThreadPoolExecutor(max_workers=args.clients) as executor:
+        started = time.perf_counter()
+        results = list(executor.map(
+            lambda seed: download(url, args.seconds, ranges, size, seed), range(0, args.clients)))
+        elapsed = time.perf_counter() - started
+
+    received = sum(r[0] for r in results)
+    requests = sum(r[1] for r in results)
+
+    print("{0:>10} {1:>6}: {2:10.1f} MB/s, {3:8.1f} requests/s".format(
+        name, "ranges" if ranges else "full", received / elapsed / BLOCK, requests / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Download handler benchmark")
+    parser.add_argument("--size", type=int, default=256, help="size of the file, in megabytes")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--seconds", type=int, default=10)
+    parser.add_argument("--port", type=int, default=9611)
+    parser.add_argument("--url", default=None, help="a file of the same --size served by another server, to compare with")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    size = args.size * BLOCK
+
+    with open(os.path.join(root, FILE_NAME), "wb") as f:
+        for i in range(0, args.size):
+            f.write(os.urandom(BLOCK))
+
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve, args=(root, args.port, ready), daemon=True)
+    server.start()
+    ready.wait()
+
+    targets = [
+        ("download", "http://127.0.0.1:{0}/download/{1}".format(args.port, FILE_NAME)),
+        ("static", "http://127.0.0.1:{0}/static/{1}".format(args.port, FILE_NAME))
+    ]
+
+    if args.url:
+        targets.append(("external", args.url))
+
+    print("{0} MB file, {1} clients, {2}s each".format(args.size, args.clients, args.seconds))
+
+    try:
+        for ranges in (False, True):
+            for name, url in targets:
+                measure(name, url, args, size, ranges)
+    finally:
+        server.terminate()
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+
+"""
+Compares resolving a client `env` into a set of bundles:
+
+  * scan  - every condition evaluated on every bundle, the way MySQL does it with JSON conditions
+  * index - bundle filters compiled into a FilterIndex once, then a few bitwise ANDs per request
+  * mysql - (optional, --mysql) the actual `format_conditions_json` query against a seeded table
+
+Usage:
+
+    python benchmarks/filters.py --bundles 10000 --requests 1000
+    python benchmarks/filters.py --bundles 20000 --mysql --db-host 127.0.0.1 --db-name bench_dlc
+
+Both in-memory ways are checked to select exactly the same bundles.
+"""
+
+from anthill.dlc.model.filters import FilterIndex, parse_conditions, matches
+
+import argparse
+import random
+import time
+import ujson
+
+
+OS = ["windows", "linux", "mac", "ios", "android"]
+ARCHITECTURES = ["x86", "x64", "armv7", "armv7s", "arm64"]
+CHANNELS = ["release", "beta", "alpha"]
+
+FILTERS_SCHEME = {
+    "type": "object",
+    "properties": {
+        "os": {
+            "type": "object",
+            "properties": {name: {"type": "boolean"} for name in OS}
+        },
+        "architecture": {
+            "type": "object",
+            "properties": {name: {"type": "boolean"} for name in ARCHITECTURES}
+        },
+        "channel": {"type": "string"},
+        "quality": {"type": "integer"}
+    }
+}
+
+
+def generate_filters(rnd):
+    return {
+        "os": {name: rnd.random() < 0.7 for name in OS},
+        "architecture": {name: rnd.random() < 0.7 for name in ARCHITECTURES},
+        "channel": rnd.choice(CHANNELS),
+        "quality": rnd.randint(0, 10)
+    }
+
+
+def generate_env(rnd):
+    env = {
+        "os.{0}".format(rnd.choice(OS)): True,
+        "architecture.{0}".format(rnd.choice(ARCHITECTURES)): True
+    }
+
+    kind = rnd.randint(0, 3)
+
+    if kind == 1:
+        env["channel"] = rnd.choice(CHANNELS)
+    elif kind == 2:
+        env["quality"] = {"@func": ">=", "@value": rnd.randint(0, 10)}
+    elif kind == 3:
+        env["channel"] = rnd.sample(CHANNELS, 2)
+
+    return env
+
+
+def measure(name, count, method):
+    started = time.perf_counter()
+    results = method()
+    elapsed = time.perf_counter() - started
+    print("{0:>8}: {1:10.3f} ms total, {2:10.1f} us per request".format(
+        name, elapsed * 1000.0, elapsed * 1000000.0 / count))
+    return results
+
+
+def mysql(args, filters, envs):
+    from anthill.common.database import format_conditions_json
+    import pymysql
+
+    connection = pymysql.connect(
+        host=args.db_host, user=args.db_username, password=args.db_password,
+        db=args.db_name, autocommit=True)
+
+    with connection.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS `bench_bundles`;")
+        cursor.execute(
+            """
+            CREATE TABLE `bench_bundles` (
+              `bundle_id` int(11) unsigned NOT NULL,
+              `bundle_filters` json NOT NULL,
+              PRIMARY KEY (`bundle_id`)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+            """)
+        cursor.executemany(
+            "INSERT INTO `bench_bundles` (`bundle_id`, `bundle_filters`) VALUES (%s, %s);",
+            [(bundle_id, ujson.dumps(f)) for bundle_id, f in enumerate(filters)])
+
+    def run():
+        results = []
+        with connection.cursor() as cursor:
+            for env in envs:
+                conditions, data = [], []
+                for condition, values in format_conditions_json("bundle_filters", env):
+                    conditions.append("(" + condition + ")")
+                    data.extend(values)
+                cursor.execute(
+                    "SELECT `bundle_id` FROM `bench_bundles` WHERE " + " AND ".join(conditions) + ";", data)
+                results.append(sorted(row[0] for row in cursor.fetchall()))
+        return results
+
+    try:
+        return measure("mysql", len(envs), run)
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute("DROP TABLE IF EXISTS `bench_bundles`;")
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bundle filters benchmark")
+    parser.add_argument("--bundles", type=int, default=10000)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--mysql", action="store_true")
+    parser.add_argument("--db-host", default="127.0.0.1")
+    parser.add_argument("--db-username", default="root")
+    parser.add_argument("--db-password", default="")
+    parser.add_argument("--db-name", default="bench_dlc")
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+
+    filters = [generate_filters(rnd) for i in range(0, args.bundles)]
+    envs = [generate_env(rnd) for i in range(0, args.requests)]
+    conditions = [parse_conditions(env) for env in envs]
+
+    print("{0} bundles, {1} requests".format(args.bundles, args.requests))
+
+    index = measure("compile", 1, lambda: FilterIndex(filters, FILTERS_SCHEME))
+
+    scanned = measure("scan", len(envs), lambda: [
+        [bit for bit, f in enumerate(filters) if matches(f, c)]
+        for c in conditions
+    ])
+
+    indexed = measure("index", len(envs), lambda: [
+        FilterIndex.bits(index.select(c))
+        for c in conditions
+    ])
+
+    if scanned != indexed:
+        raise AssertionError("index and scan selected different bundles")
+
+    if args.mysql:
+        if mysql(args, filters, envs) != indexed:
+            raise AssertionError("index and mysql selected different bundles")
+
+    print("results are identical")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+
+"""
+Seeds large `bundles` and `datas` tables in a scratch database, then records latency and EXPLAIN plans
+of the bundle lookup (FetchBundleHandler, AttachBundleController.attach) and the data versions listing
+(DatasModel.list_data_versions) before and after the indexes from anthill/dlc/sql are applied.
+
+Usage:
+
+    python benchmarks/indexes.py --db-host 127.0.0.1 --db-name bench_dlc --bundles 200000 --datas 50000
+
+The scratch database is created if it does not exist, the tables are dropped at the end.
+
+Results: none recorded yet, the indexes still have to be measured against a MySQL server
+before the numbers can be quoted.
+"""
+
+import argparse
+import os
+import random
+import string
+import time
+
+import pymysql
+import pymysql.cursors
+
+
+SQL = os.path.join(os.path.dirname(__file__), "..", "anthill", "dlc", "sql")
+INDEXES = ["bundles_lookup_idx", "datas_application_idx"]
+STATUSES = ["CREATED", "UPLOADED", "DELIVERED", "DELIVERED", "DELIVERED"]
+BATCH = 5000
+
+
+def sql(name):
+    with open(os.path.join(SQL, name + ".sql")) as f:
+        return f.read()
+
+
+def random_string(rnd, n):
+    return "".join(rnd.choice(string.ascii_lowercase + string.digits) for i in range(0, n))
+
+
+def seed(cursor, rnd, args):
+    bundles = []
+    probes = []
+
+    for bundle_id in range(1, args.bundles + 1):
+        gamespace_id = rnd.randint(1, args.gamespaces)
+        name = "bundle_{0}".format(rnd.randint(0, args.bundles // 4))
+        bundle_hash = random_string(rnd, 64)
+        status = rnd.choice(STATUSES)
+
+        bundles.append((bundle_id, gamespace_id, name, random_string(rnd, 32), bundle_hash, status))
+
+        if status == "DELIVERED" and len(probes) < args.queries:
+            probes.append((gamespace_id, name, bundle_hash))
+
+        if len(bundles) >= BATCH:
+            insert_bundles(cursor, bundles)
+            bundles = []
+
+    insert_bundles(cursor, bundles)
+
+    datas = [
+        (rnd.randint(1, args.gamespaces), "app_{0}".format(rnd.randint(0, args.apps)),
+         rnd.choice(["CREATED", "PUBLISHED", "PUBLISHED"]))
+        for i in range(0, args.datas)
+    ]
+
+    for i in range(0, len(datas), BATCH):
+        cursor.executemany(
+            """
+            INSERT INTO `datas` (`gamespace_id`, `application_name`, `version_status`)
+            VALUES (%s, %s, %s);
+            """, datas[i:i + BATCH])
+
+    apps = [(rnd.randint(1, args.gamespaces), "app_{0}".format(rnd.randint(0, args.apps)))
+            for i in range(0, args.queries)]
+
+    return probes, apps
+
+
+def insert_bundles(cursor, bundles):
+    if not bundles:
+        return
+
+    cursor.executemany(
+        """
+        INSERT INTO `bundles`
+        (`bundle_id`, `gamespace_id`, `bundle_name`, `bundle_key`, `bundle_hash`, `bundle_status`,
+            `bundle_filters`, `bundle_payload`)
+        VALUES (%s, %s, %s, %s, %s, %s, '{}', '{}');
+        """, bundles)
+
+
+QUERIES = {
+    "bundle lookup": """
+        SELECT * FROM `bundles`
+        WHERE `gamespace_id`=%s AND `bundle_name`=%s AND `bundle_hash`=%s AND `bundle_status`='DELIVERED';
+    """,
+    "list data versions": """
+        SELECT * FROM `datas`
+        WHERE `application_name`=%s AND `gamespace_id`=%s AND `version_status`='PUBLISHED';
+    """
+}
+
+
+def run(cursor, title, probes, apps):
+    print("\n== {0}".format(title))
+
+    for name, params in [("bundle lookup", probes), ("list data versions", [(a, g) for g, a in apps])]:
+        query = QUERIES[name]
+
+        cursor.execute("EXPLAIN " + query, params[0])
+        plan = cursor.fetchone()
+
+        started = time.perf_counter()
+        for p in params:
+            cursor.execute(query, p)
+            cursor.fetchall()
+        elapsed = time.perf_counter() - started
+
+        print("{0:>20}: {1:10.1f} us per query | type={2} key={3} rows={4} extra={5}".format(
+            name, elapsed * 1000000.0 / len(params),
+            plan["type"], plan["key"], plan["rows"], plan["Extra"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bundle and data version indexes benchmark")
+    parser.add_argument("--bundles", type=int, default=200000)
+    parser.add_argument("--datas", type=int, default=50000)
+    parser.add_argument("--gamespaces", type=int, default=10)
+    parser.add_argument("--apps", type=int, default=100)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--db-host", default="127.0.0.1")
+    parser.add_argument("--db-username", default="root")
+    parser.add_argument("--db-password", default="")
+    parser.add_argument("--db-name", default="bench_dlc")
+    args = parser.parse_args()
+
+    connection = pymysql.connect(
+        host=args.db_host, user=args.db_username, password=args.db_password,
+        autocommit=True, cursorclass=pymysql.cursors.DictCursor)
+
+    rnd = random.Random(args.seed)
+
+    with connection.cursor() as cursor:
+        cursor.execute("CREATE DATABASE IF NOT EXISTS `{0}`;".format(args.db_name))
+        cursor.execute("USE `{0}`;".format(args.db_name))
+        cursor.execute("DROP TABLE IF EXISTS `bundles`, `datas`;")
+        cursor.execute(sql("bundles"))
+        cursor.execute(sql("datas"))
+
+        try:
+            started = time.perf_counter()
+            probes, apps = seed(cursor, rnd, args)
+            cursor.execute("ANALYZE TABLE `bundles`, `datas`;")
+            print("seeded {0} bundles and {1} data versions in {2:.1f}s".format(
+                args.bundles, args.datas, time.perf_counter() - started))
+
+            run(cursor, "before", probes, apps)
+
+            for index in INDEXES:
+                cursor.execute(sql(index))
+            cursor.execute("ANALYZE TABLE `bundles`, `datas`;")
+
+            run(cursor, "after", probes, apps)
+        finally:
+            cursor.execute("DROP TABLE IF EXISTS `bundles`, `datas`;")
+
+    connection.close()
+
+
+if __name__ == "__main__":
+    main()
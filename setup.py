@@ -2,7 +2,8 @@
 from setuptools import setup, find_namespace_packages
 
 DEPENDENCIES = [
-    "anthill-common>=0.2.5"
+    "anthill-common>=0.2.5",
+    "expiringdict"
 ]
 
 setup(
@@ -20,5 +21,10 @@ setup(
     include_package_data=True,
     packages=find_namespace_packages(include=["anthill.*"]),
     zip_safe=False,
-    install_requires=DEPENDENCIES
+    install_requires=DEPENDENCIES,
+    extras_require={
+        "brotli": ["brotli"],
+        "patches": ["bsdiff4"],
+        "chunks": ["numpy"]
+    }
 )